@@ -0,0 +1,313 @@
+"""Audit generated refund workbooks against the work order master.
+
+Every batch workbook is read at the zip level across a worker pool. From
+each sheet the work's fields are taken (the cells the form layout fills
+from the master) together with the layout the fixes in
+update_existing_workbooks.py enforce: the borders of the deposit table and
+the certificate, the tall certificate row and the print setup. The parent
+matches each sheet to its master work through an agreement-number index
+and writes every difference to a CSV report.
+
+    python audit_workbooks.py Security_Refund_Sheets_2022_20250903_101500
+
+The exit status is 1 if anything does not match, so a dispatch script can
+stop on it.
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from form_fields import DEFAULT_DIVISION
+from incremental import normalize_agreement
+from instrumentation import LOG_LEVELS, configure_logging, logger
+from master_reader import BACKENDS, read_excel_data
+from sheet_naming import name_sheets
+from update_existing_workbooks import (BORDERED_COLUMNS, BORDERED_ROWS, CERTIFICATE_COLUMNS, CERTIFICATE_HEADING,
+                                       CERTIFICATE_ROWS, ORIENTATION, PAGE_MARGINS, PAPER_SIZE, PRINT_AREA_PADDING,
+                                       TALL_ROW, TALL_ROW_HEIGHT, UNBORDERED_CELL)
+from work_records import work_records
+from xlsx_patch import WorkbookPackage, column_index, q, split_ref
+
+REPORT_COLUMNS = ['file', 'sheet', 'agreement_no', 'check', 'expected', 'found']
+
+_SIDES = ('left', 'right', 'top', 'bottom')
+
+
+def field_cells(spec=None, division=DEFAULT_DIVISION):
+    """(cell reference, template, field) of every cell the layout fills from a work
+
+    template is the cell's text with ``{field}`` placeholders, e.g.
+    '3. Name of Work: {work_name}'. spec defaults to RWMF 119.
+    """
+    # The layout needs openpyxl, which '--help' should not have to load
+    from form_template import RWMF_119, get_plan
+
+    plan = get_plan(spec or RWMF_119, division)
+    cells = []
+    for row_idx, col_idx, template, bare, _ in plan.variable_cells:
+        ref = f"{chr(ord('A') + col_idx - 1)}{row_idx}"
+        cells.append((ref, template, bare or template[template.index('{') + 1:template.index('}')]))
+    return cells
+
+
+def _text(value):
+    return ' '.join(str(value).split()) if value is not None else ''
+
+
+class _Borders:
+    """Border styles of the cell formats of one workbook, looked up once per format"""
+
+    def __init__(self, styles):
+        self.borders = list(styles.borders)
+        self.cell_xfs = list(styles.cell_xfs)
+        self._sides = {}
+
+    def sides(self, xf_id):
+        """(left, right, top, bottom) border styles of a cell format, None for no line"""
+        xf_id = int(xf_id or 0)
+        if xf_id not in self._sides:
+            border = self.borders[int(self.cell_xfs[xf_id].get('borderId', 0))]
+            sides = []
+            for side in _SIDES:
+                el = border.find(q(side))
+                sides.append(el.get('style') if el is not None else None)
+            self._sides[xf_id] = tuple(sides)
+        return self._sides[xf_id]
+
+
+def _layout_problems(package, borders, sheet_index, sheet):
+    """(check, expected, found) for every layout rule of the fixes a sheet breaks"""
+    problems = []
+    merged = []
+    merge_cells = sheet.element('mergeCells')
+    for merge in merge_cells if merge_cells is not None else []:
+        (left, top), (right, bottom) = (split_ref(ref) for ref in merge.get('ref').split(':'))
+        merged.append((column_index(left), top, column_index(right), bottom))
+
+    def cell_sides(ref):
+        """Printed border sides of a cell as {side: style}; sides inside a merged range do not print"""
+        cell = sheet.cell(ref)
+        styles = borders.sides(cell.get('s') if cell is not None else 0)
+        col_letter, row_idx = split_ref(ref)
+        col_idx = column_index(col_letter)
+        inner = [False] * 4
+        for first_col, first_row, last_col, last_row in merged:
+            if first_col <= col_idx <= last_col and first_row <= row_idx <= last_row:
+                inner = [col_idx > first_col, col_idx < last_col, row_idx > first_row, row_idx < last_row]
+        return {side: style for side, style, hidden in zip(_SIDES, styles, inner) if not hidden}
+
+    def describe(sides):
+        return ' '.join(f"{side}={style or 'none'}" for side, style in sides.items())
+
+    for row_idx in BORDERED_ROWS:
+        for col in BORDERED_COLUMNS:
+            sides = cell_sides(f"{col}{row_idx}")
+            if any(style != 'thin' for style in sides.values()):
+                problems.append((f"border {col}{row_idx}", 'thin', describe(sides)))
+
+    row = sheet.rows.get(TALL_ROW)
+    height = float(row.get('ht')) if row is not None and row.get('ht') else None
+    if height != TALL_ROW_HEIGHT:
+        problems.append((f"height of row {TALL_ROW}", f"{TALL_ROW_HEIGHT:g}", f"{height:g}" if height else ''))
+
+    max_row = sheet.max_row()
+    last_row = 0
+    cert_start = None
+    for r in range(1, max_row + 1):
+        value = sheet.value(f"A{r}")
+        if value is not None:
+            last_row = r
+            if cert_start is None and value.strip().startswith(CERTIFICATE_HEADING):
+                cert_start = r
+    bordered = [f"{col}{r}" for r in range(cert_start, min(cert_start + CERTIFICATE_ROWS, max_row + 1))
+                for col in CERTIFICATE_COLUMNS] if cert_start else []
+    for ref in bordered + [UNBORDERED_CELL]:
+        sides = cell_sides(ref)
+        if any(sides.values()):
+            problems.append((f"border {ref}", 'none', describe(sides)))
+
+    setup = sheet.element('pageSetup')
+    setup = setup.attrib if setup is not None else {}
+    expected_setup = {'paperSize': str(PAPER_SIZE), 'orientation': ORIENTATION, 'fitToWidth': '1', 'fitToHeight': '1'}
+    for name, expected in expected_setup.items():
+        # An absent fitTo* means 1 page
+        found = setup.get(name, '1' if name.startswith('fitTo') else '')
+        if found != expected:
+            problems.append((f"page setup {name}", expected, found))
+
+    margins = sheet.element('pageMargins')
+    margins = margins.attrib if margins is not None else {}
+    for side, expected in PAGE_MARGINS.items():
+        found = margins.get(side)
+        if found is None or abs(float(found) - expected) > 1e-6:
+            problems.append((f"margin {side}", f"{expected:g}", found or ''))
+
+    options = sheet.element('printOptions')
+    if options is None or options.get('horizontalCentered') not in ('1', 'true'):
+        problems.append(('horizontally centered', '1', options.get('horizontalCentered', '') if options is not None else ''))
+
+    if last_row:
+        expected_area = f"A1:E{last_row + PRINT_AREA_PADDING}"
+        found_area = ''
+        names = package.workbook.find(q('definedNames'))
+        for name in names if names is not None else []:
+            if name.get('name') == '_xlnm.Print_Area' and name.get('localSheetId') == str(sheet_index):
+                found_area = (name.text or '').rsplit('!', 1)[-1].replace('$', '')
+        if found_area != expected_area:
+            problems.append(('print area', expected_area, found_area))
+    return problems
+
+
+def read_workbook(path, cells=None):
+    """What the audit needs of one workbook: per sheet its field values and layout problems
+
+    Runs in a worker process; returns plain tuples
+    (file, sheet, {field: value}, [(check, expected, found)]), or a single
+    sheetless entry whose problem says why the file could not be read.
+    """
+    cells = cells or field_cells()
+    name = os.path.basename(path)
+    try:
+        package = WorkbookPackage(path)
+        borders = _Borders(package.styles)
+        sheets = []
+        for sheet_index, (sheet_name, part_name) in enumerate(package.sheets):
+            sheet = package.sheet(part_name)
+            values = {ref: sheet.value(ref) for ref, _, _ in cells}
+            sheets.append((name, sheet_name, values,
+                           _layout_problems(package, borders, sheet_index, sheet)))
+        return sheets
+    except Exception as e:
+        return [(name, '', {}, [('unreadable workbook', '', str(e))])]
+
+
+def read_workbooks(paths, workers=1):
+    """read_workbook for every path, in a process pool when workers > 1; results in path order"""
+    if workers <= 1 or len(paths) <= 1:
+        return [read_workbook(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_workbook, paths, chunksize=max(1, len(paths) // (workers * 4))))
+
+
+def master_index(records):
+    """Agreement-number index of the master's records: {normalized agreement: [records]}"""
+    index = {}
+    for record in records:
+        index.setdefault(normalize_agreement(record.agreement_no), []).append(record)
+    return index
+
+
+def audit(sheets, records, cells=None):
+    """Report rows (REPORT_COLUMNS) for every difference between the sheets and the master
+
+    A sheet is matched to the master work with its agreement number; when
+    several works share one, to the one with the sheet's own name. Master
+    works that no sheet matched are reported as missing.
+    """
+    cells = cells or field_cells()
+    agreement_ref = next(ref for ref, _, field in cells if field == 'agreement_no')
+    index = master_index(records)
+    matched = set()
+    report = []
+    for file, sheet_name, values, problems in sheets:
+        agreement_no = _text(values.get(agreement_ref))
+        report.extend([file, sheet_name, agreement_no, *problem] for problem in problems)
+        if not sheet_name:
+            continue
+
+        candidates = index.get(normalize_agreement(agreement_no), [])
+        record = next((r for r in candidates if r.sheet_name == sheet_name), None)
+        record = record or next((r for r in candidates if id(r) not in matched), None)
+        if record is None:
+            report.append([file, sheet_name, agreement_no, 'not in master', '', agreement_no])
+            continue
+        matched.add(id(record))
+        if record.sheet_name != sheet_name:
+            report.append([file, sheet_name, agreement_no, 'sheet name', record.sheet_name, sheet_name])
+        fields = record._asdict()
+        for ref, template, field in cells:
+            expected = _text(template.format(**fields))
+            found = _text(values.get(ref))
+            if found != expected:
+                report.append([file, sheet_name, agreement_no, f"{field} ({ref})", expected, found])
+
+    for record in records:
+        if id(record) not in matched:
+            report.append(['', record.sheet_name, record.agreement_no, 'missing form', record.sheet_name, ''])
+    return report
+
+
+def _check_kind(check):
+    """'border B22' -> 'border', 'contractor (E2)' -> 'contractor', for the summary"""
+    check = check.split(' (')[0]
+    if check.startswith(('border ', 'margin ', 'page setup ')):
+        check = check.rsplit(' ', 1)[0]
+    return check
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check generated refund workbooks against the master")
+    parser.add_argument('target_dir', help="directory holding the batch workbooks")
+    parser.add_argument('--master', default='work_order_master.xlsx',
+                        help="work order master the forms were generated from (.xlsx, .csv or .parquet)")
+    parser.add_argument('--master-sheet', default='Work Orders',
+                        help="sheet of an xlsx master to read (default: %(default)s)")
+    parser.add_argument('--master-backend', choices=BACKENDS, default='auto',
+                        help="reader for the master (default: by extension, calamine for xlsx if installed)")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="worker processes (0 = one per CPU)")
+    parser.add_argument('--report', default='security_refund_audit.csv',
+                        help="CSV the differences are written to (default: %(default)s)")
+    parser.add_argument('--log-level', default='INFO', choices=LOG_LEVELS, type=str.upper)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(args.log_level)
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    started = time.perf_counter()
+
+    df = read_excel_data(args.master, args.master_sheet, backend=args.master_backend)
+    if df is None:
+        logger.error(f"Could not read the master {args.master}")
+        return 2
+    name_sheets(df)
+    records = work_records(df)
+
+    # The run's index and register workbooks sit beside the batches but are not forms
+    paths = [os.path.join(args.target_dir, name) for name in sorted(os.listdir(args.target_dir))
+             if name.endswith('.xlsx')
+             and not name.startswith(('~$', 'Security_Refund_Index_', 'Security_Refund_Register_'))]
+    sheets = [sheet for found in read_workbooks(paths, workers) for sheet in found]
+    report = audit(sheets, records)
+
+    with open(args.report, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_COLUMNS)
+        writer.writerows(report)
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Audited {len(sheets)} sheets in {len(paths)} workbooks against {len(records)} master works "
+                f"in {elapsed:.2f}s")
+    if not report:
+        logger.info("Everything matches the master and the print layout.")
+        return 0
+    counts = {}
+    for row in report:
+        kind = _check_kind(row[3])
+        counts[kind] = counts.get(kind, 0) + 1
+    logger.warning(f"{len(report)} difference(s):")
+    for check, count in sorted(counts.items(), key=lambda item: -item[1]):
+        logger.warning(f"  {count:>6} x {check}")
+    for file, sheet, agreement_no, check, expected, found in report[:10]:
+        logger.warning(f"  {file} '{sheet}' ({agreement_no}): {check}: expected {expected!r}, found {found!r}")
+    logger.info(f"Audit report written to {args.report}")
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Scaling benchmark for the streaming text-export parser
+
+Writes synthetic exports of increasing size, parses each with
+iter_work_orders_txt and reports the time per entry. The parser is linear
+if that time stays flat; the run fails if the largest file costs more per
+entry than --tolerance times the smallest.
+
+    python benchmarks/bench_txt_parser.py --sizes 25000 50000 100000 200000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import write_synthetic_export
+from txt_reader import iter_work_orders_txt
+
+
+def time_parse(path):
+    started = time.perf_counter()
+    count = sum(1 for _ in iter_work_orders_txt(path))
+    return count, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[25000, 50000, 100000, 200000],
+                        help='Number of entries per synthetic file')
+    parser.add_argument('--name-words', type=int, default=8,
+                        help='Words per work name; raise it to test long entries')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Allowed growth of the per-entry time from smallest to largest size')
+    args = parser.parse_args(argv)
+
+    per_entry = []
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'entries':>10} {'MB':>8} {'seconds':>9} {'us/entry':>9}")
+        for size in sorted(args.sizes):
+            path = os.path.join(tmp, f"export_{size}.txt")
+            write_synthetic_export(path, size, args.name_words)
+            count, seconds = time_parse(path)
+            if count != size:
+                print(f"Parsed {count} entries from a file of {size}")
+                return 1
+            per_entry.append(seconds / size)
+            mb = os.path.getsize(path) / 1e6
+            print(f"{size:>10} {mb:>8.1f} {seconds:>9.2f} {per_entry[-1] * 1e6:>9.2f}")
+            os.remove(path)
+
+    growth = per_entry[-1] / per_entry[0]
+    print(f"Per-entry time grew {growth:.2f}x from the smallest to the largest file")
+    if growth > args.tolerance:
+        print(f"Not linear: growth is above the tolerance of {args.tolerance}x")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,378 @@
+"""Stage benchmarks for security refund generation, with a regression gate
+
+Builds synthetic masters of each size and times every stage of a run on
+its own: reading the master (as XLSX and as CSV), naming, rendering and print-setting sheets,
+saving, reading the text export and patching saved workbooks. Each stage
+is timed as the fastest of --repeats rounds over all the stages, so a slow
+moment on a busy machine is not taken for a regression, and run once under
+tracemalloc for its peak memory. Results are written as JSON; --compare
+checks them against a saved baseline and exits with status 1 if a stage
+got slower (per item) or hungrier than --threshold allows. The startup
+time of each command of security_refund.py (its imports and argument
+parsing, timed through '<command> --help' in a fresh interpreter, and
+'generate --lookup') is measured and checked alike.
+
+    python benchmarks/run_benchmarks.py --sizes 100 1000 10000 --output baseline.json
+    python benchmarks/run_benchmarks.py --sizes 100 1000 10000 --compare baseline.json
+
+Stages that build workbooks cost the same per work at any master size, so
+they run on at most --render-works works of each master.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import openpyxl
+
+import form_template
+import security_refund as cli
+import security_refund_generator as generator
+import update_existing_workbooks as updater
+from instrumentation import configure_logging
+from synthetic import MASTER_SHEET, write_synthetic_export, write_synthetic_master
+from validation import validate_master
+from work_records import work_records
+
+BASELINE_VERSION = 2
+BATCH_SIZE = 25
+
+
+class BenchContext:
+    """State handed from one stage to the next within a master size"""
+
+    def __init__(self, work_dir, size, render_works):
+        self.work_dir = work_dir
+        self.size = size
+        self.render_works = render_works
+        self.master_path = os.path.join(work_dir, f"master_{size}.xlsx")
+        self.csv_path = os.path.join(work_dir, f"master_{size}.csv")
+        self.txt_path = os.path.join(work_dir, f"export_{size}.txt")
+        self.out_dir = os.path.join(work_dir, f"out_{size}")
+        self.df = None
+        self.workbooks = []
+        self.saved = []
+
+    def batches(self):
+        subset = self.df.iloc[:self.render_works]
+        return [batch for batch, _ in generator.split_data_into_batches(subset, BATCH_SIZE)]
+
+
+def stage_read_excel_data(ctx):
+    ctx.df = generator.read_excel_data(ctx.master_path, MASTER_SHEET, use_cache=False)
+    return len(ctx.df)
+
+
+def warm_master_cache(ctx):
+    generator.read_excel_data(ctx.master_path, MASTER_SHEET, use_cache=True)
+
+
+def stage_read_excel_data_cached(ctx):
+    return len(generator.read_excel_data(ctx.master_path, MASTER_SHEET, use_cache=True))
+
+
+def write_csv_master(ctx):
+    ctx.df.to_csv(ctx.csv_path, index=False)
+
+
+def stage_read_csv_master(ctx):
+    return len(generator.read_excel_data(ctx.csv_path, MASTER_SHEET, use_cache=False))
+
+
+def stage_validate_master(ctx):
+    validate_master(ctx.df)
+    return len(ctx.df)
+
+
+def stage_create_sheet_name(ctx):
+    for vendor, agreement_no in zip(ctx.df['Name of Contractor'], ctx.df['Agreement No.']):
+        generator.create_sheet_name(vendor, agreement_no)
+    return len(ctx.df)
+
+
+def stage_assign_sheet_names(ctx):
+    generator.name_sheets(ctx.df)
+    return len(ctx.df)
+
+
+def stage_create_single_work_sheet(ctx):
+    ctx.workbooks = []
+    works = 0
+    for batch in ctx.batches():
+        wb = openpyxl.Workbook()
+        wb.remove(wb.active)
+        for work_idx, record in enumerate(work_records(batch), 1):
+            form_template.create_single_work_sheet(wb, record, work_idx)
+            works += 1
+        ctx.workbooks.append(wb)
+    return works
+
+
+def stage_setup_default_print_layout(ctx):
+    sheets = 0
+    for wb in ctx.workbooks:
+        for ws in wb.worksheets:
+            generator.setup_default_print_layout(ws)
+            sheets += 1
+    return sheets
+
+
+def stage_wb_save(ctx):
+    os.makedirs(ctx.out_dir, exist_ok=True)
+    ctx.saved = []
+    for batch_number, wb in enumerate(ctx.workbooks, 1):
+        path = os.path.join(ctx.out_dir, f"batch_{batch_number:04d}.xlsx")
+        wb.save(path)
+        ctx.saved.append(path)
+    return sum(len(wb.worksheets) for wb in ctx.workbooks)
+
+
+def stage_read_work_data_from_txt(ctx):
+    return len(generator.read_work_data_from_txt(ctx.txt_path))
+
+
+def stage_fix_workbook(ctx):
+    for path in ctx.saved:
+        updater.fix_workbook(path)
+    return sum(len(wb.worksheets) for wb in ctx.workbooks)
+
+
+def stage_patch_workbook(ctx):
+    for path in ctx.saved:
+        updater.patch_workbook(path)
+    return sum(len(wb.worksheets) for wb in ctx.workbooks)
+
+
+# (name, function) in run order; later stages use what earlier ones leave in the context
+STAGES = [
+    ('read_excel_data', stage_read_excel_data),
+    ('read_excel_data (cached)', stage_read_excel_data_cached),
+    ('read_master (csv)', stage_read_csv_master),
+    ('validate_master', stage_validate_master),
+    ('create_sheet_name', stage_create_sheet_name),
+    ('assign_sheet_names', stage_assign_sheet_names),
+    ('create_single_work_sheet', stage_create_single_work_sheet),
+    ('setup_default_print_layout', stage_setup_default_print_layout),
+    ('wb.save', stage_wb_save),
+    ('read_work_data_from_txt', stage_read_work_data_from_txt),
+    ('fix_workbook', stage_fix_workbook),
+    ('patch_workbook', stage_patch_workbook),
+]
+
+# Untimed setup run just before a stage
+PREPARE = {
+    'read_excel_data (cached)': warm_master_cache,
+    'read_master (csv)': write_csv_master,
+}
+
+
+def run_stages(ctx, stages, trace_memory):
+    """Run the stages once, returning {name: (items, seconds, peak bytes or None)}"""
+    results = {}
+    for name, stage in stages:
+        if name in PREPARE:
+            PREPARE[name](ctx)
+        gc.collect()
+        if trace_memory:
+            tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        items = stage(ctx)
+        seconds = time.perf_counter() - started
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+            tracemalloc.stop()
+        results[name] = (items, seconds, peak)
+    return results
+
+
+def benchmark_size(work_dir, size, render_works, stages, trace_memory=True, repeats=3):
+    ctx = BenchContext(work_dir, size, render_works)
+    write_synthetic_master(ctx.master_path, size)
+    write_synthetic_export(ctx.txt_path, size)
+
+    # Whole rounds rather than back-to-back repeats of a stage, so a few slow
+    # seconds on a busy machine cost one round's samples, not all of a stage's
+    rounds = [run_stages(ctx, stages, trace_memory=False) for _ in range(repeats)]
+    timed = {name: min((found[name] for found in rounds), key=lambda result: result[1])
+             for name in rounds[0]}
+    traced = run_stages(ctx, stages, trace_memory=True) if trace_memory else {}
+
+    report = {}
+    for name, (items, seconds, _) in timed.items():
+        peak = traced[name][2] if name in traced else None
+        report[name] = {
+            'items': items,
+            'seconds': round(seconds, 6),
+            'items_per_second': round(items / seconds, 2) if seconds else None,
+            'peak_mb': round(peak / 2**20, 3) if peak is not None else None,
+        }
+    return report
+
+
+def startup_commands(work_dir):
+    """{label: (arguments, exit status)} of the command lines whose startup is timed
+
+    '<command> --help' for every command, and the generator's --lookup,
+    which answers from a run's index without reading the master (here it
+    finds no index in work_dir and stops at once, with status 1).
+    """
+    commands = {command: ([command, '--help'], 0) for command in cli.COMMANDS}
+    commands['generate --lookup'] = (['generate', '--lookup', '1/2020-21', '--output-dir', work_dir], 1)
+    return commands
+
+
+def measure_startup(work_dir, repeats=5):
+    """Fastest of repeats wall times of each startup command line, {label: seconds}
+
+    A fresh interpreter each time, so this is what a scheduled job pays
+    before it does any work.
+    """
+    startup = {}
+    for label, (arguments, status) in startup_commands(work_dir).items():
+        times = []
+        for _ in range(repeats):
+            command = [sys.executable, os.path.join(REPO_DIR, 'security_refund.py'), *arguments]
+            started = time.perf_counter()
+            completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - started)
+            if completed.returncode != status:
+                raise subprocess.CalledProcessError(completed.returncode, command)
+        startup[label] = round(min(times), 6)
+    return startup
+
+
+def compare(results, baseline, threshold, min_seconds):
+    """List the stages that regressed against the baseline"""
+    regressions = []
+    for command, seconds in results.get('startup', {}).items():
+        before = baseline.get('startup', {}).get(command)
+        if before and before >= min_seconds and seconds > before * (1 + threshold):
+            regressions.append(f"startup of {command}: {before * 1000:.0f} ms -> {seconds * 1000:.0f} ms")
+    for size, stages in results['results'].items():
+        for name, current in stages.items():
+            before = baseline['results'].get(size, {}).get(name)
+            if not before or not before['items'] or not current['items']:
+                continue
+            if before['seconds'] >= min_seconds:
+                old_rate = before['seconds'] / before['items']
+                new_rate = current['seconds'] / current['items']
+                if new_rate > old_rate * (1 + threshold):
+                    regressions.append(f"{size} works, {name}: {new_rate / old_rate - 1:+.0%} time per item")
+            if before.get('peak_mb') and current.get('peak_mb'):
+                # Ignore noise in stages that hardly allocate anything
+                if current['peak_mb'] > before['peak_mb'] * (1 + threshold) and current['peak_mb'] > 1:
+                    regressions.append(f"{size} works, {name}: peak memory "
+                                       f"{before['peak_mb']:.1f} MB -> {current['peak_mb']:.1f} MB")
+    return regressions
+
+
+def print_report(results):
+    print(f"{'works':>7}  {'stage':<28} {'items':>7} {'seconds':>9} {'items/s':>10} {'peak MB':>8}")
+    for size, stages in results['results'].items():
+        for name, r in stages.items():
+            peak = f"{r['peak_mb']:.1f}" if r['peak_mb'] is not None else '-'
+            rate = f"{r['items_per_second']:.0f}" if r['items_per_second'] else '-'
+            print(f"{size:>7}  {name:<28} {r['items']:>7} {r['seconds']:>9.3f} {rate:>10} {peak:>8}")
+    for command, seconds in results.get('startup', {}).items():
+        print(f"{'startup':>7}  {command:<28} {'':>7} {seconds:>9.3f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Works per synthetic master (e.g. 100 1000 10000 100000)')
+    parser.add_argument('--render-works', type=int, default=1000,
+                        help='Most works per master the workbook stages are run on')
+    parser.add_argument('--stages', nargs='+', choices=[name for name, _ in STAGES],
+                        help='Only run these stages (stages they depend on still run)')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Rounds over the stages; the fastest time of each is reported (default: %(default)s)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the tracemalloc pass (halves the run time)')
+    parser.add_argument('--no-startup', action='store_true',
+                        help="Skip timing the startup of security_refund.py's commands")
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='Fail if a stage regressed against this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown or memory growth before --compare fails (0.25 = 25%%)')
+    parser.add_argument('--min-seconds', type=float, default=0.2,
+                        help='Baseline stages faster than this are too noisy to time-check')
+    parser.add_argument('--work-dir', help='Keep the synthetic files here instead of a temp directory')
+    return parser.parse_args(argv)
+
+
+def selected_stages(names):
+    if not names:
+        return STAGES
+    # Stages pass state forward, so everything up to the last one asked for is run
+    last = max(idx for idx, (name, _) in enumerate(STAGES) if name in names)
+    return STAGES[:last + 1]
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stages = selected_stages(args.stages)
+    # The stages log their progress; only errors are shown while they are timed
+    configure_logging('ERROR')
+
+    results = {
+        'version': BASELINE_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'render_works': args.render_works,
+        'repeats': args.repeats,
+        'results': {},
+    }
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(work_dir, exist_ok=True)
+        for size in args.sizes:
+            print(f"Benchmarking {size} works...")
+            report = benchmark_size(work_dir, size, args.render_works, stages, not args.no_memory,
+                                    args.repeats)
+            if args.stages:
+                report = {name: r for name, r in report.items() if name in args.stages}
+            results['results'][str(size)] = report
+        if not args.no_startup:
+            print("Timing command startup...")
+            results['startup'] = measure_startup(work_dir)
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('version') != BASELINE_VERSION:
+            print(f"Baseline {args.compare} is from another benchmark version")
+            return 2
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.compare}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"No regressions against {args.compare}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
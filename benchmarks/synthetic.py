@@ -0,0 +1,70 @@
+"""Synthetic inputs for the benchmarks: masters and text exports of any size
+
+The master has the columns and value formats of work_order_master.xlsx
+(text dates, about one work in ten without an actual completion date, a few
+repeated agreement numbers), so every stage sees realistic data.
+"""
+import random
+
+import openpyxl
+
+MASTER_HEADER = ['s.no.', 'Name of Contractor', 'Name of Work', 'Agreement No.', 'Date of Commencement',
+                 'Stipulated date of Completion', 'Actual Date of Completion']
+MASTER_SHEET = 'Work Orders'
+
+WORDS = ['work', 'in', 'building', 'of', 'repair', 'hostel', 'civil', 'and',
+         'school', 'campus', 'wiring', 'internal', 'external', 'residence']
+PLACES = ['Udaipur', 'Rajsamand', 'Nathdwara', 'Salumber', 'Gogunda', 'Jhadol', 'Mavli']
+VENDORS = ['Mitul Enterprises', 'Shree Ram Electricals', 'Gupta & Sons Company',
+           'Kumar Traders', 'Jain Engineering', 'Rajesh Service Centre',
+           'Abhinav Engineering and Suppliers', 'Arun Electricals']
+
+
+def _date(rng, year):
+    return f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{year}"
+
+
+def synthetic_master_rows(works, seed=0):
+    """Yield master rows (as lists in MASTER_HEADER order)"""
+    rng = random.Random(seed)
+    for n in range(1, works + 1):
+        year = rng.randint(2014, 2024)
+        # Roughly 2% of agreement numbers repeat an earlier one, as in the real master
+        agreement_n = rng.randint(1, max(1, n // 2)) if rng.random() < 0.02 else n
+        name = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 12)))
+        yield [
+            n,
+            rng.choice(VENDORS),
+            f"E/F {name} {rng.choice(PLACES)}",
+            f"{agreement_n}/{year}-{(year + 1) % 100:02d}",
+            _date(rng, year),
+            _date(rng, year + 1),
+            _date(rng, year + 1) if rng.random() > 0.1 else None,
+        ]
+
+
+def write_synthetic_master(path, works, seed=0):
+    """Write an xlsx master with a 'Work Orders' sheet of the given number of works"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(MASTER_SHEET)
+    ws.append(MASTER_HEADER)
+    for row in synthetic_master_rows(works, seed):
+        ws.append(row)
+    wb.save(path)
+
+
+def synthetic_entry(n, rng, name_words):
+    """One entry of the one-line text export"""
+    name = ' '.join(rng.choice(WORDS) for _ in range(name_words))
+    return (f"{n}E/F {name} at Udaipur{rng.choice(VENDORS[:6])} {rng.randint(10000, 999999)} "
+            f"{rng.randint(1, 300)}/2022-23 ({rng.randint(10, 28)}/07/2022) "
+            f"({rng.randint(10, 28)}/01/2023) {rng.randint(100, 99999)}.{rng.randint(10, 99)} "
+            f"{rng.randint(100, 9999)}.50 {rng.randint(10, 28)}/02/2023")
+
+
+def write_synthetic_export(path, entries, name_words=8, seed=0):
+    """Write a one-line text export of the given number of entries"""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for n in range(1, entries + 1):
+            f.write(synthetic_entry(n, rng, name_words))
@@ -0,0 +1,191 @@
+"""Security-deposit ledger: bulk fill of the deposit details on existing forms.
+
+Generated forms leave the amount of deposit (item 2), the MB No. (item 9),
+the date of payment of the final bill (item 10) and the item-18 deposit
+table blank. A ledger has one row per deposit: agreement number, bill type,
+MB No., SD type and amount, optionally with the final bill's payment date.
+The ledger may be CSV, Parquet or XLSX.
+
+``ledger_fills`` joins the whole ledger to the forms in a directory of batch
+workbooks with a single merge on the agreement number and totals the
+deposits of each work. It returns only the cells to write into each sheet;
+``update_existing_workbooks.py --ledger`` then writes them in place.
+"""
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from form_template import RWMF_119
+from master_reader import parse_master
+from run_index import load_lookup
+from work_records import normalize_date
+from xlsx_patch import WorkbookPackage
+
+# Ledger columns, read like the master's: text as text, the rest as found
+LEDGER_COLUMNS = {
+    'Agreement No.': str,
+    'Bill Type': str,
+    'MB No.': str,
+    'SD Type': str,
+    'Amount': object,
+    'Date of Payment of final bill': object,
+}
+REQUIRED_LEDGER_COLUMNS = ['Agreement No.', 'Amount']
+
+
+def _form_row(label):
+    """Row of the RWMF 119 form whose column A text starts with label"""
+    for row_idx, row in enumerate(RWMF_119['rows'], 1):
+        if any(col == 'A' and str(value).startswith(label) for col, value, _ in row['cells']):
+            return row_idx
+    raise ValueError(f"{RWMF_119['name']} has no row '{label}'")
+
+
+AMOUNT_ROW = _form_row("2. Amount of Deposit")
+AGREEMENT_ROW = _form_row("4. Agreement No.")
+MB_ROW = _form_row("9. MB No.")
+PAYMENT_ROW = _form_row("10. Date of Payment of final bill")
+TOTAL_ROW = _form_row("Total:")
+TABLE_ROWS = list(range(_form_row("Bill Type") + 1, TOTAL_ROW))
+VALUE_COLUMN = 'E'
+
+# Item-18 table: bill type in A (merged over A:B), MB No. in C, SD type in D, amount in E
+TABLE_COLUMNS = {'Bill Type': 'A', 'MB No.': 'C', 'SD Type': 'D', 'Amount': 'E'}
+
+
+def agreement_keys(series):
+    """incremental.normalize_agreement over a whole column"""
+    return series.astype(str).str.split().str.join(' ').str.lower()
+
+
+def read_ledger(path, sheet_name=None, backend='auto'):
+    """Deposit rows of a ledger with numeric amounts and dd/mm/yyyy payment dates
+
+    Returns (ledger, dropped): rows without an agreement number or a usable
+    amount are dropped and counted. Missing optional columns are left blank.
+    """
+    optional = [col for col in LEDGER_COLUMNS if col not in REQUIRED_LEDGER_COLUMNS]
+    df = parse_master(path, sheet_name, LEDGER_COLUMNS, backend, optional)
+    if df is None:
+        raise ValueError(f"could not read ledger sheet '{sheet_name}' from {path}")
+    missing = [col for col in REQUIRED_LEDGER_COLUMNS if col not in df.columns]
+    if missing:
+        raise ValueError(f"ledger {path} has no {', '.join(missing)} column")
+
+    df = df.reindex(columns=list(LEDGER_COLUMNS))
+    # '1,25,000', '₹ 5000' and 5000.0 all come out as 5000-style numbers
+    df['Amount'] = pd.to_numeric(df['Amount'].astype(str).str.replace(r'[^0-9.\-]', '', regex=True),
+                                 errors='coerce')
+    df['Date of Payment of final bill'] = df['Date of Payment of final bill'].map(normalize_date)
+    for col in ('Bill Type', 'MB No.', 'SD Type'):
+        df[col] = df[col].fillna('').astype(str).str.strip()
+
+    usable = df['Agreement No.'].notna() & (df['Agreement No.'].astype(str).str.strip() != '') \
+        & df['Amount'].notna()
+    return df[usable].reset_index(drop=True), int((~usable).sum())
+
+
+def scan_workbook(path):
+    """(file, sheet, agreement number) of every form in a batch workbook"""
+    package = WorkbookPackage(path)
+    ref = f"{VALUE_COLUMN}{AGREEMENT_ROW}"
+    return [(os.path.basename(path), sheet_name, package.sheet(part_name).value(ref) or '')
+            for sheet_name, part_name in package.sheets]
+
+
+def work_locations(paths, workers=1):
+    """DataFrame of (file, sheet, key) for every form in the workbooks
+
+    Forms listed in a run's lookup index next to the workbooks are taken
+    from it; only workbooks no index covers are opened and read.
+    """
+    rows = []
+    indexed = set()
+    for directory in sorted({os.path.dirname(path) for path in paths}):
+        for index_path in sorted(glob.glob(os.path.join(directory, 'Security_Refund_Index_*.json'))):
+            lookup = load_lookup(index_path)
+            for entry in lookup['entries'] if lookup else []:
+                rows.append((entry['file'], entry['sheet'], entry['agreement_no']))
+                indexed.add(entry['file'])
+
+    unindexed = [path for path in paths if os.path.basename(path) not in indexed]
+    if workers > 1 and len(unindexed) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            scanned = list(executor.map(scan_workbook, unindexed))
+    else:
+        scanned = [scan_workbook(path) for path in unindexed]
+    rows.extend(row for found in scanned for row in found)
+
+    works = pd.DataFrame(rows, columns=['file', 'sheet', 'agreement_no'])
+    works = works[works['file'].isin({os.path.basename(path) for path in paths})]
+    return works.assign(key=agreement_keys(works['agreement_no'])).drop(columns='agreement_no')
+
+
+def _table_slots(ledger):
+    """One row per filled table row of each agreement
+
+    Deposits beyond the table's rows are summed into its last row, so the
+    rows shown always add up to the total.
+    """
+    capacity = len(TABLE_ROWS)
+    line = ledger.groupby('key').cumcount()
+    count = ledger.groupby('key')['key'].transform('size')
+    slots = ledger.assign(slot=line.where(count <= capacity, line.clip(upper=capacity - 1)))
+    table = slots.groupby(['key', 'slot'], sort=False).agg(
+        **{'Bill Type': ('Bill Type', 'first'), 'MB No.': ('MB No.', 'first'),
+           'SD Type': ('SD Type', 'first'), 'Amount': ('Amount', 'sum'), 'bills': ('Amount', 'size')})
+    merged = table['bills'] > 1
+    table.loc[merged, 'Bill Type'] = 'Others (' + table.loc[merged, 'bills'].astype(str) + ' bills)'
+    table.loc[merged, ['MB No.', 'SD Type']] = ''
+    return table.drop(columns='bills').reset_index()
+
+
+def _cell_value(value):
+    """Plain int, float or str for a cell (5000.0 is written as 5000)"""
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else float(value)
+    return value
+
+
+def ledger_fills(ledger, works):
+    """Cells to write per workbook and sheet, from one merge of the ledger and the forms
+
+    Returns ({file: {sheet: {cell: value}}}, stats). Every table row of a
+    matched form is written, blank where there is no deposit, so filling
+    from a corrected ledger again leaves nothing stale behind.
+    """
+    ledger = ledger.assign(key=agreement_keys(ledger['Agreement No.']))
+    totals = ledger.groupby('key').agg(total=('Amount', 'sum'))
+    mb_nos = (ledger[ledger['MB No.'] != ''].drop_duplicates(['key', 'MB No.'])
+              .groupby('key')['MB No.'].agg(', '.join).rename('mb_nos'))
+    paid = (ledger[ledger['Date of Payment of final bill'] != '']
+            .groupby('key')['Date of Payment of final bill'].last().rename('paid'))
+    per_work = totals.join(mb_nos).join(paid).fillna({'mb_nos': '', 'paid': ''}).reset_index()
+
+    matched = works.merge(per_work, on='key', how='inner')
+    refs = {'total': [f"{VALUE_COLUMN}{AMOUNT_ROW}", f"{VALUE_COLUMN}{TOTAL_ROW}"],
+            'mb_nos': [f"{VALUE_COLUMN}{MB_ROW}"], 'paid': [f"{VALUE_COLUMN}{PAYMENT_ROW}"]}
+    # An MB No. or payment date the ledger does not have is left as the clerk wrote it
+    cells = [matched.loc[matched[field] != '', ['file', 'sheet']].assign(ref=ref, value=matched[field])
+             for field, field_refs in refs.items() for ref in field_refs]
+
+    # Every table row of every matched form, filled from its deposit or blank
+    grid = matched[['file', 'sheet', 'key']].merge(pd.DataFrame({'slot': range(len(TABLE_ROWS))}), how='cross')
+    grid = grid.merge(_table_slots(ledger), on=['key', 'slot'], how='left')
+    rows = grid['slot'].map(dict(enumerate(TABLE_ROWS))).astype(str)
+    for field, col in TABLE_COLUMNS.items():
+        cells.append(grid[['file', 'sheet']].assign(ref=col + rows, value=grid[field].astype(object).where(
+            grid[field].notna(), '')))
+
+    fills = {}
+    long = pd.concat(cells, ignore_index=True) if cells else pd.DataFrame(columns=['file', 'sheet', 'ref', 'value'])
+    for file, sheet, ref, value in long.itertuples(index=False):
+        fills.setdefault(file, {}).setdefault(sheet, {})[ref] = _cell_value(value)
+
+    stats = {'forms': len(works), 'filled': len(matched),
+             'unmatched_agreements': int((~per_work['key'].isin(works['key'])).sum()),
+             'overflowing': int((ledger.groupby('key').size() > len(TABLE_ROWS))
+                                .reindex(matched['key'], fill_value=False).sum())}
+    return fills, stats
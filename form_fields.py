@@ -0,0 +1,30 @@
+"""Per-work fields of the refund form and the master columns they are read from.
+
+Kept apart from form_template, which builds the layout with openpyxl, so
+modules that only need these names load quickly.
+"""
+
+DEFAULT_DIVISION = "PWD Electric Div.- Udaipur"
+
+# Per-work fields a layout may reference as ``{name}`` in its cell values
+WORK_FIELDS = (
+    'contractor',
+    'work_name',
+    'agreement_no',
+    'commencement',
+    'stipulated_completion',
+    'actual_completion',
+)
+
+# Master column each per-work field is read from
+FIELD_COLUMNS = {
+    'contractor': 'Name of Contractor',
+    'work_name': 'Name of Work',
+    'agreement_no': 'Agreement No.',
+    'commencement': 'Date of Commencement',
+    'stipulated_completion': 'Stipulated date of Completion',
+    'actual_completion': 'Actual Date of Completion',
+}
+
+# Defect liability period, in months after actual completion (item 11 of the form)
+DEFAULT_DLP_MONTHS = 6
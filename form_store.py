@@ -0,0 +1,79 @@
+"""SQLite store of the forms each run generated.
+
+Every run upserts one row per work: the field values its form was rendered
+from, the sheet name, the batch workbook it went into and a hash of the
+values. A single form can then be rendered again from the store alone,
+without reading the master or rebuilding its batch.
+"""
+import hashlib
+import os
+import sqlite3
+from datetime import datetime
+
+from form_fields import WORK_FIELDS
+from incremental import normalize_agreement
+from work_records import WorkRecord
+
+DEFAULT_STORE = 'security_refund_forms.sqlite'
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS forms (
+    work_key TEXT PRIMARY KEY,
+    agreement_key TEXT NOT NULL,
+    sheet_name TEXT NOT NULL,
+    {', '.join(f'{field} TEXT NOT NULL' for field in WORK_FIELDS)},
+    division TEXT NOT NULL,
+    output_dir TEXT NOT NULL,
+    batch_file TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS forms_agreement ON forms (agreement_key);
+"""
+
+_COLUMNS = ('work_key', 'agreement_key', 'sheet_name') + WORK_FIELDS + (
+    'division', 'output_dir', 'batch_file', 'content_hash', 'updated_at')
+
+_UPSERT = "INSERT INTO forms ({}) VALUES ({}) ON CONFLICT (work_key) DO UPDATE SET {}".format(
+    ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS)),
+    ', '.join(f"{column} = excluded.{column}" for column in _COLUMNS[1:]))
+
+
+def open_store(path=DEFAULT_STORE):
+    """Connect to the store, creating its table on first use"""
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def record_hash(record):
+    """Hash of everything that appears on a work's form"""
+    return hashlib.sha1('\x1f'.join(str(value) for value in record).encode('utf-8')).hexdigest()
+
+
+def upsert_forms(connection, keys, records, batch_files, division, output_dir):
+    """Insert or update one row per work in a single transaction
+
+    keys are the works' stable keys (incremental.work_keys), batch_files the
+    name of the workbook each record was rendered into.
+    """
+    updated_at = datetime.now().isoformat(timespec='seconds')
+    output_dir = os.path.abspath(output_dir)
+    rows = [(key, normalize_agreement(record.agreement_no), *record, division, output_dir,
+             batch_file, record_hash(record), updated_at)
+            for key, record, batch_file in zip(keys, records, batch_files)]
+    with connection:
+        connection.executemany(_UPSERT, rows)
+    return len(rows)
+
+
+def find_stored_forms(connection, agreement_no):
+    """Stored rows for an agreement number, in key order ('#2' repeats after the first)"""
+    return connection.execute("SELECT * FROM forms WHERE agreement_key = ? ORDER BY work_key",
+                              (normalize_agreement(agreement_no),)).fetchall()
+
+
+def stored_record(row):
+    """WorkRecord a stored row was rendered from"""
+    return WorkRecord._make(row[field] for field in WorkRecord._fields)
@@ -0,0 +1,390 @@
+"""Declarative RWMF 119 layout and a compiled render plan for it.
+
+The layout of the refund form lives in ``RWMF_119`` as plain data. It is
+compiled once into a ``RenderPlan`` holding the shared style objects, merge
+ranges, static cells and row heights, so rendering a work only has to stamp
+its variable cells (contractor, work name, agreement number and dates).
+"""
+import re
+from copy import copy
+from string import Formatter
+from weakref import WeakKeyDictionary
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+from form_fields import DEFAULT_DIVISION, FIELD_COLUMNS, WORK_FIELDS
+from instrumentation import MetricsRecorder, logger
+
+try:
+    from openpyxl.styles.cell_style import StyleArray
+except ImportError:
+    StyleArray = None
+
+# openpyxl series the fast paths here and in xlsx_stream are written against
+# (pinned in requirements.txt); they use its internals, so under any other
+# series the public API is used instead
+TESTED_OPENPYXL = (3, 1)
+
+
+def openpyxl_tested():
+    """True if the installed openpyxl is the series whose internals the fast paths use"""
+    version = re.match(r'(\d+)\.(\d+)', openpyxl.__version__)
+    return version is not None and tuple(map(int, version.groups())) == TESTED_OPENPYXL
+
+
+# Registering styles once per workbook and stamping their style arrays onto
+# cells goes through Workbook._fonts (etc.) and Cell._style
+STYLE_ARRAYS = openpyxl_tested() and StyleArray is not None
+if not STYLE_ARRAYS:
+    logger.warning(f"openpyxl {openpyxl.__version__} is not the tested {'.'.join(map(str, TESTED_OPENPYXL))} "
+                   "series; styling cells through its public API, which is slower")
+
+
+def _box(style):
+    side = Side(style=style)
+    return Border(left=side, right=side, top=side, bottom=side)
+
+
+def _fill(color):
+    return PatternFill(start_color=color, end_color=color, fill_type='solid')
+
+
+_title_font = Font(bold=True, size=16, color='000080')  # Navy blue
+_header_font = Font(bold=True, size=12, color='000000')
+_normal_font = Font(size=11, color='000000')
+_small_font = Font(size=10, color='000000')
+_value_font = Font(size=11, bold=True, color='000000')
+
+_center = Alignment(horizontal='center', vertical='center')
+_left = Alignment(horizontal='left', vertical='center')
+_wrap_top = Alignment(horizontal='left', vertical='top', wrap_text=True)
+
+_thin = _box('thin')
+_header_fill = _fill('E6E6FA')
+
+
+def _row(*cells, merge=None, height=None):
+    """One form row: ``(column, value, style)`` cells, an optional merge span and height"""
+    return {'cells': list(cells), 'merge': merge, 'height': height}
+
+
+def _field(label, value=''):
+    """Numbered form item: label in A, value in a bordered box in E"""
+    return _row(('A', label, 'label'), ('E', value, 'value'))
+
+
+def _table(first, mb_no, sd_type, amount, style):
+    return _row(('A', first, style), ('B', '', 'boxed'), ('C', mb_no, style),
+                ('D', sd_type, style), ('E', amount, style), merge='A:B')
+
+
+RWMF_119 = {
+    'name': 'RWMF 119',
+    'styles': {
+        'title': {'font': _title_font, 'alignment': _center, 'border': _box('thick'), 'fill': _header_fill},
+        'label': {'font': _normal_font, 'alignment': _left},
+        'value': {'font': _value_font, 'alignment': _left, 'border': _thin},
+        'wrapped_value': {'font': _value_font, 'alignment': _wrap_top},
+        'section': {'font': _header_font, 'alignment': _left, 'border': _thin},
+        'table_header': {'font': _header_font, 'alignment': _center, 'border': _thin, 'fill': _header_fill},
+        'table_cell': {'font': _normal_font, 'alignment': _center, 'border': _thin},
+        'boxed': {'border': _thin},
+        'heading': {'font': _header_font, 'alignment': _left},
+        'note': {'font': _small_font, 'alignment': _left},
+        'wrapped_note': {'font': _small_font, 'alignment': _wrap_top},
+        'signature': {'font': _normal_font, 'alignment': _center},
+    },
+    'rows': [
+        _row(('A', "ORDER FOR REFUND OF SECURITY DEPOSIT [RWMF 119]", 'title'), merge='A:E'),
+        _field("1. Name of Contractor:", '{contractor}'),
+        _field("2. Amount of Deposit: ₹"),
+        _row(('A', "3. Name of Work: {work_name}", 'wrapped_value'), merge='A:E'),
+        _field("4. Agreement No.:", '{agreement_no}'),
+        _field("5. Reference for granting refunds:"),
+        _field("6. Date of Commencement:", '{commencement}'),
+        _field("7. Stipulated date of Completion:", '{stipulated_completion}'),
+        _field("8. Actual Date of Completion:", '{actual_completion}'),
+        _field("9. MB No.:"),
+        _field("10. Date of Payment of final bill:"),
+        _field("11. Date of Expiry of 3/6 months/DLP:"),
+        _field("12. Was work satisfactory:", "Yes"),
+        _field("13. Any tools outstanding against contractor:", "Nil"),
+        _field("14. Any recovery due from contractor after payment of final bill:", "Nil"),
+        _field("15. Extension of time limit sanctioned vide"),
+        _field("16. Assistant Engineer Signature's Recommending refund"),
+        _field("17. Accountant's Remarks"),
+        _row(('A', "18. Details of Security Deposit", 'section')),
+        _table("Bill Type", "MB No.", "SD Type", "Amount (₹)", 'table_header'),
+        _table('', '', '', '', 'table_cell'),
+        _table('', '', '', '', 'table_cell'),
+        _table('', '', '', '', 'table_cell'),
+        _table('', '', '', '', 'table_cell'),
+        _table('', '', '', '', 'table_cell'),
+        _table("Total:", '', '', "₹[Amount to be filled]", 'table_cell'),
+        _row(('A', "Certified That:-", 'heading')),
+        _row(('A', "1. The Work has been completed as per G-schedule.", 'note')),
+        _row(('A', "2. The work has been inspected by the undersigned as on and it stood satisfactory.", 'note')),
+        _row(('A', "3. No Defect found during DLP Period.", 'note')),
+        _row(('A', "4. The final time extension granted upto With/without compensation by the competent authority.", 'note')),
+        _row(('A', "5. The defects pointed out by higher authorities or other authorized authorities during inspection etc have been removed by the contractor and compliance has been refund.", 'wrapped_note'),
+             merge='A:E', height=40),
+        _row(),
+        _row(('A', "Divisional Accountant", 'signature'), ('C', "Assistant Engineer", 'signature'),
+             ('E', "Executive Engineer", 'signature')),
+        _row(('E', '{division}', 'signature')),
+    ],
+    'row_height': 20,
+    # Rows below the form that still get the default height, as Excel shows them on screen
+    'sized_rows': 40,
+    'column_widths': {'A': 30, 'B': 5, 'C': 25, 'D': 25, 'E': 25, 'F': 15, 'G': 15, 'H': 15},
+    'print': {
+        'paper_size': 9,  # A4
+        'orientation': 'portrait',
+        'margins': {'left': 0.5, 'right': 0.5, 'top': 0.5, 'bottom': 0.5, 'header': 0.2, 'footer': 0.2},
+        'fit_to_width': 1,
+        'fit_to_height': 1,
+        'horizontal_centered': True,
+        'header': "Security Deposit Refund Form",
+        'footer': "Page &P of &N",
+        # Extra rows below the last column A entry included in the print area
+        'area_padding': 2,
+    },
+}
+
+
+def apply_print_setup(ws, print_spec, last_row):
+    """Apply a layout's print settings to a worksheet whose content ends at last_row"""
+    ws.print_area = f"A1:E{last_row + print_spec['area_padding']}"
+
+    ws.page_setup.paperSize = print_spec['paper_size']
+    ws.page_setup.orientation = print_spec['orientation']
+
+    for side, value in print_spec['margins'].items():
+        setattr(ws.page_margins, side, value)
+
+    ws.page_setup.fitToWidth = print_spec['fit_to_width']
+    ws.page_setup.fitToHeight = print_spec['fit_to_height']
+    ws.print_options.horizontalCentered = print_spec['horizontal_centered']
+
+    ws.oddHeader.center.text = print_spec['header']
+    ws.oddFooter.center.text = print_spec['footer']
+
+
+def _field_names(value):
+    """Names of the ``{field}`` placeholders in a cell value"""
+    return [name for _, name, _, _ in Formatter().parse(value) if name]
+
+
+class RenderPlan:
+    """A compiled layout: everything about a form that does not change per work
+
+    A compact plan writes only the dimensions that differ from the sheet's
+    defaults: the layout's row height becomes the default row height, only
+    taller or shorter rows get an entry, and columns of equal width share one.
+    """
+
+    def __init__(self, spec, params, compact=False):
+        self.spec = spec
+        self.compact = compact
+        self.styles = spec['styles']
+        self.merges = []
+        self.static_cells = []
+        self.variable_cells = []
+        self.row_heights = {}
+        self.last_content_row = 0
+
+        for row_idx, row in enumerate(spec['rows'], 1):
+            if row['merge']:
+                first, last = row['merge'].split(':')
+                self.merges.append(f"{first}{row_idx}:{last}{row_idx}")
+
+            for col_letter, value, style in row['cells']:
+                col_idx = column_index_from_string(col_letter)
+                if col_letter == 'A' and value:
+                    self.last_content_row = row_idx
+
+                names = _field_names(value)
+                if names and all(name in params for name in names):
+                    value = value.format(**params)
+                    names = []
+
+                if names:
+                    # A bare placeholder keeps the field's own type (e.g. a date)
+                    bare = names[0] if value == f"{{{names[0]}}}" else None
+                    self.variable_cells.append((row_idx, col_idx, value, bare, style))
+                else:
+                    self.static_cells.append((row_idx, col_idx, value if value != '' else None, style))
+
+            if row['height']:
+                self.row_heights[row_idx] = row['height']
+
+        self.row_count = len(spec['rows'])
+        self._bound = WeakKeyDictionary()
+
+        # (first, last, width) runs of adjacent columns of the same width
+        self.column_runs = []
+        for col_letter, width in sorted(spec['column_widths'].items(),
+                                        key=lambda item: column_index_from_string(item[0])):
+            col_idx = column_index_from_string(col_letter)
+            if self.column_runs and self.column_runs[-1][1] == col_idx - 1 and self.column_runs[-1][2] == width:
+                self.column_runs[-1] = (self.column_runs[-1][0], col_idx, width)
+            else:
+                self.column_runs.append((col_idx, col_idx, width))
+
+        # Row-ordered view of the same cells for streaming writers: ``bare`` is
+        # None for static cells, '' for templated text, else the field name
+        self.row_cells = {}
+        for row_idx, col_idx, value, style in self.static_cells:
+            self.row_cells.setdefault(row_idx, []).append((col_idx, value, None, style))
+        for row_idx, col_idx, template, bare, style in self.variable_cells:
+            self.row_cells.setdefault(row_idx, []).append((col_idx, template, bare or '', style))
+        for cells in self.row_cells.values():
+            cells.sort()
+
+    def style_arrays(self, wb):
+        """Register the plan's styles with a workbook once and return their style arrays
+
+        None if this openpyxl is not the tested series; cells are then styled
+        attribute by attribute (see stamp).
+        """
+        if not STYLE_ARRAYS:
+            return None
+        arrays = self._bound.get(wb)
+        if arrays is None:
+            arrays = {}
+            for key, style in self.styles.items():
+                array = StyleArray()
+                if 'font' in style:
+                    array.fontId = wb._fonts.add(style['font'])
+                if 'alignment' in style:
+                    array.alignmentId = wb._alignments.add(style['alignment'])
+                if 'border' in style:
+                    array.borderId = wb._borders.add(style['border'])
+                if 'fill' in style:
+                    array.fillId = wb._fills.add(style['fill'])
+                arrays[key] = array
+            self._bound[wb] = arrays
+        return arrays
+
+    def stamp(self, cell, arrays, style):
+        """Give a cell one of the plan's styles, from its style array if there is one"""
+        if arrays is not None:
+            cell._style = copy(arrays[style])
+            return
+        for name, value in self.styles[style].items():
+            setattr(cell, name, value)
+
+    def render(self, wb, sheet_name, values):
+        """Add a sheet for one work, filling the variable cells from values"""
+        if wb.write_only:
+            return self.stream(wb, sheet_name, values)
+
+        ws = wb.create_sheet(title=sheet_name)
+        arrays = self.style_arrays(wb)
+
+        for merge in self.merges:
+            ws.merge_cells(merge)
+
+        for row_idx, col_idx, value, style in self.static_cells:
+            cell = ws.cell(row=row_idx, column=col_idx)
+            self.stamp(cell, arrays, style)
+            if value is not None:
+                cell.value = value
+
+        for row_idx, col_idx, template, bare, style in self.variable_cells:
+            cell = ws.cell(row=row_idx, column=col_idx)
+            self.stamp(cell, arrays, style)
+            cell.value = values.get(bare, '') if bare else template.format_map(values)
+
+        self.apply_dimensions(ws)
+        apply_print_setup(ws, self.spec['print'], self.last_content_row)
+        return ws
+
+    def stream(self, wb, sheet_name, values):
+        """Add a sheet to a write-only workbook, emitting it row by row
+
+        Dimensions, merges and print setup are set before the first row is
+        appended, as write-only sheets cannot be changed once rows are out.
+        """
+        ws = wb.create_sheet(title=sheet_name)
+        arrays = self.style_arrays(wb)
+
+        self.apply_dimensions(ws)
+        for merge in self.merges:
+            ws.merged_cells.add(merge)
+        apply_print_setup(ws, self.spec['print'], self.last_content_row)
+
+        last_row = self.row_count if self.compact else max(self.row_count, self.spec['sized_rows'])
+        for row_idx in range(1, last_row + 1):
+            row = []
+            for col_idx, value, bare, style in self.row_cells.get(row_idx, ()):
+                if bare:
+                    value = values.get(bare, '')
+                elif bare is not None:
+                    value = value.format_map(values)
+                cell = WriteOnlyCell(ws, value)
+                self.stamp(cell, arrays, style)
+                row.extend([None] * (col_idx - len(row) - 1))
+                row.append(cell)
+            ws.append(row)
+
+        # Finish the sheet now: its XML is on disk and the writer's buffers are released
+        ws.close()
+        return ws
+
+    def apply_dimensions(self, ws):
+        """Set column widths and row heights"""
+        if self.compact:
+            return self.apply_compact_dimensions(ws)
+
+        for col_letter, width in self.spec['column_widths'].items():
+            ws.column_dimensions[col_letter].width = width
+
+        default_height = self.spec['row_height']
+        for row_idx in range(1, self.spec['sized_rows'] + 1):
+            ws.row_dimensions[row_idx].height = self.row_heights.get(row_idx, default_height)
+
+    def apply_compact_dimensions(self, ws):
+        """Set the default row height and only the dimensions that differ from it"""
+        default_height = self.spec['row_height']
+        ws.sheet_format.defaultRowHeight = default_height
+        ws.sheet_format.customHeight = True
+        for row_idx, height in self.row_heights.items():
+            if height != default_height:
+                ws.row_dimensions[row_idx].height = height
+
+        for first, last, width in self.column_runs:
+            dim = ws.column_dimensions[get_column_letter(first)]
+            dim.width = width
+            dim.min, dim.max = first, last
+
+
+_plans = {}
+
+
+def get_plan(spec=RWMF_119, division=DEFAULT_DIVISION, compact=False):
+    """Return the compiled plan for a layout and division, compiling it on first use"""
+    key = (id(spec), division, compact)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _plans[key] = RenderPlan(spec, {'division': division}, compact)
+    return plan
+
+
+def create_single_work_sheet(wb, record, work_idx, division=DEFAULT_DIVISION, metrics=None, compact=False):
+    """Create a single work sheet from the compiled RWMF 119 layout
+
+    record is the work's WorkRecord, which already carries its sheet name.
+    With compact=True only dimensions that differ from the sheet defaults are
+    written. Rendering (which includes the print setup) is timed into metrics
+    if a MetricsRecorder is given.
+    """
+    metrics = metrics or MetricsRecorder(enabled=False)
+
+    # Only the per-work cells are filled here; styles, merges, static labels,
+    # heights and print setup come from the compiled plan
+    with metrics.time('render', work_idx):
+        return get_plan(division=division, compact=compact).render(wb, record.sheet_name, record._asdict())
@@ -0,0 +1,149 @@
+"""Incremental regeneration: stable batch assignment and a content-hash manifest.
+
+Works are keyed on their agreement number rather than their row position, and
+``manifest.json`` in the output directory remembers which batch each work was
+put in and a hash of everything that appears on its form. On a rerun only the
+batches whose works were added, removed or changed are rebuilt.
+"""
+import hashlib
+import json
+import os
+
+from form_fields import DEFAULT_DIVISION
+from sheet_naming import SHEET_NAME_COLUMN
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+def normalize_agreement(agreement_no):
+    """Canonical form of an agreement number used as a work key"""
+    return ' '.join(str(agreement_no).split()).lower()
+
+
+def work_keys(df, seen=None):
+    """Stable key per row: the normalized agreement number
+
+    Repeated agreement numbers get '#2', '#3', ... in the order they appear,
+    so each work still has a key of its own. Passing the same seen dict with
+    each chunk of a master carries the counts over from earlier chunks.
+    """
+    seen = {} if seen is None else seen
+    keys = []
+    for agreement_no in df['Agreement No.'] if 'Agreement No.' in df.columns else [''] * len(df):
+        key = normalize_agreement(agreement_no)
+        seen[key] = seen.get(key, 0) + 1
+        keys.append(key if seen[key] == 1 else f"{key}#{seen[key]}")
+    return keys
+
+
+def layout_fingerprint(spec=None, division=DEFAULT_DIVISION, compact=False):
+    """Hash of the form layout (RWMF 119 by default), so a layout change rebuilds everything"""
+    if spec is None:
+        from form_template import RWMF_119
+        spec = RWMF_119
+    key = f"{spec!r}|{division}" + ('|compact' if compact else '')
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def work_hashes(df):
+    """Content hash per row over the master columns that appear on the form
+
+    The sheet name is included when the master has been named, since a new
+    work can change the suffix of a repeated name in another batch.
+    """
+    # Imported here so the pandas-free paths can use normalize_agreement
+    from master_reader import MASTER_COLUMNS
+
+    hashed = [*MASTER_COLUMNS, SHEET_NAME_COLUMN] if SHEET_NAME_COLUMN in df.columns else list(MASTER_COLUMNS)
+    columns = [df[col].fillna('').astype(str) if col in df.columns else [''] * len(df)
+               for col in hashed]
+    return [hashlib.sha1('\x1f'.join(values).encode('utf-8')).hexdigest()
+            for values in zip(*columns)]
+
+
+def load_manifest(output_dir):
+    """Read the manifest of a previous run, or None if there is none usable"""
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(output_dir, manifest):
+    """Write the manifest atomically next to the batch files"""
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def batch_filename(batch_number, agreement_year):
+    return f"Security_Refund_Batch_{batch_number:02d}_{agreement_year}.xlsx"
+
+
+def plan_incremental_batches(df, output_dir, agreement_year, batch_size=25, division=DEFAULT_DIVISION,
+                             compact=False):
+    """Work out which batches need rebuilding against the previous manifest
+
+    Returns (batches, manifest, stale_files): the (batch DataFrame, batch number)
+    pairs to rebuild, the manifest to save once they are written, and batch
+    files that no longer hold any work.
+    """
+    keys = work_keys(df)
+    hashes = work_hashes(df)
+    position = {key: pos for pos, key in enumerate(keys)}
+    fingerprint = layout_fingerprint(division=division, compact=compact)
+
+    previous = load_manifest(output_dir)
+    if (previous is None or previous['agreement_year'] != agreement_year
+            or previous['batch_size'] != batch_size):
+        previous = {'batches': {}, 'works': {}, 'layout': None}
+
+    # Existing works stay in their batch, in their previous order
+    members = {}
+    for number, batch in previous['batches'].items():
+        kept = [key for key in batch['works'] if key in position]
+        if kept:
+            members[int(number)] = kept
+
+    # New works fill the lowest-numbered batch with room, then new batches
+    assigned = {key for kept in members.values() for key in kept}
+    batch_number = 1
+    for key in keys:
+        if key in assigned:
+            continue
+        while len(members.get(batch_number, ())) >= batch_size:
+            batch_number += 1
+        members.setdefault(batch_number, []).append(key)
+
+    layout_changed = previous['layout'] != fingerprint
+    batches = []
+    manifest = {'version': MANIFEST_VERSION, 'agreement_year': agreement_year,
+                'batch_size': batch_size, 'layout': fingerprint, 'batches': {}, 'works': {}}
+
+    for number in sorted(members):
+        batch_keys = members[number]
+        filename = batch_filename(number, agreement_year)
+        old = previous['batches'].get(str(number))
+        changed = (layout_changed or old is None or old['works'] != batch_keys
+                   or not os.path.exists(os.path.join(output_dir, filename))
+                   or any(previous['works'].get(key, {}).get('hash') != hashes[position[key]]
+                          for key in batch_keys))
+        if changed:
+            batch = df.iloc[[position[key] for key in batch_keys]]
+            batches.append((batch, number))
+
+        manifest['batches'][str(number)] = {'file': filename, 'works': batch_keys}
+        for key in batch_keys:
+            manifest['works'][key] = {'batch': number, 'hash': hashes[position[key]]}
+
+    stale_files = [batch['file'] for number, batch in previous['batches'].items()
+                   if int(number) not in members]
+    return batches, manifest, stale_files
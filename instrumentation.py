@@ -0,0 +1,92 @@
+"""Logging and per-stage timing for generation runs.
+
+Progress goes through the ``security_refund`` logger, so ``--log-level``
+decides how chatty a run is; per-sheet lines are DEBUG and stay off by
+default. ``MetricsRecorder`` collects one event per timed stage (read,
+naming, render, print layout, save), per work or per batch, including the
+bytes written, and can write them out as JSON or CSV at the end of a run.
+"""
+import csv
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('security_refund')
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+
+def configure_logging(level='INFO'):
+    """Send the logger's messages to the console as plain lines"""
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(getattr(logging, str(level).upper()))
+
+
+class MetricsRecorder:
+    """One event per timed stage: stage, batch, work, seconds, bytes
+
+    A disabled recorder times nothing and keeps nothing, so callers can use
+    it unconditionally in the per-work loop.
+    """
+
+    FIELDS = ['stage', 'batch', 'work', 'seconds', 'bytes']
+
+    def __init__(self, enabled=True, batch=None):
+        self.enabled = enabled
+        self.batch = batch
+        self.events = []
+
+    def record(self, stage, seconds, work=None, nbytes=None, batch=None):
+        if self.enabled:
+            self.events.append({'stage': stage, 'batch': self.batch if batch is None else batch,
+                                'work': work, 'seconds': seconds, 'bytes': nbytes})
+
+    @contextmanager
+    def time(self, stage, work=None):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, work)
+
+    def extend(self, events):
+        """Add events recorded elsewhere, e.g. returned by a worker process"""
+        if self.enabled:
+            self.events.extend(events)
+
+    def summary(self):
+        """{stage: count, total and max seconds, bytes} in first-seen stage order"""
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event['stage'], {'count': 0, 'seconds': 0.0,
+                                                       'max_seconds': 0.0, 'bytes': 0})
+            stage['count'] += 1
+            stage['seconds'] += event['seconds']
+            stage['max_seconds'] = max(stage['max_seconds'], event['seconds'])
+            stage['bytes'] += event['bytes'] or 0
+        return stages
+
+    def write(self, path):
+        """Write the events as CSV (for a .csv path) or as JSON with a summary"""
+        if path.lower().endswith('.csv'):
+            with open(path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                writer.writeheader()
+                writer.writerows(self.events)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({'summary': self.summary(), 'events': self.events}, f, indent=1)
+
+    def log_summary(self):
+        for stage, totals in self.summary().items():
+            logger.info(f"  {stage:<13} {totals['count']:>6} x  {totals['seconds']:8.2f}s total"
+                        f"  {totals['max_seconds'] * 1000:8.1f}ms max"
+                        + (f"  {totals['bytes'] / 1e6:.1f} MB" if totals['bytes'] else ''))
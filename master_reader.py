@@ -0,0 +1,372 @@
+"""Load the work-order master: only the form's columns, through an on-disk cache.
+
+Parsing the XLSX master is a noticeable share of every run, so the parsed
+columns are pickled under ``.security_refund_cache`` next to the master and
+reused while the file's mtime and size (or, failing that, its SHA-1) match.
+
+The master can also be a CSV or Parquet export, which loads much faster
+than XLSX. The backend is picked from the file extension; XLSX is read with
+calamine when python-calamine is installed and with openpyxl otherwise.
+Every backend returns the same columns with the same dtypes, matched to
+MASTER_COLUMNS ignoring case and surrounding spaces in the headers.
+
+``iter_master_chunks`` reads the same columns as a stream of small frames
+instead, so a run can start on the first batch without holding the master.
+pandas is imported only by the functions that build frames, so a command
+that merely parses its options does not load it.
+"""
+import hashlib
+import importlib.util
+import itertools
+import os
+import pickle
+
+from instrumentation import logger
+
+# Master columns the refund form needs, with the dtypes they are read as.
+# Dates stay object so both text dates and real Excel dates survive.
+MASTER_COLUMNS = {
+    'Name of Contractor': str,
+    'Name of Work': str,
+    'Agreement No.': str,
+    'Date of Commencement': object,
+    'Stipulated date of Completion': object,
+    'Actual Date of Completion': object,
+}
+
+BACKENDS = ('auto', 'calamine', 'openpyxl', 'csv', 'parquet')
+
+# Backend for each master file extension; xlsx is decided by xlsx_engine()
+EXTENSION_BACKENDS = {
+    '.xlsx': 'xlsx', '.xlsm': 'xlsx', '.csv': 'csv',
+    '.parquet': 'parquet', '.pq': 'parquet',
+}
+
+CACHE_DIR_NAME = '.security_refund_cache'
+CACHE_VERSION = 2
+
+
+def file_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cache_path(file_path, sheet_name):
+    directory, name = os.path.split(os.path.abspath(file_path))
+    safe_sheet = ''.join(c if c.isalnum() else '_' for c in str(sheet_name))
+    return os.path.join(directory, CACHE_DIR_NAME, f"{name}.{safe_sheet}.pkl")
+
+
+def load_cached(file_path, sheet_name, columns):
+    """Return the cached DataFrame if it is still valid for file_path, else None"""
+    path = cache_path(file_path, sheet_name)
+    try:
+        with open(path, 'rb') as f:
+            entry = pickle.load(f)
+        stat = os.stat(file_path)
+    except Exception:
+        return None
+
+    if entry.get('version') != CACHE_VERSION or entry.get('columns') != list(columns):
+        return None
+    if entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+        return entry['df']
+
+    # Touched but possibly unchanged (e.g. copied or re-saved): compare content
+    if entry['sha1'] == file_sha1(file_path):
+        entry['mtime_ns'], entry['size'] = stat.st_mtime_ns, stat.st_size
+        _write_entry(path, entry)
+        return entry['df']
+    return None
+
+
+def store_cached(file_path, sheet_name, columns, df):
+    stat = os.stat(file_path)
+    entry = {
+        'version': CACHE_VERSION,
+        'columns': list(columns),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha1': file_sha1(file_path),
+        'df': df,
+    }
+    try:
+        _write_entry(cache_path(file_path, sheet_name), entry)
+    except OSError as e:
+        # A read-only share is fine, the run just is not cached
+        logger.warning(f"Could not write master cache: {e}")
+
+
+def _write_entry(path, entry):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def xlsx_engine():
+    """Fastest installed engine for XLSX masters"""
+    return 'calamine' if importlib.util.find_spec('python_calamine') else 'openpyxl'
+
+
+def resolve_backend(file_path, backend='auto'):
+    """Backend that reads file_path: the one asked for, or the one its extension calls for"""
+    if backend != 'auto':
+        return backend
+    kind = EXTENSION_BACKENDS.get(os.path.splitext(file_path)[1].lower(), 'xlsx')
+    return xlsx_engine() if kind == 'xlsx' else kind
+
+
+def _column_key(name):
+    return ' '.join(str(name).split()).casefold()
+
+
+def _matcher(columns):
+    """usecols callable picking the header of each wanted column, however it is spaced or cased"""
+    wanted = {_column_key(col) for col in columns}
+    return lambda col: _column_key(col) in wanted
+
+
+def _read_excel(file_path, sheet_name, columns, engine):
+    import pandas as pd
+
+    with pd.ExcelFile(file_path, engine=engine) as xl:
+        if sheet_name is None:
+            sheet_name = xl.sheet_names[0]
+        elif sheet_name not in xl.sheet_names:
+            logger.error(f"Sheet '{sheet_name}' not found. Available sheets: {xl.sheet_names}")
+            return None
+        return xl.parse(sheet_name, usecols=_matcher(columns), dtype=object)
+
+
+def _read_csv(file_path, sheet_name, columns, engine):
+    import pandas as pd
+
+    # Every field is text, as in a master typed into Excel; blanks become NaN
+    return pd.read_csv(file_path, usecols=_matcher(columns), dtype=object,
+                       encoding='utf-8-sig', skipinitialspace=True)
+
+
+def _parquet_engine():
+    """The installed Parquet library pandas reads with"""
+    for engine, module in (('pyarrow', 'pyarrow'), ('fastparquet', 'fastparquet')):
+        if importlib.util.find_spec(module):
+            return engine
+    raise ImportError("the parquet backend needs pyarrow or fastparquet (pip install pyarrow)")
+
+
+def _parquet_columns(file_path, columns, engine):
+    """The wanted columns as spelled in the Parquet file, read from its schema alone"""
+    if engine == 'pyarrow':
+        import pyarrow.parquet as pq
+        names = pq.read_schema(file_path).names
+    else:
+        import fastparquet
+        names = fastparquet.ParquetFile(file_path).columns
+    return [name for name in names if _matcher(columns)(name)]
+
+
+def _read_parquet(file_path, sheet_name, columns, engine):
+    import pandas as pd
+
+    engine = _parquet_engine()
+    return pd.read_parquet(file_path, engine=engine, columns=_parquet_columns(file_path, columns, engine))
+
+
+_READERS = {
+    'calamine': _read_excel,
+    'openpyxl': _read_excel,
+    'csv': _read_csv,
+    'parquet': _read_parquet,
+}
+
+
+def _cell_text(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def normalize_master(df, columns=MASTER_COLUMNS):
+    """The wanted columns of df under their canonical names, text columns as text
+
+    Any backend's frame comes out alike: headers are matched ignoring case
+    and spacing, numbers in text columns become text and real dates are kept
+    as dates in object columns, with blanks left as NaN.
+    """
+    canonical = {_column_key(col): col for col in columns}
+    df = df.loc[:, [col for col in df.columns if _column_key(col) in canonical]]
+    df.columns = [canonical[_column_key(col)] for col in df.columns]
+    df = df.loc[:, ~df.columns.duplicated()]
+
+    for col, dtype in columns.items():
+        if col not in df.columns:
+            continue
+        values = df[col].astype(object)
+        if dtype is str:
+            text = values.map(_cell_text, na_action='ignore')
+            df[col] = text.astype(str).where(text.notna())
+        else:
+            df[col] = values
+    return df
+
+
+def parse_master(file_path, sheet_name, columns=MASTER_COLUMNS, backend='auto', optional=()):
+    """Parse the needed columns of the master with the backend for its file type
+
+    sheet_name only applies to XLSX masters (None reads the first sheet).
+    Columns in optional may be missing without a warning. Returns None
+    (after listing the available sheets) if the sheet is missing.
+    """
+    backend = resolve_backend(file_path, backend)
+    if backend == 'calamine' and not importlib.util.find_spec('python_calamine'):
+        raise ImportError("the calamine backend needs python-calamine (pip install python-calamine)")
+    if backend not in _READERS:
+        raise ValueError(f"unknown master backend '{backend}'; use one of {', '.join(BACKENDS)}")
+    logger.debug(f"Reading {file_path} with the {backend} backend")
+
+    df = _READERS[backend](file_path, sheet_name, columns, backend)
+    if df is None:
+        return None
+    df = normalize_master(df, columns)
+
+    missing = [col for col in columns if col not in df.columns and col not in optional]
+    if missing:
+        logger.warning(f"{os.path.basename(file_path)} is missing columns {missing}")
+    return df
+
+
+def _xlsx_rows(file_path, sheet_name, columns):
+    """Header and rows of a sheet from openpyxl's read-only mode, rows as value tuples"""
+    import openpyxl
+
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        if sheet_name is None:
+            sheet_name = wb.sheetnames[0]
+        elif sheet_name not in wb.sheetnames:
+            raise ValueError(f"Sheet '{sheet_name}' not found. Available sheets: {wb.sheetnames}")
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        header = next(rows, ())
+        wanted = _matcher(columns)
+        positions = [pos for pos, name in enumerate(header) if name is not None and wanted(name)]
+        yield [header[pos] for pos in positions]
+        # Blank rows count only if something follows them, as when pandas reads the sheet
+        blank = []
+        for row in rows:
+            values = tuple(row[pos] if pos < len(row) else None for pos in positions)
+            if all(value is None or value == '' for value in values):
+                blank.append(values)
+                continue
+            yield from blank
+            blank.clear()
+            yield values
+    finally:
+        wb.close()
+
+
+def _xlsx_chunks(file_path, sheet_name, columns, chunk_rows):
+    import pandas as pd
+
+    rows = _xlsx_rows(file_path, sheet_name, columns)
+    header = next(rows)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_rows))
+        if not chunk:
+            return
+        df = pd.DataFrame(chunk, columns=header, index=pd.RangeIndex(start, start + len(chunk)), dtype=object)
+        # Empty cells are NaN, as pandas reads them
+        yield df.where(df.notna() & (df != ''), float('nan'))
+        start += len(chunk)
+
+
+def _csv_chunks(file_path, sheet_name, columns, chunk_rows):
+    import pandas as pd
+
+    yield from pd.read_csv(file_path, usecols=_matcher(columns), dtype=object, encoding='utf-8-sig',
+                           skipinitialspace=True, chunksize=chunk_rows)
+
+
+def _parquet_chunks(file_path, sheet_name, columns, chunk_rows):
+    import pandas as pd
+
+    engine = _parquet_engine()
+    names = _parquet_columns(file_path, columns, engine)
+    if engine != 'pyarrow':
+        # fastparquet cannot read by row batches: read the needed columns, then hand them out in chunks
+        df = pd.read_parquet(file_path, engine=engine, columns=names).reset_index(drop=True)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+        return
+
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(file_path)
+    start = 0
+    for batch in parquet.iter_batches(batch_size=chunk_rows, columns=names):
+        df = batch.to_pandas()
+        df.index = pd.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
+
+
+def iter_master_chunks(file_path, sheet_name, chunk_rows, columns=MASTER_COLUMNS, backend='auto'):
+    """The master as frames of chunk_rows rows, normalized like parse_master's result
+
+    Row labels run on across chunks, so they are the same as in the whole
+    master. XLSX is streamed through openpyxl's read-only mode (calamine
+    cannot stream), CSV through pandas' chunked reader and Parquet by row
+    batches with pyarrow, so only one chunk is held at a time. With
+    fastparquet the needed columns are read whole and then chunked.
+    """
+    backend = resolve_backend(file_path, backend)
+    if backend in ('calamine', 'openpyxl'):
+        chunks = _xlsx_chunks(file_path, sheet_name, columns, chunk_rows)
+    elif backend == 'csv':
+        chunks = _csv_chunks(file_path, sheet_name, columns, chunk_rows)
+    elif backend == 'parquet':
+        chunks = _parquet_chunks(file_path, sheet_name, columns, chunk_rows)
+    else:
+        raise ValueError(f"unknown master backend '{backend}'; use one of {', '.join(BACKENDS)}")
+    logger.debug(f"Streaming {file_path} in chunks of {chunk_rows} rows with the {backend} backend")
+
+    for position, chunk in enumerate(chunks):
+        chunk = normalize_master(chunk, columns)
+        if position == 0:
+            missing = [col for col in columns if col not in chunk.columns]
+            if missing:
+                logger.warning(f"{os.path.basename(file_path)} is missing columns {missing}")
+        yield chunk
+
+
+def read_excel_data(file_path, sheet_name='agency', use_cache=True, backend='auto'):
+    """Read the form's columns from a sheet of the Excel master, or from a CSV/Parquet export
+
+    The file is opened once and only the columns in MASTER_COLUMNS are
+    parsed, by the backend its extension calls for unless one is given.
+    The result is cached on disk and reused until the file changes.
+    """
+    try:
+        if use_cache:
+            df = load_cached(file_path, sheet_name, MASTER_COLUMNS)
+            if df is not None:
+                logger.info(f"Loaded {len(df)} rows from {sheet_name} sheet (cached)")
+                return df
+
+        df = parse_master(file_path, sheet_name, backend=backend)
+        if df is None:
+            return None
+        logger.info(f"Successfully read {len(df)} rows from {sheet_name} sheet")
+        logger.debug(f"Columns: {list(df.columns)}")
+
+        if use_cache:
+            store_cached(file_path, sheet_name, MASTER_COLUMNS, df)
+        return df
+    except Exception as e:
+        logger.error(f"Error reading master {file_path}: {e}")
+        return None
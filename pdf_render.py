@@ -0,0 +1,399 @@
+"""Render refund forms straight to PDF, without Excel.
+
+``PageLayout`` turns a compiled ``RenderPlan`` into page geometry the way
+Excel prints the sheet: the print area, column widths and row heights,
+scaled to fit one A4 portrait page inside the layout's margins and centred
+horizontally, with its header and footer. ``render_page`` draws one work as
+a PDF content stream using the standard Helvetica fonts, so nothing has to
+be embedded; text outside their WinAnsi character set is approximated (the
+rupee sign prints as "Rs."). ``PdfWriter`` collects pages into a file one
+at a time, so a combined PDF of every work never has to be held in memory.
+"""
+import math
+import os
+import stat
+import tempfile
+import zlib
+from datetime import date, datetime
+
+from openpyxl.utils import get_column_letter, range_boundaries
+
+from form_template import DEFAULT_DIVISION, get_plan
+from work_records import as_records
+
+A4_PORTRAIT = (595.28, 841.89)
+POINTS_PER_INCH = 72
+CELL_PADDING = 2
+DEFAULT_FONT_SIZE = 11
+HEADER_FONT_SIZE = 10
+
+BORDER_WIDTHS = {
+    'hair': 0.25, 'thin': 0.5, 'dotted': 0.5, 'dashed': 0.5, 'dashDot': 0.5, 'dashDotDot': 0.5,
+    'medium': 1.0, 'mediumDashed': 1.0, 'mediumDashDot': 1.0, 'mediumDashDotDot': 1.0,
+    'slantDashDot': 1.0, 'thick': 1.5, 'double': 1.5,
+}
+
+# Glyph widths (1/1000 em) of ' ' to '~' in the standard Helvetica fonts
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+]
+FALLBACK_WIDTH = 556
+
+# Resource name and base font of the regular and bold faces
+FONTS = {False: ('F1', 'Helvetica'), True: ('F2', 'Helvetica-Bold')}
+
+
+def _process_umask():
+    """The umask new files get, read without changing it where the OS allows"""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError):
+        pass
+    # os.umask can only read the mask by setting it, so this is done once, at import
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+_UMASK = _process_umask()
+
+
+def display_text(value):
+    """Cell value as printed text (dates as dd/mm/yyyy, blanks and NaN as '')"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%d/%m/%Y')
+    return str(value)
+
+
+def pdf_bytes(text):
+    """Text encoded for the WinAnsi Helvetica fonts"""
+    return text.replace('₹', 'Rs.').encode('cp1252', errors='replace')
+
+
+def text_width(text, bold, size):
+    widths = HELVETICA_BOLD_WIDTHS if bold else HELVETICA_WIDTHS
+    total = 0
+    for byte in pdf_bytes(text):
+        total += widths[byte - 32] if 32 <= byte <= 126 else FALLBACK_WIDTH
+    return total * size / 1000
+
+
+def wrap_text(text, bold, size, width):
+    """Split text into lines no wider than width, breaking at spaces"""
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = f"{line} {word}" if line else word
+            if line and text_width(candidate, bold, size) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+def column_points(width):
+    """Excel column width (in characters of the default font) as points"""
+    return int(width * 7 + 5) * 0.75
+
+
+def _literal(data):
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def _rgb(color, default='000000'):
+    rgb = getattr(color, 'rgb', None)
+    rgb = rgb[-6:] if isinstance(rgb, str) else default
+    return ' '.join(f"{int(rgb[i:i + 2], 16) / 255:.3f}" for i in (0, 2, 4))
+
+
+class PageLayout:
+    """Where every cell of a plan's print area lands on an A4 page"""
+
+    def __init__(self, plan, page_size=A4_PORTRAIT):
+        self.plan = plan
+        spec = plan.spec
+        print_spec = spec['print']
+        self.page_width, self.page_height = page_size
+        self.print_spec = print_spec
+
+        # Print area as apply_print_setup sets it: A1 to E(last row + padding)
+        last_row = plan.last_content_row + print_spec['area_padding']
+        self.last_col = 5
+        self.col_x = [0.0]
+        for col_idx in range(1, self.last_col + 1):
+            width = spec['column_widths'].get(get_column_letter(col_idx), 8.43)
+            self.col_x.append(self.col_x[-1] + column_points(width))
+        self.row_y = [0.0]
+        for row_idx in range(1, last_row + 1):
+            self.row_y.append(self.row_y[-1] + plan.row_heights.get(row_idx, spec['row_height']))
+        self.last_row = last_row
+
+        margins = {side: value * POINTS_PER_INCH for side, value in print_spec['margins'].items()}
+        self.margins = margins
+        area_width, area_height = self.col_x[-1], self.row_y[-1]
+        self.scale = min(1.0, (self.page_width - margins['left'] - margins['right']) / area_width)
+        if print_spec.get('fit_to_height'):
+            self.scale = min(self.scale, (self.page_height - margins['top'] - margins['bottom']) / area_height)
+        if print_spec.get('horizontal_centered'):
+            self.origin_x = (self.page_width - area_width * self.scale) / 2
+        else:
+            self.origin_x = margins['left']
+        self.origin_y = self.page_height - margins['top']
+
+        # Merged ranges by their top-left cell, and the cells they cover
+        self.merged = {}
+        self.covered = set()
+        for merge in plan.merges:
+            min_col, min_row, max_col, max_row = range_boundaries(merge)
+            self.merged[(min_row, min_col)] = (max_row, max_col)
+            for row_idx in range(min_row, max_row + 1):
+                for col_idx in range(min_col, max_col + 1):
+                    if (row_idx, col_idx) != (min_row, min_col):
+                        self.covered.add((row_idx, col_idx))
+
+        self.static_ops = self._static_ops()
+
+    def box(self, row_idx, col_idx):
+        """(x, y, width, height) in sheet points of a cell or its merged range, y down"""
+        max_row, max_col = self.merged.get((row_idx, col_idx), (row_idx, col_idx))
+        x, y = self.col_x[col_idx - 1], self.row_y[row_idx - 1]
+        return x, y, self.col_x[max_col] - x, self.row_y[max_row] - y
+
+    def _header_footer_ops(self):
+        ops = []
+        margins = self.margins
+        for text, baseline in ((self.print_spec.get('header'), self.page_height - margins['header'] - HEADER_FONT_SIZE),
+                               (self.print_spec.get('footer'), margins['footer'] + HEADER_FONT_SIZE * 0.25)):
+            if not text:
+                continue
+            # Every form prints as its own one-page sheet
+            text = text.replace('&P', '1').replace('&N', '1')
+            x = (self.page_width - text_width(text, False, HEADER_FONT_SIZE)) / 2
+            ops.append(b'BT /F1 %d Tf 0 g %.2f %.2f Td %s Tj ET' % (
+                HEADER_FONT_SIZE, x, baseline, _literal(pdf_bytes(text))))
+        return ops
+
+    def _static_ops(self):
+        """Drawing operators shared by every page: header, footer, fills and borders"""
+        ops = self._header_footer_ops()
+        ops.append(b'q %.5f 0 0 %.5f %.3f %.3f cm' % (self.scale, self.scale, self.origin_x,
+                                                        self.origin_y - self.row_y[-1] * self.scale))
+        height = self.row_y[-1]
+        styles = self.plan.styles
+
+        cells = [(row_idx, col_idx, style) for row_idx, cells in self.plan.row_cells.items()
+                 for col_idx, _, _, style in cells
+                 if row_idx <= self.last_row and col_idx <= self.last_col and (row_idx, col_idx) not in self.covered]
+
+        for row_idx, col_idx, style in cells:
+            fill = styles[style].get('fill')
+            if fill is not None and fill.fill_type == 'solid':
+                x, y, w, h = self.box(row_idx, col_idx)
+                ops.append(b'%s rg %.2f %.2f %.2f %.2f re f' % (
+                    _rgb(fill.fgColor, 'FFFFFF').encode(), x, height - y - h, w, h))
+
+        for row_idx, col_idx, style in cells:
+            border = styles[style].get('border')
+            if border is None:
+                continue
+            x, y, w, h = self.box(row_idx, col_idx)
+            top, bottom = height - y, height - y - h
+            edges = {'left': (x, bottom, x, top), 'right': (x + w, bottom, x + w, top),
+                     'top': (x, top, x + w, top), 'bottom': (x, bottom, x + w, bottom)}
+            for side_name, (x1, y1, x2, y2) in edges.items():
+                side = getattr(border, side_name)
+                if side is not None and side.style:
+                    ops.append(b'%s RG %.2f w %.2f %.2f m %.2f %.2f l S' % (
+                        _rgb(side.color).encode(), BORDER_WIDTHS.get(side.style, 0.5), x1, y1, x2, y2))
+        ops.append(b'Q')
+        return ops
+
+    def text_ops(self, values):
+        """Drawing operators for the text of one work"""
+        height = self.row_y[-1]
+        styles = self.plan.styles
+        ops = [b'q %.5f 0 0 %.5f %.3f %.3f cm' % (self.scale, self.scale, self.origin_x,
+                                                   self.origin_y - height * self.scale),
+               b'0 0 %.2f %.2f re W n' % (self.col_x[-1], height)]
+
+        for row_idx, cells in self.plan.row_cells.items():
+            if row_idx > self.last_row:
+                continue
+            for col_idx, value, bare, style in cells:
+                if col_idx > self.last_col or (row_idx, col_idx) in self.covered:
+                    continue
+                if bare:
+                    value = values.get(bare, '')
+                elif bare is not None:
+                    value = value.format_map(values)
+                text = display_text(value)
+                if text:
+                    ops.extend(self._cell_text(row_idx, col_idx, text, styles[style], height))
+        ops.append(b'Q')
+        return ops
+
+    def _cell_text(self, row_idx, col_idx, text, style, height):
+        font = style.get('font')
+        alignment = style.get('alignment')
+        bold = bool(font is not None and font.b)
+        size = float(font.sz) if font is not None and font.sz else DEFAULT_FONT_SIZE
+        horizontal = alignment.horizontal if alignment is not None else None
+        vertical = alignment.vertical if alignment is not None else None
+        wrap = bool(alignment is not None and alignment.wrap_text)
+
+        x, y, w, h = self.box(row_idx, col_idx)
+        top, bottom = height - y, height - y - h
+        lines = wrap_text(text, bold, size, w - 2 * CELL_PADDING) if wrap else [text]
+        leading = size * 1.2
+
+        if vertical == 'top':
+            baseline = top - size * 0.95 - 1
+        elif vertical == 'center':
+            baseline = (top + bottom) / 2 + (len(lines) - 1) * leading / 2 - size * 0.35
+        else:
+            baseline = bottom + (len(lines) - 1) * leading + size * 0.25 + 1
+
+        resource = FONTS[bold][0].encode()
+        ops = [b'q']
+        if wrap:
+            # Excel keeps wrapped text inside its cell at a fixed row height
+            ops.append(b'%.2f %.2f %.2f %.2f re W n' % (x, bottom, w, h))
+        ops.append(b'BT /%s %.1f Tf %s rg' % (resource, size, _rgb(font.color if font is not None else None).encode()))
+        for line in lines:
+            line_width = text_width(line, bold, size)
+            if horizontal == 'center':
+                line_x = x + (w - line_width) / 2
+            elif horizontal == 'right':
+                line_x = x + w - CELL_PADDING - line_width
+            else:
+                line_x = x + CELL_PADDING
+            ops.append(b'1 0 0 1 %.2f %.2f Tm %s Tj' % (line_x, baseline, _literal(pdf_bytes(line))))
+            baseline -= leading
+        ops.append(b'ET Q')
+        return ops
+
+
+_layouts = {}
+
+
+def get_page_layout(plan):
+    layout = _layouts.get(id(plan))
+    if layout is None:
+        layout = _layouts[id(plan)] = PageLayout(plan)
+    return layout
+
+
+def render_page(values, division=DEFAULT_DIVISION):
+    """Compressed PDF content stream of the form for one work's field values"""
+    layout = get_page_layout(get_plan(division=division))
+    stream = b'\n'.join(layout.static_ops + layout.text_ops(values))
+    return zlib.compress(stream)
+
+
+def render_batch_pages(batch_data, batch_idx, division=DEFAULT_DIVISION):
+    """Render every work of a batch (WorkRecords or a DataFrame), returning its pages and status
+
+    Runs in a worker process; the pages are compressed content streams that
+    the parent writes out with PdfWriter.
+    """
+    result = {'batch': batch_idx, 'works': len(batch_data), 'status': 'ok', 'pages': [], 'error': None}
+    try:
+        for record in as_records(batch_data):
+            result['pages'].append(render_page(record._asdict(), division))
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    return result
+
+
+class PdfWriter:
+    """Write a PDF page by page from compressed content streams
+
+    Pages go to a temporary file as they are added; close() writes the page
+    tree and cross-reference table and moves the file into place.
+    """
+
+    def __init__(self, path, title=None, page_size=A4_PORTRAIT):
+        self.path = path
+        self.title = title
+        self.page_size = page_size
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, self._tmp_path = tempfile.mkstemp(prefix='.~pdf', suffix='.pdf', dir=directory)
+        self._file = os.fdopen(fd, 'wb')
+        self._offsets = {}
+        self._pages = []
+        # 1 catalog, 2 page tree, 3-4 fonts, 5 info; pages from 6 on
+        self._next_id = 6
+        self._file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _object(self, obj_id, body):
+        self._offsets[obj_id] = self._file.tell()
+        self._file.write(b'%d 0 obj\n' % obj_id + body + b'\nendobj\n')
+
+    def add_page(self, stream):
+        content_id, page_id = self._next_id, self._next_id + 1
+        self._next_id += 2
+        self._object(content_id, b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(stream)
+                     + stream + b'\nendstream')
+        self._object(page_id, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+                     b'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %d 0 R >>'
+                     % (*self.page_size, content_id))
+        self._pages.append(page_id)
+
+    def close(self):
+        try:
+            kids = b' '.join(b'%d 0 R' % page_id for page_id in self._pages)
+            self._object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+            self._object(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self._pages)))
+            for obj_id, bold in ((3, False), (4, True)):
+                self._object(obj_id, b'<< /Type /Font /Subtype /Type1 /BaseFont /%s '
+                             b'/Encoding /WinAnsiEncoding >>' % FONTS[bold][1].encode())
+            info = b'/Producer (security_refund_generator)'
+            if self.title:
+                info += b' /Title ' + _literal(pdf_bytes(self.title))
+            self._object(5, b'<< ' + info + b' >>')
+
+            xref = self._file.tell()
+            self._file.write(b'xref\n0 %d\n0000000000 65535 f \n' % self._next_id)
+            for obj_id in range(1, self._next_id):
+                self._file.write(b'%010d 00000 n \n' % self._offsets[obj_id])
+            self._file.write(b'trailer\n<< /Size %d /Root 1 0 R /Info 5 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                             % (self._next_id, xref))
+            self._file.close()
+            # mkstemp creates the file private; keep the mode of the file it replaces,
+            # or give a new one the usual permissions
+            if os.path.exists(self.path):
+                os.chmod(self._tmp_path, stat.S_IMODE(os.stat(self.path).st_mode))
+            else:
+                os.chmod(self._tmp_path, 0o666 & ~_UMASK)
+            os.replace(self._tmp_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Drop the partial file"""
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
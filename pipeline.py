@@ -0,0 +1,161 @@
+"""Threaded pipeline of stages joined by bounded queues.
+
+Each stage runs in its own thread (or threads) and passes its output to the
+next stage through a queue that holds at most ``depth`` items. A slow stage
+therefore holds up the stages before it (backpressure) instead of letting
+finished work pile up in memory, while the stages still overlap: one batch
+can be written to disk while the next is being rendered.
+
+Every stage keeps count of the time it spent working, the time it was
+starved (waiting for input) and the time it was stalled (waiting for room
+downstream), plus how deep its input queue was.
+"""
+import queue
+import threading
+import time
+
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+class PipelineStage:
+    """A named step of a pipeline: fn(item) -> item, run by `workers` threads"""
+
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.starved_seconds = 0.0
+        self.stalled_seconds = 0.0
+        self.max_queue = 0
+        self._queue_total = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {'stage': self.name, 'items': self.items, 'busy_seconds': self.busy_seconds,
+                'starved_seconds': self.starved_seconds, 'stalled_seconds': self.stalled_seconds,
+                'max_queue': self.max_queue,
+                'mean_queue': self._queue_total / self.items if self.items else 0.0}
+
+
+class Pipeline:
+    """Run items from a source through stages; run() yields the last stage's outputs
+
+    Outputs come in the order they finish, which is the source order when
+    every stage has one worker. The first exception raised by a stage stops
+    the pipeline and is raised again from run().
+    """
+
+    def __init__(self, stages, depth=2):
+        self.stages = stages
+        self.depth = depth
+        # Producing items from the source is reported as a stage of its own
+        self.source_stage = PipelineStage('load', None)
+        # Waits of whoever consumes run() are not attributed to any stage
+        self._consumer = PipelineStage('consumer', None)
+        self._stop = threading.Event()
+        self._error = None
+
+    def _put(self, q, item, stage):
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                break
+            except queue.Full:
+                continue
+        with stage._lock:
+            stage.stalled_seconds += time.perf_counter() - started
+
+    def _get(self, q, stage):
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                depth = q.qsize()
+                item = q.get(timeout=_POLL_SECONDS)
+                break
+            except queue.Empty:
+                continue
+        else:
+            return _DONE
+        with stage._lock:
+            stage.starved_seconds += time.perf_counter() - started
+            if item is not _DONE:
+                stage.max_queue = max(stage.max_queue, depth)
+                stage._queue_total += depth
+        return item
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _feed(self, source, out_q):
+        stage = self.source_stage
+        iterator = iter(source)
+        try:
+            while not self._stop.is_set():
+                started = time.perf_counter()
+                item = next(iterator, _DONE)
+                if item is _DONE:
+                    break
+                stage.busy_seconds += time.perf_counter() - started
+                stage.items += 1
+                self._put(out_q, item, stage)
+        except Exception as e:
+            self._fail(e)
+        self._put(out_q, _DONE, stage)
+
+    def _work(self, stage, in_q, out_q, finished):
+        while True:
+            item = self._get(in_q, stage)
+            if item is _DONE:
+                break
+            started = time.perf_counter()
+            try:
+                item = stage.fn(item)
+            except Exception as e:
+                self._fail(e)
+                break
+            with stage._lock:
+                stage.busy_seconds += time.perf_counter() - started
+                stage.items += 1
+            self._put(out_q, item, stage)
+
+        # Let sibling workers see the end too; the last one passes it on
+        if not self._stop.is_set():
+            self._put(in_q, _DONE, stage)
+        with stage._lock:
+            finished[0] += 1
+            last = finished[0] == stage.workers
+        if last:
+            self._put(out_q, _DONE, stage)
+
+    def run(self, source):
+        queues = [queue.Queue(maxsize=self.depth) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0]), daemon=True)]
+        for stage, in_q, out_q in zip(self.stages, queues, queues[1:]):
+            finished = [0]
+            threads.extend(threading.Thread(target=self._work, args=(stage, in_q, out_q, finished), daemon=True)
+                           for _ in range(stage.workers))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(queues[-1], self._consumer)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def stats(self):
+        """Per-stage counters, source first"""
+        return [stage.stats() for stage in [self.source_stage] + self.stages]
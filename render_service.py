@@ -0,0 +1,187 @@
+"""Local render service: single refund forms on demand from a warm process.
+
+The service parses the master once and keeps every work as a record in
+memory, with the compiled form layout, so a request only renders one sheet.
+The master is parsed again only when its modification time or size changes.
+
+    python render_service.py --port 8765
+    GET /form?agreement=104/2020-21              -> one-sheet xlsx
+    GET /form?agreement=104/2020-21&format=pdf   -> one-page PDF
+    GET /health                                  -> JSON status
+
+A repeated agreement number is asked for as '104/2020-21#2', the same work
+key the incremental manifest uses.
+"""
+import argparse
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import openpyxl
+
+from form_template import DEFAULT_DIVISION, create_single_work_sheet
+from incremental import normalize_agreement, work_keys
+from instrumentation import LOG_LEVELS, configure_logging, logger
+from master_reader import read_excel_data
+from pdf_render import PdfWriter, render_page
+from sheet_naming import name_sheets
+from work_records import work_records
+from xlsx_stream import save_workbook
+
+CONTENT_TYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pdf': 'application/pdf',
+}
+
+
+class MasterCache:
+    """Records of the master by work key, reloaded when the file changes"""
+
+    def __init__(self, path, sheet_name='Work Orders'):
+        self.path = path
+        self.sheet_name = sheet_name
+        self._stamp = None
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def records(self):
+        """Current {work key: WorkRecord}, parsing the master again if it changed"""
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    self._load(stamp)
+        return self._records
+
+    def _load(self, stamp):
+        started = time.perf_counter()
+        df = read_excel_data(self.path, self.sheet_name)
+        if df is None:
+            raise RuntimeError(f"could not read '{self.sheet_name}' from {self.path}")
+        name_sheets(df)
+        self._records = dict(zip(work_keys(df), work_records(df)))
+        self._stamp = stamp
+        logger.info(f"Loaded {len(self._records)} works from {self.path} in {time.perf_counter() - started:.2f}s")
+
+    def find(self, agreement_no):
+        return self.records().get(normalize_agreement(agreement_no))
+
+
+def render_form(record, fmt='xlsx', division=DEFAULT_DIVISION):
+    """One work's form as xlsx or PDF bytes"""
+    if fmt == 'pdf':
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'form.pdf')
+            writer = PdfWriter(path, title=f"Security Deposit Refund - {record.agreement_no}")
+            writer.add_page(render_page(record._asdict(), division))
+            writer.close()
+            with open(path, 'rb') as f:
+                return f.read()
+
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    create_single_work_sheet(wb, record, 1, division)
+    buffer = BytesIO()
+    save_workbook(wb, buffer)
+    return buffer.getvalue()
+
+
+class FormRequestHandler(BaseHTTPRequestHandler):
+    """GET /form and /health against the server's MasterCache"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/health':
+                body = json.dumps({'master': self.server.master.path,
+                                   'works': len(self.server.master.records())}).encode('utf-8')
+                return self._send(200, body, 'application/json')
+            if url.path != '/form':
+                return self._send_error(404, "unknown path; use /form?agreement=...")
+
+            fmt = query.get('format', 'xlsx')
+            if fmt not in CONTENT_TYPES:
+                return self._send_error(400, "format must be xlsx or pdf")
+            if not query.get('agreement'):
+                return self._send_error(400, "agreement is required")
+            record = self.server.master.find(query['agreement'])
+            if record is None:
+                return self._send_error(404, f"no work with agreement '{query['agreement']}'")
+
+            started = time.perf_counter()
+            body = render_form(record, fmt, self.server.division)
+            filename = re.sub(r'[^0-9A-Za-z]+', '_', record.sheet_name).strip('_')
+            self._send(200, body, CONTENT_TYPES[fmt],
+                       {'Content-Disposition': f'attachment; filename="Security_Refund_{filename}.{fmt}"'})
+            logger.debug(f"Rendered {record.agreement_no} as {fmt} in {(time.perf_counter() - started) * 1000:.1f} ms")
+        except Exception as e:
+            logger.error(f"Failed: {self.path}: {e}")
+            self._send_error(500, str(e))
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send(status, json.dumps({'error': message}).encode('utf-8'), 'application/json')
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def make_server(master_path, host='127.0.0.1', port=8765, division=DEFAULT_DIVISION, sheet_name='Work Orders'):
+    """HTTP server with the master loaded and the layout compiled, ready to serve"""
+    server = ThreadingHTTPServer((host, port), FormRequestHandler)
+    server.master = MasterCache(master_path, sheet_name)
+    server.division = division
+    records = server.master.records()
+    if records:
+        # Compile the layouts and register their styles before the first request
+        render_form(next(iter(records.values())), 'xlsx', division)
+        render_form(next(iter(records.values())), 'pdf', division)
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve single security refund forms from a warm process")
+    parser.add_argument('--master', default='work_order_master.xlsx',
+                        help="work order master to serve forms from")
+    parser.add_argument('--master-sheet', default='Work Orders',
+                        help="sheet of an xlsx master to read (default: %(default)s)")
+    parser.add_argument('--division', default=DEFAULT_DIVISION,
+                        help="division printed in the forms' footer (default: %(default)s)")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to listen on (default: local only)")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--log-level', default='INFO', choices=LOG_LEVELS, type=str.upper,
+                        help="DEBUG adds a line per request with its render time")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(args.log_level)
+    server = make_server(args.master, args.host, args.port, args.division, args.master_sheet)
+    logger.info(f"Serving forms on http://{args.host}:{server.server_port}/form?agreement=...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""Index of a generation run: where every work's form ended up.
+
+Each run writes two files next to its batch workbooks. The index workbook
+lists every work with hyperlinks to its batch file and to its sheet inside
+that file. The JSON lookup index maps agreement numbers, and contractors, to
+the same entries, so ``find_forms`` answers "where is this form?" with a
+dictionary lookup instead of a scan through the batch workbooks.
+"""
+import json
+import os
+
+from incremental import normalize_agreement
+from sheet_naming import strip_firm_prefix
+from xlsx_patch import quote_sheet_name
+
+INDEX_VERSION = 1
+
+INDEX_COLUMNS = [
+    ('S.No', 7), ('Name of Contractor', 35), ('Agreement No.', 16), ('Name of Work', 60),
+    ('Workbook', 36), ('Sheet', 24),
+]
+
+def index_paths(output_dir, agreement_year):
+    """(index workbook, lookup index) paths of a run's output directory"""
+    base = os.path.join(output_dir, f"Security_Refund_Index_{agreement_year}")
+    return base + '.xlsx', base + '.json'
+
+
+def normalize_contractor(contractor):
+    """Canonical form of a contractor name used as a lookup key, without 'M/s', case or spacing"""
+    return ' '.join(strip_firm_prefix(str(contractor)).split()).casefold()
+
+
+def _words_match(query_words, name_words):
+    """True if every query word starts some word of the name"""
+    return all(any(word.startswith(query_word) for word in name_words) for query_word in query_words)
+
+
+def index_entries(records, batch_numbers, batch_filename):
+    """One index entry per work, in master order
+
+    records are the run's WorkRecords, batch_numbers the batch each one went
+    into and batch_filename(batch_number) the name of that batch's workbook.
+    """
+    return [{'contractor': record.contractor, 'agreement_no': record.agreement_no,
+             'work_name': record.work_name, 'batch': batch_number,
+             'file': batch_filename(batch_number), 'sheet': record.sheet_name}
+            for record, batch_number in zip(records, batch_numbers)]
+
+
+def build_lookup(entries):
+    """Lookup index: entries plus agreement-number and contractor keys into them"""
+    agreements = {}
+    contractors = {}
+    for position, entry in enumerate(entries):
+        agreements.setdefault(normalize_agreement(entry['agreement_no']), []).append(position)
+        contractors.setdefault(normalize_contractor(entry['contractor']), []).append(position)
+    return {'version': INDEX_VERSION, 'entries': entries,
+            'agreements': agreements, 'contractors': contractors}
+
+
+def write_index_workbook(entries, path):
+    """Write the index workbook: one row per work, linking to its file and sheet"""
+    # openpyxl only here, so looking a form up does not load it
+    import openpyxl
+    from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+    from openpyxl.worksheet.hyperlink import Hyperlink
+
+    thin = Side(style='thin')
+    header_style = {
+        'font': Font(bold=True, size=11),
+        'fill': PatternFill(start_color='E6E6FA', end_color='E6E6FA', fill_type='solid'),
+        'alignment': Alignment(horizontal='center', vertical='center'),
+        'border': Border(left=thin, right=thin, top=thin, bottom=thin),
+    }
+    link_font = Font(color='0563C1', underline='single')
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'Index'
+
+    for col_idx, (title, width) in enumerate(INDEX_COLUMNS, 1):
+        cell = ws.cell(row=1, column=col_idx, value=title)
+        for name, value in header_style.items():
+            setattr(cell, name, value)
+        ws.column_dimensions[cell.column_letter].width = width
+
+    for row_idx, entry in enumerate(entries, 2):
+        values = [row_idx - 1, entry['contractor'], entry['agreement_no'], entry['work_name'],
+                  entry['file'], entry['sheet']]
+        for col_idx, value in enumerate(values, 1):
+            ws.cell(row=row_idx, column=col_idx, value=value)
+
+        file_cell = ws.cell(row=row_idx, column=5)
+        file_cell.hyperlink = Hyperlink(ref=file_cell.coordinate, target=entry['file'])
+        file_cell.font = link_font
+        sheet_cell = ws.cell(row=row_idx, column=6)
+        sheet_cell.hyperlink = Hyperlink(ref=sheet_cell.coordinate, target=entry['file'],
+                                         location=f"{quote_sheet_name(entry['sheet'])}!A1")
+        sheet_cell.font = link_font
+
+    ws.freeze_panes = 'A2'
+    ws.auto_filter.ref = f"A1:F{len(entries) + 1}"
+    wb.save(path)
+
+
+def save_lookup(lookup, path):
+    """Write the lookup index atomically"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(lookup, f, indent=1, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load_lookup(path):
+    """Read a lookup index, or None if there is none usable"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            lookup = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if lookup.get('version') != INDEX_VERSION:
+        return None
+    return lookup
+
+
+def write_run_index(entries, output_dir, agreement_year):
+    """Write the index workbook and the lookup index of a run, returning their paths"""
+    workbook_path, lookup_path = index_paths(output_dir, agreement_year)
+    write_index_workbook(entries, workbook_path)
+    save_lookup(build_lookup(entries), lookup_path)
+    return workbook_path, lookup_path
+
+
+def find_forms(lookup, query):
+    """Entries for an agreement number or, failing that, a contractor
+
+    A contractor is found by its whole name or, failing that, by words:
+    'Abhinav' or 'abhinav eng' find every form of Abhinav Engineering &
+    Suppliers, in master order.
+    """
+    positions = lookup['agreements'].get(normalize_agreement(query))
+    if not positions:
+        key = normalize_contractor(query)
+        positions = lookup['contractors'].get(key)
+        if not positions and key:
+            query_words = key.split()
+            positions = sorted(position for name, name_positions in lookup['contractors'].items()
+                               if _words_match(query_words, name.split()) for position in name_positions)
+    return [lookup['entries'][position] for position in positions or []]
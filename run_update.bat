@@ -30,8 +30,8 @@ REM Upgrade pip and install dependencies
 "%VENV_PY%" -m pip install --upgrade pip
 "%VENV_PY%" -m pip install --upgrade openpyxl pandas
 
-REM Run the updater script
-"%VENV_PY%" update_existing_workbooks.py
+REM Run the updater (zip-level; loads neither openpyxl nor pandas)
+"%VENV_PY%" security_refund.py update
 
 echo.
 echo Completed updating Excel workbooks.
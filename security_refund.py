@@ -0,0 +1,47 @@
+"""Command-line entry point for the security refund tools.
+
+    python security_refund.py generate --master work_order_master.xlsx --workers 4
+    python security_refund.py update Security_Refund_Sheets_2025_20250903_033335
+    python security_refund.py verify Security_Refund_Sheets_2025_20250903_033335
+    python security_refund.py single-form 104/2020-21
+
+Each subcommand hands the rest of the command line to its tool's own
+``main`` (``<command> --help`` lists its options). Only that tool is
+imported, so a command loads only the libraries it needs: ``update``
+patches at the zip level without openpyxl or pandas, and ``single-form``
+renders without pandas. A short job then no longer spends most of its time
+importing.
+"""
+import argparse
+import importlib
+import sys
+
+# command -> (module whose main() runs it, summary)
+COMMANDS = {
+    'generate': ('security_refund_generator', "generate the batch workbooks (or PDFs) from the master"),
+    'update': ('update_existing_workbooks', "apply the layout fixes, or fill deposits from a ledger"),
+    'verify': ('audit_workbooks', "check generated workbooks against the master and the print layout"),
+    'single-form': ('single_form', "render one agreement's form straight from the master"),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Security deposit refund forms",
+        epilog='\n'.join(f"  {command:<12} {summary}" for command, (_, summary) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=COMMANDS, metavar='command',
+                        help="one of: " + ', '.join(COMMANDS))
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help="options of the command (see '<command> --help')")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    module = importlib.import_module(COMMANDS[args.command][0])
+    return module.main(args.args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
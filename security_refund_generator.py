@@ -1,379 +1,120 @@
-import pandas as pd
-import openpyxl
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.drawing.image import Image
-from openpyxl.worksheet.hyperlink import Hyperlink
+"""Generate the RWMF 119 security refund workbooks (or PDFs) from the work order master.
+
+Only argparse and light helpers are imported at the top, so '--help',
+--lookup and --reprint start quickly; pandas, openpyxl, the PDF renderer,
+the pipeline and the index, register and store writers are imported by the
+functions that use them.
+"""
+import argparse
+import copy
+import itertools
+import logging
 import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, nullcontext
 from datetime import datetime
+from io import BytesIO
 
-def read_excel_data(file_path, sheet_name='agency'):
-    """Read data from Excel file agency sheet"""
-    try:
-        # First, let's see what sheets are available
-        xl_file = pd.ExcelFile(file_path)
-        print(f"Available sheets: {xl_file.sheet_names}")
-        
-        df = pd.read_excel(file_path, sheet_name=sheet_name)
-        print(f"Successfully read {len(df)} rows from {sheet_name} sheet")
-        print(f"Columns: {list(df.columns)}")
-        return df
-    except Exception as e:
-        print(f"Error reading Excel file: {e}")
-        return None
+from form_fields import DEFAULT_DIVISION, DEFAULT_DLP_MONTHS, FIELD_COLUMNS
+from form_store import DEFAULT_STORE
+from incremental import batch_filename, normalize_agreement, plan_incremental_batches, save_manifest, work_keys
+from instrumentation import LOG_LEVELS, MetricsRecorder, configure_logging, logger
+from master_reader import BACKENDS, iter_master_chunks, read_excel_data
+from sheet_naming import SHEET_NAME_COLUMN, base_sheet_names, is_blank, name_sheets, sheet_name_for, unique_names
+from work_records import as_records, work_records
+
+# Master rows read, checked and named at a time by --lazy
+LAZY_BLOCK_ROWS = 1000
+
+# Files a --masters directory is searched for
+MASTER_EXTENSIONS = ('.xlsx', '.xlsm', '.csv', '.parquet')
+
+# Stand-in for callers that do not collect metrics
+_NO_METRICS = MetricsRecorder(enabled=False)
 
 def create_sheet_name(vendor, agreement_no):
-    """Create sheet name from vendor and agreement number"""
-    try:
-        # Get vendor name and clean it
-        vendor_str = str(vendor).strip()
-        
-        # Remove 'M/s' prefix variations
-        vendor_clean = vendor_str.replace('M/s', '').replace('M/s.', '').replace('M/s ', '').strip()
-        
-        # Get first word (first name)
-        first_name = vendor_clean.split()[0] if vendor_clean else 'Unknown'
-        
-        # Get agreement number and clean it
-        agreement_str = str(agreement_no).strip()
-        
-        # Extract number part before year (e.g., "104/2020-21" -> "104")
-        if '/' in agreement_str:
-            agreement_clean = agreement_str.split('/')[0]
-        elif '-' in agreement_str:
-            agreement_clean = agreement_str.split('-')[0]
-        else:
-            agreement_clean = agreement_str
-        
-        # Create sheet name: First name + space + agreement number
-        sheet_name = f"{first_name} {agreement_clean}"
-        
-        # Excel sheet names cannot contain certain characters
-        invalid_chars = ['\\', '/', '*', '?', ':', '[', ']']
-        for char in invalid_chars:
-            sheet_name = sheet_name.replace(char, '')
-        
-        # Excel sheet names have 31 character limit
-        if len(sheet_name) > 31:
-            sheet_name = sheet_name[:31]
-        
-        # Ensure it's not empty
-        if not sheet_name.strip():
-            sheet_name = f"Work_{agreement_clean}"
-        
-        # Final cleanup
-        sheet_name = sheet_name.strip()
-        
-        print(f"Creating sheet: '{sheet_name}' from vendor: '{vendor_str}' and agreement: '{agreement_str}'")
-        
-        return sheet_name
-        
-    except Exception as e:
-        print(f"Error creating sheet name: {e}")
-        # Fallback naming
-        try:
-            agreement_clean = str(agreement_no).split('/')[0] if '/' in str(agreement_no) else str(agreement_no)
-            return f"Work_{agreement_clean}"
-        except:
-            return "Work_Unknown"
-
-def create_single_work_sheet(wb, row, work_idx):
-    """Create a single work sheet with enhanced formatting"""
-    
-    # Create new worksheet with correct column names
-    vendor_name = row['Name of Contractor'] if 'Name of Contractor' in row else ''
-    agreement_no = row['Agreement No.'] if 'Agreement No.' in row else ''
-    
-    sheet_name = create_sheet_name(vendor_name, agreement_no)
-    ws = wb.create_sheet(title=sheet_name)
-    
-    # Define enhanced styles
-    title_font = Font(bold=True, size=16, color='000080')  # Navy blue
-    header_font = Font(bold=True, size=12, color='000000')
-    normal_font = Font(size=11, color='000000')
-    small_font = Font(size=10, color='000000')
-    value_font = Font(size=11, bold=True, color='000000')
-    
-    center_alignment = Alignment(horizontal='center', vertical='center')
-    left_alignment = Alignment(horizontal='left', vertical='center')
-    
-    # Enhanced borders
-    thick_border = Border(
-        left=Side(style='thick'),
-        right=Side(style='thick'),
-        top=Side(style='thick'),
-        bottom=Side(style='thick')
-    )
-    
-    medium_border = Border(
-        left=Side(style='medium'),
-        right=Side(style='medium'),
-        top=Side(style='medium'),
-        bottom=Side(style='medium')
-    )
-    
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Header background
-    header_fill = PatternFill(start_color='E6E6FA', end_color='E6E6FA', fill_type='solid')
-    
-    current_row = 1
-    
-    # Main title with enhanced styling - merged A to E
-    ws.merge_cells(f'A{current_row}:E{current_row}')
-    ws[f'A{current_row}'] = f"ORDER FOR REFUND OF SECURITY DEPOSIT [RWMF 119]"
-    ws[f'A{current_row}'].font = title_font
-    ws[f'A{current_row}'].alignment = center_alignment
-    ws[f'A{current_row}'].border = thick_border
-    ws[f'A{current_row}'].fill = header_fill
-    current_row += 1  # Only one blank row after heading
-    
-    # Form fields with enhanced formatting - using correct column names
-    form_fields = [
-        ("1. Name of Contractor:", vendor_name),
-        ("2. Amount of Deposit: ₹", ""),  # Not available in current data
-        ("3. Name of Work:", row['Name of Work'] if 'Name of Work' in row else ''),
-        ("4. Agreement No.:", agreement_no),
-        ("5. Reference for granting refunds:", ""),
-        ("6. Date of Commencement:", row['Date of Commencement'] if 'Date of Commencement' in row else ''),
-        ("7. Stipulated date of Completion:", row['Stipulated date of Completion'] if 'Stipulated date of Completion' in row else ''),
-        ("8. Actual Date of Completion:", row['Actual Date of Completion'] if 'Actual Date of Completion' in row else ''),
-        ("9. MB No.:", ""),
-        ("10. Date of Payment of final bill:", ""),
-        ("11. Date of Expiry of 3/6 months/DLP:", ""),
-        ("12. Was work satisfactory:", "Yes"),
-        ("13. Any tools outstanding against contractor:", "Nil"),
-        ("14. Any recovery due from contractor after payment of final bill:", "Nil"),
-        ("15. Extension of time limit sanctioned vide", ""),
-        ("16. Assistant Engineer Signature's Recommending refund", ""),
-        ("17. Accountant's Remarks", "")
-    ]
-    
-    for field_label, field_value in form_fields:
-        if field_label == "3. Name of Work:":
-            # Name of work spans A to E
-            ws.merge_cells(f'A{current_row}:E{current_row}')
-            ws[f'A{current_row}'] = f"{field_label} {field_value}"
-            ws[f'A{current_row}'].font = value_font
-            ws[f'A{current_row}'].alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
-        else:
-            # All other items: Label in A, Value in E (shifting from C to E)
-            ws[f'A{current_row}'] = field_label
-            ws[f'A{current_row}'].font = normal_font
-            ws[f'A{current_row}'].alignment = left_alignment
-            # No border for form fields A2 to A18
-            
-            ws[f'E{current_row}'] = field_value
-            ws[f'E{current_row}'].font = value_font
-            ws[f'E{current_row}'].alignment = left_alignment
-            ws[f'E{current_row}'].border = thin_border
-        
-        current_row += 1
-    
-    # No blank row between item 17 and 18
-    
-    # Security Deposit Details Table - corrected header
-    ws[f'A{current_row}'] = "18. Details of Security Deposit"
-    ws[f'A{current_row}'].font = header_font
-    ws[f'A{current_row}'].alignment = left_alignment
-    ws[f'A{current_row}'].border = thin_border
-    current_row += 1
-    
-    # Table headers - merge A and B, shift others to C, D, E
-    headers = ["Bill Type", "MB No.", "SD Type", "Amount (₹)"]
-    
-    # First header spans A and B
-    table_header_row = current_row
-    ws.merge_cells(f'A{current_row}:B{current_row}')
-    ws[f'A{current_row}'] = headers[0]
-    ws[f'A{current_row}'].font = header_font
-    ws[f'A{current_row}'].alignment = center_alignment
-    ws[f'A{current_row}'].border = thin_border
-    ws[f'A{current_row}'].fill = header_fill
-    
-    # Remaining headers in C, D, E
-    for col_idx, header in enumerate(headers[1:], 1):
-        col_letter = chr(67 + col_idx - 1)  # C, D, E
-        ws[f'{col_letter}{current_row}'] = header
-        ws[f'{col_letter}{current_row}'].font = header_font
-        ws[f'{col_letter}{current_row}'].alignment = center_alignment
-        ws[f'{col_letter}{current_row}'].border = thin_border
-        ws[f'{col_letter}{current_row}'].fill = header_fill
-    
-    current_row += 1
-    
-    # Enhanced table data rows - A-B merged, then C, D, E
-    table_data = [
-        ("", "", "", ""),  # Row 1 - empty for filling
-        ("", "", "", ""),  # Row 2 - empty for filling
-        ("", "", "", ""),  # Row 3 - empty for filling
-        ("", "", "", ""),  # Row 4 - empty for filling
-        ("", "", "", ""),  # Row 5 - empty for filling
-        ("Total:", "", "", "₹[Amount to be filled]")
-    ]
-    
-    for table_row in table_data:
-        # First column spans A and B
-        ws.merge_cells(f'A{current_row}:B{current_row}')
-        ws[f'A{current_row}'] = table_row[0]
-        ws[f'A{current_row}'].font = normal_font
-        ws[f'A{current_row}'].alignment = center_alignment
-        ws[f'A{current_row}'].border = thin_border
-        
-        # Remaining columns in C, D, E
-        for col_idx, value in enumerate(table_row[1:], 1):
-            col_letter = chr(67 + col_idx - 1)  # C, D, E
-            ws[f'{col_letter}{current_row}'] = value
-            ws[f'{col_letter}{current_row}'].font = normal_font
-            ws[f'{col_letter}{current_row}'].alignment = center_alignment
-            ws[f'{col_letter}{current_row}'].border = thin_border
-        current_row += 1
-    
-    # Ensure borders are correctly applied to A20:B26 (table header + 6 data rows)
-    # Based on the current layout, this corresponds to table_header_row through table_header_row + len(table_data)
-    for row_idx in range(table_header_row, table_header_row + len(table_data) + 1):
-        for col_letter in ('A', 'B'):
-            ws[f'{col_letter}{row_idx}'].border = thin_border
-
-    # Explicitly enforce borders on A20:B26 regardless of layout shifts
-    for row_idx in range(20, 27):
-        for col_letter in ('A', 'B'):
-            ws[f'{col_letter}{row_idx}'].border = thin_border
-    
-    # No blank rows after total
-    
-    # Certification section - no borders, proper formatting
-    certification_items = [
-        "Certified That:-",
-        "1. The Work has been completed as per G-schedule.",
-        "2. The work has been inspected by the undersigned as on and it stood satisfactory.",
-        "3. No Defect found during DLP Period.",
-        "4. The final time extension granted upto With/without compensation by the competent authority.",
-        "5. The defects pointed out by higher authorities or other authorized authorities during inspection etc have been removed by the contractor and compliance has been refund."
-    ]
-    
-    for cert_item in certification_items:
-        if cert_item.startswith("Certified That:-"):
-            ws[f'A{current_row}'] = cert_item
-            ws[f'A{current_row}'].font = header_font
-            ws[f'A{current_row}'].alignment = left_alignment
-        elif cert_item.startswith("5."):
-            # Special handling for point 5 - span columns A to E with wrap text and proper height
-            ws.merge_cells(f'A{current_row}:E{current_row}')
-            ws[f'A{current_row}'] = cert_item
-            ws[f'A{current_row}'].font = small_font
-            ws[f'A{current_row}'].alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
-            ws.row_dimensions[current_row].height = 26  # Set to 26 points as requested
-        else:
-            ws[f'A{current_row}'] = cert_item
-            ws[f'A{current_row}'].font = small_font
-            ws[f'A{current_row}'].alignment = left_alignment
-        current_row += 1
-    
-    # Signature section - no borders, proper layout
-    current_row += 1
-    
-    # Signature items with PWD Electric Div.- Udaipur below Executive Engineer - no blank rows
-    signature_items = [
-        ("Divisional Accountant", "Assistant Engineer", "Executive Engineer"),
-        ("", "", "PWD Electric Div.- Udaipur")  # Directly below Executive Engineer
-    ]
-    
-    for sig_row in signature_items:
-        for col_idx, sig_text in enumerate(sig_row):
-            col_letter = chr(65 + col_idx * 2)  # A, C, E (spacing between signatures)
-            if sig_text:  # Only write if there's text
-                ws[f'{col_letter}{current_row}'] = sig_text
-                ws[f'{col_letter}{current_row}'].font = normal_font
-                ws[f'{col_letter}{current_row}'].alignment = center_alignment
-                # No border for signature section
-        current_row += 1
-    
-    # Auto-adjust column widths with better formatting for wrapped text
-    column_widths = {'A': 30, 'B': 5, 'C': 25, 'D': 25, 'E': 25, 'F': 15, 'G': 15, 'H': 15}
-    for col, width in column_widths.items():
-        ws.column_dimensions[col].width = width
-    
-    # Set row heights for better appearance
-    for row_num in range(1, current_row + 5):
-        ws.row_dimensions[row_num].height = 20
-    
-    # Ensure certificate point 5 maintains its 26 point height (override general setting)
-    # Find the certificate point 5 row and set its height to 26
-    for row_num in range(1, current_row + 5):
-        cell_value = ws[f'A{row_num}'].value
-        if cell_value and str(cell_value).startswith("5."):
-            ws.row_dimensions[row_num].height = 26
-            break
-    
-    # Special case: Double the height of row 32 (~40 points)
-    ws.row_dimensions[32].height = 40
-    
-    # Setup default print layout for all sheets
-    setup_default_print_layout(ws)
-    
-    return ws
-
-def setup_default_print_layout(ws):
+    """Create sheet name from vendor and agreement number
+    
+    This is the name of one work on its own; a full run names every work at
+    once with sheet_naming.assign_sheet_names, which also tells repeats apart.
+    """
+    sheet_name = sheet_name_for(vendor, agreement_no)
+    logger.debug(f"Creating sheet: '{sheet_name}' from vendor: '{vendor}' and agreement: '{agreement_no}'")
+    return sheet_name
+
+def setup_default_print_layout(ws, last_row=None):
     """Setup default print layout for all sheets to fit on 1 page"""
+    from form_template import RWMF_119, apply_print_setup
     
     # Set print area to cover all content (A1 to E with last row)
-    # Find the last row with content
-    last_row = 0
-    for row_num in range(1, 50):  # Check up to row 50
-        if ws[f'A{row_num}'].value is not None:
-            last_row = row_num
-    
-    # Set print area to A1:E{last_row + 2} to ensure all content is included
-    print_area = f'A1:E{last_row + 2}'
-    ws.print_area = print_area
-    
-    # Set page setup for A4 portrait
-    ws.page_setup.paperSize = 9  # A4 paper size
-    ws.page_setup.orientation = 'portrait'
+    # Find the last row with content unless the caller already knows it
+    if last_row is None:
+        last_row = 0
+        for row_num in range(1, 50):  # Check up to row 50
+            if ws[f'A{row_num}'].value is not None:
+                last_row = row_num
     
-    # Set smaller margins to fit more content
-    ws.page_margins.left = 0.5
-    ws.page_margins.right = 0.5
-    ws.page_margins.top = 0.5
-    ws.page_margins.bottom = 0.5
-    ws.page_margins.header = 0.2
-    ws.page_margins.footer = 0.2
-    
-    # Set scaling to fit to 1 page wide and tall
-    ws.page_setup.fitToWidth = 1
-    ws.page_setup.fitToHeight = 1  # Fit to 1 page tall
-    
-    # Center the page horizontally
-    ws.print_options.horizontalCentered = True
-    
-    # Set header and footer
-    ws.oddHeader.center.text = "Security Deposit Refund Form"
-    ws.oddFooter.center.text = "Page &P of &N"
+    # A4 portrait, narrow margins, fit to 1 page, centered, with header/footer
+    apply_print_setup(ws, RWMF_119['print'], last_row)
 
-def create_security_refund_sheet(data_batch, batch_number, agreement_year=None):
-    """Create a security refund workbook with 25 separate sheets, one per work"""
+def create_security_refund_sheet(data_batch, batch_number, agreement_year=None, division=DEFAULT_DIVISION,
+                                 streaming=False, metrics=None, compact=False):
+    """Create a security refund workbook with 25 separate sheets, one per work
     
-    # Create a new workbook
-    wb = openpyxl.Workbook()
+    data_batch is a list of WorkRecords (a DataFrame is converted first).
+    With streaming=True the workbook is write-only: each sheet is emitted row
+    by row to a temporary file as it is rendered, so memory does not grow with
+    the number of works in the batch.
+    """
+    import openpyxl
+
+    from form_template import create_single_work_sheet
     
-    # Remove default sheet
-    wb.remove(wb.active)
+    if streaming:
+        wb = openpyxl.Workbook(write_only=True)
+    else:
+        # Create a new workbook
+        wb = openpyxl.Workbook()
+        
+        # Remove default sheet
+        wb.remove(wb.active)
     
     # Process each work in the batch and create a separate sheet
-    for work_idx, (_, row) in enumerate(data_batch.iterrows(), 1):
-        create_single_work_sheet(wb, row, work_idx)
+    for work_idx, record in enumerate(as_records(data_batch), 1):
+        create_single_work_sheet(wb, record, work_idx, division, metrics, compact)
     
     # Add VBA macro for print functionality
     add_print_macro(wb)
     
     return wb
 
+def write_security_refund_workbook(data_batch, filepath, division=DEFAULT_DIVISION, metrics=None, compact=False,
+                                   compress_level=None):
+    """Render a batch straight into an xlsx file, one sheet at a time
+    
+    Each sheet is streamed row by row and moved into the zip as soon as it is
+    finished, so peak memory stays flat however many works the batch holds.
+    """
+    import openpyxl
+
+    from form_template import create_single_work_sheet
+    from xlsx_stream import StreamingExcelWriter
+
+    wb = openpyxl.Workbook(write_only=True)
+    writer = StreamingExcelWriter(wb, filepath, compress_level)
+    try:
+        for work_idx, record in enumerate(as_records(data_batch), 1):
+            create_single_work_sheet(wb, record, work_idx, division, metrics, compact)
+            writer.flush()
+        writer.save()
+    except Exception:
+        writer.close()
+        os.remove(filepath)
+        raise
+
 def add_print_macro(wb):
     """Add VBA macro for print functionality"""
     
@@ -419,165 +160,944 @@ End Sub
     # Users can manually add this VBA code if they want advanced print control
 
 def split_data_into_batches(df, batch_size=25):
-    """Split dataframe into batches of specified size"""
-    batches = []
-    total_rows = len(df)
-    
-    for i in range(0, total_rows, batch_size):
-        batch = df.iloc[i:i+batch_size].copy()
-        batch_number = (i // batch_size) + 1
-        batches.append((batch, batch_number))
+    """Yield (batch, batch_number) slices of df of the specified size
     
-    return batches
+    The batches are views of df, made one at a time; nothing is copied.
+    """
+    for i in range(0, len(df), batch_size):
+        yield df.iloc[i:i+batch_size], (i // batch_size) + 1
 
 def get_agreement_year_from_data(df):
-    """Extract agreement year from the data for naming convention"""
+    """Extract agreement year from the data for naming convention
+    
+    The year of each row's agreement number is derived (see
+    validation.agreement_years) and the most common one is used.
+    """
+    from validation import agreement_years
+
     try:
-        # Try to extract year from Agreement No or Start Date
-        if 'Agreement No' in df.columns:
-            # Look for year pattern in agreement numbers
-            sample_agreement = str(df['Agreement No'].iloc[0]) if not df.empty else ''
-            if len(sample_agreement) >= 4:
-                # Try to find 4-digit year
-                for i in range(len(sample_agreement) - 3):
-                    year_candidate = sample_agreement[i:i+4]
-                    if year_candidate.isdigit() and 2000 <= int(year_candidate) <= 2030:
-                        return year_candidate
+        years = agreement_years(df).dropna()
+        if not years.empty:
+            return years.value_counts().index[0]
         
         # Fallback to current year
         return datetime.now().strftime('%Y')
-    except:
+    except Exception:
         return datetime.now().strftime('%Y')
 
 def read_work_data_from_txt(file_path):
-    """Read work order data from 355.txt file"""
+    """Read work order data from 355.txt file
+    
+    The export is parsed as a stream (see txt_reader); use
+    iter_work_orders_txt directly to consume the records one at a time.
+    """
+    import pandas as pd
+
+    from txt_reader import TXT_COLUMNS, iter_work_orders_txt
+
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-        
-        # The file is all on one line, so we need to split it properly
-        # Looking at the structure, each work order starts with a number followed by the work name
-        
-        import re
-        
-        # Split the content by work order numbers (1, 2, 3, etc.)
-        # Each work order starts with a number followed by the work description
-        work_entries = re.split(r'(?=\d+[A-Z])', content)
-        
-        works = []
-        for entry in work_entries:
-            if entry.strip():
-                # Extract work number (first digits)
-                work_num_match = re.match(r'^(\d+)', entry)
-                if work_num_match:
-                    work_num = work_num_match.group(1)
-                    
-                    # Extract work name (text after work number until vendor)
-                    work_name_match = re.search(r'^\d+([A-Z][^A-Z]*(?=[A-Z][a-zA-Z\s&]+(?:Enterprises|Electricals|Company|Ltd|Pvt|Traders|Suppliers|Engineering|Industries|Centre|Service)))', entry)
-                    work_name = work_name_match.group(1).strip() if work_name_match else entry[:50] + '...'
-                    
-                    # Extract vendor
-                    vendor_match = re.search(r'([A-Z][a-zA-Z\s&]+(?:Enterprises|Electricals|Company|Ltd|Pvt|Traders|Suppliers|Engineering|Industries|Centre|Service))', entry)
-                    vendor = vendor_match.group(1).strip() if vendor_match else ''
-                    
-                    # Extract WO No (5-6 digit number)
-                    wo_match = re.search(r'(\d{5,6})', entry)
-                    wo_no = wo_match.group(1) if wo_match else ''
-                    
-                    # Extract Agreement No (pattern like "71014/2022-23")
-                    agreement_match = re.search(r'(\d+[\/\s]*(?:of\s+)?\d{4}-\d{2,4})', entry)
-                    agreement_no = agreement_match.group(1) if agreement_match else ''
-                    
-                    # Extract dates (pattern like "(26/07/2022)")
-                    date_matches = re.findall(r'\((\d{2}\/\d{2}\/\d{4})\)', entry)
-                    start_date = date_matches[0] if len(date_matches) > 0 else ''
-                    comp_date = date_matches[1] if len(date_matches) > 1 else ''
-                    
-                    # Extract amounts (decimal numbers)
-                    amount_matches = re.findall(r'(\d+\.\d{2})', entry)
-                    amount_a = amount_matches[0] if len(amount_matches) > 0 else ''
-                    amount_b = amount_matches[1] if len(amount_matches) > 1 else ''
-                    
-                    # Extract ACD date (last date in the entry)
-                    acd_match = re.search(r'(\d{2}\/\d{2}\/\d{4})(?:\s*$)', entry)
-                    acd_date = acd_match.group(1) if acd_match else ''
-                    
-                    work_data = {
-                        'S.No': work_num,
-                        'WorkOrder Name': work_name,
-                        'Vendor': vendor,
-                        'WO No': wo_no,
-                        'Agreement No': agreement_no,
-                        'Start Date Serial': '',
-                        'Start Date': start_date,
-                        'Comp Date': comp_date,
-                        'Some Date Serial': '',
-                        'Amount_a': amount_a,
-                        'Amount_b': amount_b,
-                        'Amount_c': '',
-                        'Amount_d': '',
-                        'Actual date of completion ACD': acd_date
-                    }
-                    works.append(work_data)
-        
-        df = pd.DataFrame(works)
-        print(f"Successfully read {len(df)} works from {file_path}")
+        df = pd.DataFrame(iter_work_orders_txt(file_path), columns=TXT_COLUMNS)
+        logger.info(f"Successfully read {len(df)} works from {file_path}")
         return df
         
     except Exception as e:
-        print(f"Error reading text file: {e}")
+        logger.error(f"Error reading text file: {e}")
         return None
 
-def main():
-    """Main function to process Excel file and generate security refund sheets"""
+def generate_batch_file(batch_data, batch_idx, agreement_year, output_dir, division=DEFAULT_DIVISION,
+                        streaming=False, collect_metrics=False, compact=False, compress_level=None):
+    """Build and save one batch workbook, returning only its status, size and timings
     
-    excel_file = 'work_order_master.xlsx'
+    Runs in a worker process in parallel mode, so it must not return the workbook itself.
+    With collect_metrics the per-work and save events come back under 'metrics'.
+    compact and compress_level trade nothing visible for a smaller file.
+    """
+    from xlsx_stream import save_workbook
+
+    filepath = os.path.join(output_dir, batch_filename(batch_idx, agreement_year))
+    metrics = MetricsRecorder(enabled=collect_metrics, batch=batch_idx)
+    result = {'batch': batch_idx, 'path': filepath, 'works': len(batch_data),
+              'status': 'ok', 'render_seconds': 0.0, 'save_seconds': 0.0, 'bytes': 0,
+              'error': None, 'metrics': metrics.events}
+    try:
+        started = time.perf_counter()
+        if streaming:
+            # Rendering and writing are interleaved, so all time counts as render
+            write_security_refund_workbook(batch_data, filepath, division, metrics, compact, compress_level)
+            result['render_seconds'] = time.perf_counter() - started
+        else:
+            wb = create_security_refund_sheet(batch_data, batch_idx, agreement_year, division, metrics=metrics,
+                                              compact=compact)
+            rendered = time.perf_counter()
+            save_workbook(wb, filepath, compress_level)
+            result['render_seconds'] = rendered - started
+            result['save_seconds'] = time.perf_counter() - rendered
+        result['bytes'] = os.path.getsize(filepath)
+        metrics.record('save', result['save_seconds'], nbytes=result['bytes'])
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    return result
+
+def worker_pool(workers):
+    """Process pool whose workers log at the parent's level"""
+    return ProcessPoolExecutor(max_workers=workers, initializer=configure_logging,
+                               initargs=(logging.getLevelName(logger.getEffectiveLevel()),))
+
+def run_jobs(task, jobs, workers=1, executor=None):
+    """Run task(*job) for every job, in a process pool when workers > 1
     
-    print("Reading Excel file Work Orders...")
-    df = read_excel_data(excel_file, 'Work Orders')
+    Results come back in job order whatever order the workers finish in.
+    Jobs go to executor if one is given, and it is left running afterwards.
+    """
+    if executor is None and (workers <= 1 or len(jobs) <= 1):
+        for job in jobs:
+            logger.debug(f"Processing batch {job[1]} with {len(job[0])} works...")
+            yield task(*job)
+        return
     
-    if df is None:
-        print("Failed to read Excel file. Please check the file path and sheet name.")
+    if executor is None:
+        with worker_pool(workers) as executor:
+            yield from run_jobs(task, jobs, executor=executor)
+        return
+    futures = [executor.submit(task, *job) for job in jobs]
+    for future in futures:
+        yield future.result()
+
+def batch_jobs(batches, agreement_year, output_dir, division=DEFAULT_DIVISION, streaming=False,
+               collect_metrics=False, compact=False, compress_level=None):
+    """generate_batch_file arguments of every batch"""
+    return [(batch_data, batch_number, agreement_year, output_dir, division, streaming, collect_metrics,
+             compact, compress_level)
+            for batch_data, batch_number in batches]
+
+def run_batches(batches, agreement_year, output_dir, workers=1, division=DEFAULT_DIVISION, streaming=False,
+                collect_metrics=False, compact=False, compress_level=None):
+    """Generate every batch workbook, in a process pool when workers > 1"""
+    jobs = batch_jobs(batches, agreement_year, output_dir, division, streaming, collect_metrics, compact,
+                      compress_level)
+    return run_jobs(generate_batch_file, jobs, workers)
+
+def render_batch(job, division=DEFAULT_DIVISION, compact=False, collect_metrics=False):
+    """Pipeline stage: build the batch workbook in memory (job['workbook'])"""
+    metrics = MetricsRecorder(enabled=collect_metrics, batch=job['batch'])
+    started = time.perf_counter()
+    try:
+        job['workbook'] = create_security_refund_sheet(job.pop('records'), job['batch'], division=division,
+                                                       metrics=metrics, compact=compact)
+    except Exception as e:
+        job['status'] = 'error'
+        job['error'] = str(e)
+    job['render_seconds'] = time.perf_counter() - started
+    job['metrics'] = metrics.events
+    return job
+
+def serialize_batch(job, compress_level=None):
+    """Pipeline stage: compress the workbook into xlsx bytes (job['data'])"""
+    from xlsx_stream import save_workbook
+
+    if job['status'] != 'ok':
+        return job
+    started = time.perf_counter()
+    try:
+        buffer = BytesIO()
+        save_workbook(job.pop('workbook'), buffer, compress_level)
+        job['data'] = buffer.getvalue()
+    except Exception as e:
+        job['status'] = 'error'
+        job['error'] = str(e)
+    job['save_seconds'] = time.perf_counter() - started
+    return job
+
+def render_serialize_batch(job, division=DEFAULT_DIVISION, compact=False, compress_level=None,
+                           collect_metrics=False):
+    """Render and serialize a batch in one go, for a worker process"""
+    return serialize_batch(render_batch(job, division, compact, collect_metrics), compress_level)
+
+def write_batch(job):
+    """Pipeline stage: write the xlsx bytes to the batch file, replacing it atomically"""
+    if job['status'] == 'ok':
+        started = time.perf_counter()
+        data = job.pop('data')
+        tmp_path = job['path'] + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, job['path'])
+            job['bytes'] = len(data)
+        except Exception as e:
+            job['status'] = 'error'
+            job['error'] = str(e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        job['save_seconds'] += time.perf_counter() - started
+    job['metrics'].append({'stage': 'save', 'batch': job['batch'], 'work': None,
+                           'seconds': job['save_seconds'], 'bytes': job['bytes']})
+    return job
+
+def run_pipelined_batches(batches, agreement_year, output_dir, workers=1, division=DEFAULT_DIVISION,
+                          collect_metrics=False, compact=False, compress_level=None, depth=2, stats=None):
+    """Render, serialize and write batches as overlapping pipeline stages
+    
+    Yields one result per batch, in the shape generate_batch_file returns,
+    as each is written. Rendering and serializing run in this process unless
+    workers > 1; then `workers` render threads each hand whole batches to a
+    process pool and the render stage covers both. The per-stage counters
+    are appended to stats if a list is given.
+    """
+    from pipeline import Pipeline, PipelineStage
+
+    jobs = ({'batch': batch_number, 'path': os.path.join(output_dir, batch_filename(batch_number, agreement_year)),
+             'works': len(batch_data), 'records': batch_data, 'status': 'ok', 'render_seconds': 0.0,
+             'save_seconds': 0.0, 'bytes': 0, 'error': None, 'metrics': []}
+            for batch_data, batch_number in batches)
+    write = PipelineStage('write', write_batch)
+    if workers <= 1:
+        pipeline = Pipeline([PipelineStage('render', lambda job: render_batch(job, division, compact, collect_metrics)),
+                             PipelineStage('serialize', lambda job: serialize_batch(job, compress_level)),
+                             write], depth)
+        try:
+            yield from pipeline.run(jobs)
+        finally:
+            if stats is not None:
+                stats.extend(pipeline.stats())
+        return
+    
+    with worker_pool(workers) as executor:
+        def render_in_pool(job):
+            return executor.submit(render_serialize_batch, job, division, compact, compress_level,
+                                   collect_metrics).result()
+        pipeline = Pipeline([PipelineStage('render', render_in_pool, workers), write], depth)
+        try:
+            yield from pipeline.run(jobs)
+        finally:
+            if stats is not None:
+                stats.extend(pipeline.stats())
+
+def division_slug(division):
+    """File-name form of a division name"""
+    return re.sub(r'[^0-9A-Za-z]+', '_', division).strip('_')
+
+def write_pdf_batches(batches, agreement_year, output_dir, workers=1, division=DEFAULT_DIVISION, combine='batch'):
+    """Render batches to PDF across the pool and write one file per batch or one per division
+    
+    Workers return the pages of their batch; they are written here in batch
+    order, so a combined file has the works in master order.
+    Yields one result per batch with the PDF it went into.
+    """
+    from pdf_render import PdfWriter, render_batch_pages
+
+    jobs = [(batch_data, batch_number, division) for batch_data, batch_number in batches]
+    combined = None
+    if combine == 'division':
+        combined_path = os.path.join(output_dir, f"Security_Refund_{division_slug(division)}_{agreement_year}.pdf")
+        combined = PdfWriter(combined_path, title=f"Security Deposit Refunds - {division}")
+    try:
+        for result in run_jobs(render_batch_pages, jobs, workers):
+            if combined is not None:
+                writer = combined
+            else:
+                writer = PdfWriter(os.path.join(output_dir, f"Security_Refund_Batch_{result['batch']:02d}_{agreement_year}.pdf"),
+                                   title=f"Security Deposit Refunds - Batch {result['batch']}")
+            result['path'] = writer.path
+            if result['status'] == 'ok':
+                for page in result.pop('pages'):
+                    writer.add_page(page)
+                if writer is not combined:
+                    writer.close()
+            elif writer is not combined:
+                writer.abort()
+            yield result
+        if combined is not None:
+            combined.close()
+            combined = None
+    finally:
+        if combined is not None:
+            combined.abort()
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(
+        description="Generate security deposit refund sheets (RWMF 119)",
+        epilog="The master is validated first. If it has errors (see --validation-report) nothing is "
+               "generated and the exit status is 1; pass --allow-invalid to generate anyway. "
+               "The exit status is also 1 when the master cannot be read or a --lookup or "
+               "--reprint finds nothing.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes for batch generation (0 = one per CPU)")
+    parser.add_argument('--batch-size', type=int, default=25,
+                        help="number of works (sheets) per workbook")
+    parser.add_argument('--streaming', action='store_true',
+                        help="write sheets row by row in write-only mode to keep memory flat for large batches")
+    parser.add_argument('--compact', action='store_true',
+                        help="smaller workbooks: write only row and column sizes that differ from the sheet defaults")
+    parser.add_argument('--compress-level', type=int, choices=range(10), metavar='0-9',
+                        help="zip compression level of the workbooks (default 6; 9 is smallest)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="overlap rendering, zip compression and disk writes of successive batches")
+    parser.add_argument('--pipeline-depth', type=int, default=2,
+                        help="with --pipeline: batches that may wait between two stages")
+    parser.add_argument('--lazy', action='store_true',
+                        help="stream the master batch by batch straight into the pipeline, so the first workbook "
+                             "appears at once and memory does not grow with the master (needs --allow-invalid)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="keep works in stable batches keyed on agreement number and rebuild only changed batches")
+    parser.add_argument('--output-dir',
+                        help="output directory (default: timestamped, or Security_Refund_Sheets_<year> with --incremental)")
+    parser.add_argument('--master', default='work_order_master.xlsx',
+                        help="work order master: .xlsx, or a .csv/.parquet export with the same columns")
+    parser.add_argument('--masters', nargs='+', metavar='MASTER[=DIVISION]',
+                        help="instead of --master: several division masters in one run sharing the worker pool, "
+                             "each into its own folder; a directory stands for the masters in it, and a master "
+                             "without =DIVISION takes its file name as the division")
+    parser.add_argument('--division',
+                        help=f"division printed in the forms' footer (default: {DEFAULT_DIVISION})")
+    parser.add_argument('--master-sheet', default='Work Orders',
+                        help="sheet of an xlsx master to read (default: %(default)s)")
+    parser.add_argument('--master-backend', choices=BACKENDS, default='auto',
+                        help="reader for the master; auto picks by extension, and calamine for xlsx when installed")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always parse the master instead of using the parsed cache")
+    parser.add_argument('--format', choices=['xlsx', 'pdf'], default='xlsx',
+                        help="xlsx workbooks, or print-ready A4 PDFs rendered without Excel")
+    parser.add_argument('--pdf-combine', choices=['batch', 'division'], default='batch',
+                        help="with --format pdf: one PDF per batch, or one for the whole division")
+    parser.add_argument('--validate-only', action='store_true',
+                        help="check the master and write the validation report, without generating")
+    parser.add_argument('--allow-invalid', action='store_true',
+                        help="generate even if validation finds errors (by default the run stops "
+                             "with exit status 1 before building anything)")
+    parser.add_argument('--validation-report', default='security_refund_validation.csv',
+                        help="CSV the validation problems are written to (default: %(default)s)")
+    parser.add_argument('--agreement-year',
+                        help="year used in the file names (default: the most common agreement year; "
+                             "with --lazy, that of the first batch)")
+    parser.add_argument('--by-year', action='store_true',
+                        help="one output directory per agreement year (subdirectories of --output-dir if given)")
+    parser.add_argument('--dlp-months', type=int, default=DEFAULT_DLP_MONTHS,
+                        help="defect liability period after actual completion, for the register (default: %(default)s)")
+    parser.add_argument('--no-register', action='store_true',
+                        help="do not write the contractor/year register of pending refunds next to the batches")
+    parser.add_argument('--lookup', metavar='AGREEMENT_OR_CONTRACTOR',
+                        help="print the workbook and sheet of a form from a run's index instead of generating "
+                             "(searches --output-dir, or the newest Security_Refund_Sheets_* directory)")
+    parser.add_argument('--store', default=DEFAULT_STORE,
+                        help="SQLite store every xlsx run records its forms in (default: %(default)s)")
+    parser.add_argument('--reprint', metavar='AGREEMENT_NO',
+                        help="render one form again from the store into --output-dir (default: current directory) "
+                             "in --format, without reading the master")
+    parser.add_argument('--log-level', default='INFO', choices=LOG_LEVELS, type=str.upper,
+                        help="console detail; DEBUG adds a line per batch and per sheet")
+    parser.add_argument('--metrics-out',
+                        help="write per-stage, per-work timings to this file (.json or .csv)")
+    args = parser.parse_args(argv)
+    if args.format == 'pdf' and args.incremental:
+        parser.error("--incremental only applies to xlsx output")
+    if args.pipeline and (args.streaming or args.format == 'pdf'):
+        parser.error("--pipeline applies to xlsx output without --streaming")
+    if args.lazy:
+        conflicts = [flag for flag, used in (('--incremental', args.incremental), ('--by-year', args.by_year),
+                                             ('--streaming', args.streaming), ('--validate-only', args.validate_only),
+                                             ('--format pdf', args.format == 'pdf')) if used]
+        if conflicts:
+            parser.error(f"--lazy cannot be combined with {', '.join(conflicts)}")
+        if not args.allow_invalid:
+            parser.error("--lazy validates each batch as it is read and cannot stop before the first workbook; "
+                         "check the master with --validate-only first, then pass --allow-invalid")
+    if args.masters:
+        conflicts = [flag for flag, used in (('--lazy', args.lazy), ('--by-year', args.by_year),
+                                             ('--pipeline', args.pipeline), ('--format pdf', args.format == 'pdf'),
+                                             ('--division', args.division is not None)) if used]
+        if conflicts:
+            parser.error(f"--masters cannot be combined with {', '.join(conflicts)}")
+        if args.incremental and not args.output_dir:
+            parser.error("--masters with --incremental needs the --output-dir to rebuild")
+    args.division = args.division or DEFAULT_DIVISION
+    return args
+
+def find_lookup(output_dir=None):
+    """Lookup index of output_dir, or of the newest run directory that has one"""
+    from run_index import load_lookup
+
+    if output_dir:
+        candidates = [output_dir]
+    else:
+        candidates = sorted((name for name in os.listdir('.')
+                             if name.startswith('Security_Refund_Sheets_') and os.path.isdir(name)),
+                            key=os.path.getmtime, reverse=True)
+    for directory in candidates:
+        for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+            if name.startswith('Security_Refund_Index_') and name.endswith('.json'):
+                lookup = load_lookup(os.path.join(directory, name))
+                if lookup is not None:
+                    return directory, lookup
+    return None, None
+
+def lookup_forms(query, output_dir=None):
+    """Log where the forms for an agreement number or contractor are; False if none"""
+    from run_index import find_forms
+
+    directory, lookup = find_lookup(output_dir)
+    if lookup is None:
+        logger.error("No run index found; generate the sheets first or pass --output-dir.")
+        return False
+    entries = find_forms(lookup, query)
+    if not entries:
+        logger.error(f"No form for '{query}' in the index of '{directory}'.")
+        return False
+    for entry in entries:
+        logger.info(f"{entry['agreement_no']}  {entry['contractor']}: "
+                    f"{os.path.join(directory, entry['file'])} -> sheet '{entry['sheet']}'")
+    return True
+
+def reprint_form(agreement_no, store_path=DEFAULT_STORE, output_dir=None, fmt='xlsx'):
+    """Render the stored form(s) of an agreement number to files; the paths written"""
+    import openpyxl
+
+    from form_store import find_stored_forms, open_store, stored_record
+    from form_template import create_single_work_sheet
+    from pdf_render import PdfWriter, render_page
+    from xlsx_stream import save_workbook
+
+    if not os.path.exists(store_path):
+        logger.error(f"No form store at '{store_path}'; generate the sheets first.")
+        return []
+    with closing(open_store(store_path)) as connection:
+        rows = find_stored_forms(connection, agreement_no)
+    if not rows:
+        logger.error(f"No stored form for agreement '{agreement_no}'.")
+        return []
+    
+    output_dir = output_dir or '.'
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for row in rows:
+        record = stored_record(row)
+        slug = re.sub(r'[^0-9A-Za-z]+', '_', record.sheet_name).strip('_')
+        path = os.path.join(output_dir, f"Security_Refund_{slug}.{fmt}")
+        if fmt == 'pdf':
+            writer = PdfWriter(path, title=f"Security Deposit Refund - {record.agreement_no}")
+            writer.add_page(render_page(record._asdict(), row['division']))
+            writer.close()
+        else:
+            wb = openpyxl.Workbook()
+            wb.remove(wb.active)
+            create_single_work_sheet(wb, record, 1, row['division'])
+            save_workbook(wb, path)
+        logger.info(f"Reprinted {record.agreement_no} ({record.contractor}) from the run of "
+                    f"{row['updated_at']} into {path}")
+        paths.append(path)
+    return paths
+
+def log_pipeline_stats(pipeline_stats, metrics):
+    """Log the per-stage counters of a pipelined run and record each stage's stalls"""
+    if not pipeline_stats:
+        return
+    logger.info("Pipeline stages (busy / starved for input / stalled by the next stage, input queue depth):")
+    for stage in pipeline_stats:
+        logger.info(f"  {stage['stage']:<10} {stage['items']:>4} x  {stage['busy_seconds']:7.2f}s busy  "
+                    f"{stage['starved_seconds']:7.2f}s starved  {stage['stalled_seconds']:7.2f}s stalled  "
+                    f"queue max {stage['max_queue']}, mean {stage['mean_queue']:.1f}")
+        metrics.record(f"{stage['stage']} stall", stage['stalled_seconds'])
+
+def plan_outputs(df, agreement_year, output_dir, args, division=DEFAULT_DIVISION):
+    """Output directory, records and batches of df's run, worked out before anything is rendered"""
+    manifest = stale_files = None
+    if args.incremental:
+        # Reuse one output directory and rebuild only the batches whose works changed
+        output_dir = output_dir or f"Security_Refund_Sheets_{agreement_year}"
+        os.makedirs(output_dir, exist_ok=True)
+        batches, manifest, stale_files = plan_incremental_batches(df, output_dir, agreement_year, args.batch_size,
+                                                                  division, compact=args.compact)
+        logger.info(f"{len(batches)} of {len(manifest['batches'])} batches changed since the last run")
+    else:
+        # Create output directory with timestamp to avoid permission issues
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_dir = output_dir or f"Security_Refund_Sheets_{agreement_year}_{timestamp}"
+        os.makedirs(output_dir, exist_ok=True)
+    
+    # Each work becomes a compact record once, here; workers only ever see records
+    records = work_records(df)
+    if args.incremental:
+        batches = [([records[pos] for pos in df.index.get_indexer(batch.index)], batch_number)
+                   for batch, batch_number in batches]
+    else:
+        # Consecutive runs of records, without slicing the frame
+        batches = [(records[start:start + args.batch_size], start // args.batch_size + 1)
+                   for start in range(0, len(records), args.batch_size)]
+        logger.info(f"Created {len(batches)} batches")
+    return {'df': df, 'agreement_year': agreement_year, 'output_dir': output_dir, 'division': division,
+            'records': records, 'batches': batches, 'manifest': manifest, 'stale_files': stale_files}
+
+def finish_outputs(plan, results, args, metrics, keys=None, pipeline_stats=()):
+    """Log the plan's batch results as they come, then save its manifest, index, register and store rows
+    
+    keys are the works' keys in the form store (work_keys of the plan's
+    works by default).
+    """
+    from form_store import open_store, upsert_forms
+    from run_index import index_entries, write_run_index
+    from summary_register import work_status
+
+    df, agreement_year, output_dir = plan['df'], plan['agreement_year'], plan['output_dir']
+    manifest = plan['manifest']
+    started = time.perf_counter()
+    failed = total_bytes = total_sheets = 0
+    for result in results:
+        metrics.extend(result['metrics'])
+        if result['status'] == 'ok':
+            total_bytes += result['bytes']
+            total_sheets += result['works']
+            logger.info(f"Saved: {result['path']} ({result['works']} works, "
+                        f"render {result['render_seconds']:.2f}s, save {result['save_seconds']:.2f}s, "
+                        f"{result['bytes'] / 1024:.1f} KB, {result['bytes'] // max(result['works'], 1)} bytes/sheet)")
+        else:
+            failed += 1
+            logger.error(f"Failed: {result['path']}: {result['error']}")
+            if args.incremental:
+                # Forget the hashes so the next run retries this batch
+                for key in manifest['batches'][str(result['batch'])]['works']:
+                    manifest['works'][key]['hash'] = None
+    elapsed = time.perf_counter() - started
+    
+    if args.incremental:
+        for filename in plan['stale_files']:
+            stale_path = os.path.join(output_dir, filename)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+                logger.info(f"Removed empty batch: {stale_path}")
+        save_manifest(output_dir, manifest)
+    
+    # Index and store every work, including those in batches this run left alone
+    records = plan['records']
+    if args.incremental:
+        batch_numbers = [manifest['works'][key]['batch'] for key in work_keys(df)]
+    else:
+        batch_numbers = [pos // args.batch_size + 1 for pos in range(len(df))]
+    entries = index_entries(records, batch_numbers, lambda number: batch_filename(number, agreement_year))
+    index_workbook, _ = write_run_index(entries, output_dir, agreement_year)
+    logger.info(f"Index of all {len(entries)} works: {index_workbook}")
+    if not args.no_register:
+        with metrics.time('register'):
+            status = work_status(df, datetime.now().date(), args.dlp_months)
+        write_summary(status, entries, output_dir, agreement_year, args)
+    with closing(open_store(args.store)) as connection:
+        stored = upsert_forms(connection, work_keys(df) if keys is None else keys, records,
+                              [entry['file'] for entry in entries], plan['division'], output_dir)
+    logger.info(f"Recorded {stored} forms in {args.store}")
+    
+    logger.info(f"\nCompleted! Generated {len(plan['batches']) - failed} security refund workbooks in '{output_dir}' directory in {elapsed:.2f}s.")
+    log_pipeline_stats(pipeline_stats, metrics)
+    if total_sheets:
+        logger.info(f"Output: {total_bytes / 1024:.1f} KB for {total_sheets} sheets, "
+                    f"{total_bytes // total_sheets} bytes/sheet")
+    if failed:
+        logger.warning(f"{failed} batch(es) failed; see messages above.")
+
+def generate_outputs(df, agreement_year, output_dir, args, workers, metrics, division=DEFAULT_DIVISION):
+    """Generate, index and store the forms of df as one run's output (one output directory)"""
+    plan = plan_outputs(df, agreement_year, output_dir, args, division)
+    batches, output_dir = plan['batches'], plan['output_dir']
+    
+    # Generate security refund sheets for each batch
+    if workers > 1:
+        logger.info(f"Generating in parallel with {workers} worker processes...")
+    if args.format == 'pdf':
+        started = time.perf_counter()
+        failed = 0
+        for result in write_pdf_batches(batches, agreement_year, output_dir, workers, division,
+                                         combine=args.pdf_combine):
+            if result['status'] == 'ok':
+                logger.info(f"Rendered batch {result['batch']} ({result['works']} pages) into {result['path']}")
+            else:
+                failed += 1
+                logger.error(f"Failed: batch {result['batch']}: {result['error']}")
+        logger.info(f"\nCompleted! Rendered {len(df)} forms to PDF in '{output_dir}' in "
+                    f"{time.perf_counter() - started:.2f}s.")
+        if failed:
+            logger.warning(f"{failed} batch(es) failed; see messages above.")
         return
     
-    print(f"Total works found: {len(df)}")
+    pipeline_stats = []
+    if args.pipeline:
+        results = run_pipelined_batches(batches, agreement_year, output_dir, workers, division,
+                                        collect_metrics=metrics.enabled, compact=args.compact,
+                                        compress_level=args.compress_level, depth=args.pipeline_depth,
+                                        stats=pipeline_stats)
+    else:
+        results = run_batches(batches, agreement_year, output_dir, workers, division, streaming=args.streaming,
+                              collect_metrics=metrics.enabled, compact=args.compact,
+                              compress_level=args.compress_level)
+    finish_outputs(plan, results, args, metrics, pipeline_stats=pipeline_stats)
+
+def write_summary(status, entries, output_dir, agreement_year, args):
+    """Write the run's register of pending refunds from its works' status"""
+    from summary_register import register_path, write_register
+
+    path = write_register(status, {entry['sheet']: entry['file'] for entry in entries},
+                          register_path(output_dir, agreement_year), datetime.now().date(), args.dlp_months)
+    logger.info(f"Register of pending refunds by contractor and year: {path} "
+                f"({int(status['refund_due'].sum())} past DLP expiry, {int(status['late'].sum())} completed late)")
+
+def store_forms(connection, unstored, entries, output_dir, division=DEFAULT_DIVISION):
+    """Upsert the (keys, records) of finished batches in one transaction and forget them
     
-    # Get agreement year for naming
-    agreement_year = get_agreement_year_from_data(df)
-    print(f"Using agreement year: {agreement_year}")
+    Their index entries are the last ones in entries.
+    """
+    from form_store import upsert_forms
+
+    keys = [key for batch_keys, _ in unstored for key in batch_keys]
+    records = [record for _, batch_records in unstored for record in batch_records]
+    if keys:
+        upsert_forms(connection, keys, records, [entry['file'] for entry in entries[len(entries) - len(keys):]],
+                     division, output_dir)
+    unstored.clear()
+
+def generate_lazy(args, workers, metrics):
+    """Stream the master into batch workbooks, rendering each batch as soon as it is read
     
-    # Split data into batches
-    batches = split_data_into_batches(df, 25)
-    print(f"Created {len(batches)} batches")
+    The master is never held whole: it is read a block of whole batches at
+    a time and each batch goes through the render/serialize/write pipeline
+    while the rest are read. Sheet names and work keys are settled block by
+    block, carrying over what earlier blocks took, so they match a full
+    run; each block is validated and each batch's forms stored as it passes.
+    Only a small index entry and status row per work are kept, for the run's
+    index and register at the end.
+    """
+    import pandas as pd
+
+    from form_store import open_store
+    from run_index import index_entries, write_run_index
+    from summary_register import work_status
+    from validation import summarize, validate_master
+
+    # Whole batches per block; validating a block costs about the same as one batch
+    block_rows = args.batch_size * max(1, LAZY_BLOCK_ROWS // args.batch_size)
+    chunks = iter_master_chunks(args.master, args.master_sheet, block_rows, backend=args.master_backend)
+    started = time.perf_counter()
+    try:
+        with metrics.time('read'):
+            first = next(chunks, None)
+    except (ImportError, OSError, ValueError) as e:
+        logger.error(f"Error reading master {args.master}: {e}")
+        return False
+    if first is None:
+        logger.error("The master has no works.")
+        return False
     
-    # Create output directory with timestamp to avoid permission issues
-    from datetime import datetime
+    # The file names need a year before the rest of the master has been read
+    agreement_year = args.agreement_year or get_agreement_year_from_data(first)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_dir = f"Security_Refund_Sheets_{agreement_year}_{timestamp}"
+    output_dir = args.output_dir or f"Security_Refund_Sheets_{agreement_year}_{timestamp}"
     os.makedirs(output_dir, exist_ok=True)
+    logger.info(f"Streaming {args.master} in batches of {args.batch_size} into '{output_dir}' "
+                f"(agreement year {agreement_year})")
     
-    # Generate security refund sheets for each batch
-    for batch_idx, (batch_data, batch_number) in enumerate(batches, 1):
-        print(f"Processing batch {batch_idx} with {len(batch_data)} works...")
+    taken, seen = set(), {}
+    pending = {}
+    problems = {}
+    statuses = []
+    
+    def batches():
+        batch_number = 0
+        for chunk in itertools.chain([first], chunks):
+            report = validate_master(chunk)
+            if not report.empty:
+                report.assign(row=report['row'] + 2).to_csv(args.validation_report, index=False,
+                                                            mode='a' if problems else 'w', header=not problems)
+                for severity, problem, count in summarize(report):
+                    problems[severity, problem] = problems.get((severity, problem), 0) + count
+            chunk[SHEET_NAME_COLUMN] = unique_names(base_sheet_names(chunk).tolist(), taken)
+            if not args.no_register:
+                statuses.append(work_status(chunk, datetime.now().date(), args.dlp_months))
+            records = work_records(chunk)
+            keys = work_keys(chunk, seen)
+            for start in range(0, len(records), args.batch_size):
+                batch_number += 1
+                end = start + args.batch_size
+                pending[batch_number] = (keys[start:end], records[start:end])
+                yield records[start:end], batch_number
+    
+    filename = lambda number: batch_filename(number, agreement_year)
+    entries = []
+    unstored = []
+    written = failed = total_bytes = 0
+    pipeline_stats = []
+    # With several workers batches finish out of order; they are indexed and
+    # stored in batch order, as a full run lists them
+    finished = {}
+    next_batch = 1
+    with closing(open_store(args.store)) as connection:
+        for result in run_pipelined_batches(batches(), agreement_year, output_dir, workers, args.division,
+                                            collect_metrics=metrics.enabled, compact=args.compact,
+                                            compress_level=args.compress_level, depth=args.pipeline_depth,
+                                            stats=pipeline_stats):
+            if not written:
+                logger.info(f"First workbook written {time.perf_counter() - started:.2f}s after starting")
+                metrics.record('first output', time.perf_counter() - started)
+            written += 1
+            metrics.extend(result['metrics'])
+            if result['status'] == 'ok':
+                total_bytes += result['bytes']
+                logger.info(f"Saved: {result['path']} ({result['works']} works, "
+                            f"{result['bytes'] / 1024:.1f} KB)")
+            else:
+                failed += 1
+                logger.error(f"Failed: {result['path']}: {result['error']}")
+            finished[result['batch']] = pending.pop(result['batch'])
+            while next_batch in finished:
+                keys, records = finished.pop(next_batch)
+                entries.extend(index_entries(records, [next_batch] * len(records), filename))
+                unstored.append((keys, records))
+                next_batch += 1
+            if sum(len(keys) for keys, _ in unstored) >= block_rows:
+                store_forms(connection, unstored, entries, output_dir, args.division)
+        store_forms(connection, unstored, entries, output_dir, args.division)
+    elapsed = time.perf_counter() - started
+    
+    index_workbook, _ = write_run_index(entries, output_dir, agreement_year)
+    logger.info(f"Index of all {len(entries)} works: {index_workbook}")
+    if statuses:
+        write_summary(pd.concat(statuses), entries, output_dir, agreement_year, args)
+    logger.info(f"Recorded {len(entries)} forms in {args.store}")
+    if problems:
+        logger.info(f"Validation, block by block (repeated agreement numbers are only caught within "
+                    f"{block_rows} rows):")
+        for (severity, problem), count in sorted(problems.items()):
+            logger.info(f"  {severity:<8} {count:>5} x {problem}")
+        logger.info(f"Validation report (Excel row numbers) written to {args.validation_report}")
+    logger.info(f"\nCompleted! Generated {written - failed} security refund workbooks in '{output_dir}' "
+                f"directory in {elapsed:.2f}s.")
+    log_pipeline_stats(pipeline_stats, metrics)
+    if entries:
+        logger.info(f"Output: {total_bytes / 1024:.1f} KB for {len(entries)} sheets, "
+                    f"{total_bytes // len(entries)} bytes/sheet")
+    if failed:
+        logger.warning(f"{failed} batch(es) failed; see messages above.")
+    return True
+
+def check_master(df, args, metrics=None):
+    """Validate the master, log and write the problems found; False if the run should stop"""
+    from validation import summarize, validate_master
+
+    metrics = metrics or _NO_METRICS
+    with metrics.time('validate'):
+        report = validate_master(df)
+    errors = int((report['severity'] == 'error').sum())
+    if report.empty:
+        logger.info("Validation: no problems found")
+        return True
+    
+    logger.info(f"Validation: {errors} error(s), {len(report) - errors} warning(s)")
+    for severity, problem, count in summarize(report):
+        logger.info(f"  {severity:<8} {count:>5} x {problem}")
+    for row in report[report['severity'] == 'error'].head(10).itertuples():
+        logger.error(f"  row {row.row + 2}: {row.column}: {row.problem} ({row.value!r})")
+    report.assign(row=report['row'] + 2).to_csv(args.validation_report, index=False)
+    logger.info(f"Validation report (Excel row numbers) written to {args.validation_report}")
+    
+    if errors and not args.allow_invalid:
+        logger.error("Stopping before any workbook is built; fix the master or pass --allow-invalid.")
+        return False
+    return True
+
+def generate_all(args, workers, metrics):
+    """Read, check and name the whole master, then generate its outputs; False if the run stopped"""
+    from validation import agreement_years
+
+    logger.info(f"Reading master {args.master}...")
+    with metrics.time('read'):
+        df = read_excel_data(args.master, args.master_sheet, use_cache=not args.no_cache,
+                             backend=args.master_backend)
+    
+    if df is None:
+        logger.error("Failed to read the master. Please check the file path and sheet name.")
+        return False
+    
+    logger.info(f"Total works found: {len(df)}")
+    
+    # Check the whole master before building anything
+    if not check_master(df, args, metrics):
+        return False
+    if args.validate_only:
+        return True
+    
+    # Every sheet name is settled before any batch is rendered
+    name_sheets(df, metrics)
+    
+    if args.by_year:
+        # One output per agreement year; works without a year go with the most common one
+        years = agreement_years(df).fillna(get_agreement_year_from_data(df))
+        for agreement_year, year_df in df.groupby(years, sort=True):
+            logger.info(f"\nAgreement year {agreement_year}: {len(year_df)} works")
+            output_dir = os.path.join(args.output_dir, agreement_year) if args.output_dir else None
+            generate_outputs(year_df, agreement_year, output_dir, args, workers, metrics, args.division)
+    else:
+        # Get agreement year for naming
+        agreement_year = args.agreement_year or get_agreement_year_from_data(df)
+        logger.info(f"Using agreement year: {agreement_year}")
+        generate_outputs(df, agreement_year, args.output_dir, args, workers, metrics, args.division)
+    return True
+
+def division_masters(specs):
+    """(master path, division) of every --masters entry, with directories expanded
+    
+    An entry is PATH or PATH=DIVISION; a master without a division takes its
+    file name as one.
+    """
+    masters = []
+    for spec in specs:
+        path, _, division = spec.partition('=')
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path)
+                           if os.path.splitext(name)[1].lower() in MASTER_EXTENSIONS and not name.startswith('~$')
+                           and os.path.isfile(os.path.join(path, name)))
+            if not names:
+                logger.warning(f"No master in directory {path}")
+            masters.extend((os.path.join(path, name), division or os.path.splitext(name)[0]) for name in names)
+        else:
+            masters.append((path, division or os.path.splitext(os.path.basename(path))[0]))
+    return masters
+
+def listed_works(df):
+    """(agreement, contractor) of each work as compared across divisions; None without an agreement number"""
+    from run_index import normalize_contractor
+
+    agreements = df[FIELD_COLUMNS['agreement_no']] if FIELD_COLUMNS['agreement_no'] in df.columns else [None] * len(df)
+    contractors = df[FIELD_COLUMNS['contractor']] if FIELD_COLUMNS['contractor'] in df.columns else [''] * len(df)
+    return [None if is_blank(agreement) else
+            (normalize_agreement(agreement), normalize_contractor('' if is_blank(contractor) else contractor))
+            for agreement, contractor in zip(agreements, contractors)]
+
+def generate_divisions(args, workers, metrics):
+    """Generate the outputs of several division masters in one run over one process pool
+    
+    The masters are read side by side in the pool, then each is checked and
+    named on its own. A work an earlier division already lists (same
+    agreement number and contractor) is left to that division; agreement
+    numbers repeated across divisions otherwise get '#2', '#3', ... keys, so
+    each work keeps a row of its own in the form store. The batches of every
+    division then go to the pool together, and each division's results are
+    collected in turn into its own folder under the run's output directory.
+    False if the run stopped.
+    """
+    masters = division_masters(args.masters)
+    slugs = [division_slug(division) for _, division in masters]
+    if not masters:
+        logger.error("No division master to read.")
+        return False
+    shared = sorted({slug for slug in slugs if slugs.count(slug) > 1})
+    if shared:
+        logger.error(f"Masters would share the output folder(s) {', '.join(shared)}; "
+                     "give each its own division with MASTER=DIVISION.")
+        return False
+    
+    started = time.perf_counter()
+    with worker_pool(workers) if workers > 1 else nullcontext() as pool:
+        logger.info(f"Reading {len(masters)} division masters...")
+        with metrics.time('read'):
+            reads = [(path, args.master_sheet, not args.no_cache, args.master_backend) for path, _ in masters]
+            if pool is not None:
+                futures = [pool.submit(read_excel_data, *read) for read in reads]
+                frames = [future.result() for future in futures]
+            else:
+                frames = [read_excel_data(*read) for read in reads]
         
-        # Create security refund sheet
-        wb = create_security_refund_sheet(batch_data, batch_idx, agreement_year)
+        # Every master is checked before anything is built
+        division_args = []
+        checked = True
+        for (path, division), slug, df in zip(masters, slugs, frames):
+            if df is None:
+                logger.error(f"Failed to read the master {path}. Please check the file path and sheet name.")
+                return False
+            logger.info(f"\n{division}: {len(df)} works in {path}")
+            own_args = copy.copy(args)
+            base, extension = os.path.splitext(args.validation_report)
+            own_args.validation_report = f"{base}_{slug}{extension}"
+            division_args.append(own_args)
+            checked = check_master(df, own_args, metrics) and checked
+        if not checked:
+            return False
+        if args.validate_only:
+            return True
         
-        # Save the file
-        filename = f"Security_Refund_Batch_{batch_idx:02d}_{agreement_year}.xlsx"
-        filepath = os.path.join(output_dir, filename)
-        wb.save(filepath)
+        output_root = args.output_dir or f"Security_Refund_Sheets_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        listed, seen = {}, {}
+        plans = []
+        for (path, division), slug, df, own_args in zip(masters, slugs, frames, division_args):
+            works = listed_works(df)
+            elsewhere = [work is not None and listed.get(work, division) != division for work in works]
+            if any(elsewhere):
+                for work, earlier in zip(works, elsewhere):
+                    if earlier:
+                        logger.debug(f"{division}: agreement '{work[0]}' of '{work[1]}' is already listed "
+                                     f"by {listed[work]}")
+                logger.info(f"{division}: {sum(elsewhere)} work(s) already listed by an earlier division; left to it")
+                df = df[[not earlier for earlier in elsewhere]].reset_index(drop=True)
+            for work in works:
+                if work is not None:
+                    listed.setdefault(work, division)
+            if df.empty:
+                logger.warning(f"{division}: no works left to generate")
+                continue
+            
+            logger.info(f"\n{division}:")
+            name_sheets(df, metrics)
+            agreement_year = args.agreement_year or get_agreement_year_from_data(df)
+            plan = plan_outputs(df, agreement_year, os.path.join(output_root, slug), own_args, division)
+            plans.append((plan, work_keys(df, seen), own_args))
         
-        print(f"Saved: {filepath}")
+        jobs = [job for plan, _, _ in plans
+                for job in batch_jobs(plan['batches'], plan['agreement_year'], plan['output_dir'], plan['division'],
+                                      args.streaming, metrics.enabled, args.compact, args.compress_level)]
+        logger.info(f"\nGenerating {len(jobs)} batches of {len(plans)} divisions"
+                    + (f" in parallel with {workers} worker processes..." if pool else "..."))
+        results = run_jobs(generate_batch_file, jobs, workers, pool)
+        for plan, keys, own_args in plans:
+            logger.info(f"\n{plan['division']} ({plan['agreement_year']}):")
+            finish_outputs(plan, itertools.islice(results, len(plan['batches'])), own_args, metrics, keys)
+    
+    logger.info(f"\nAll {len(plans)} divisions generated into '{output_root}' in {time.perf_counter() - started:.2f}s.")
+    return True
+
+def main(argv=None):
+    """Main function to process Excel file and generate security refund sheets"""
+    
+    args = parse_args(argv)
+    configure_logging(args.log_level)
+    if args.lookup:
+        return 0 if lookup_forms(args.lookup, args.output_dir) else 1
+    if args.reprint:
+        return 0 if reprint_form(args.reprint, args.store, args.output_dir, args.format) else 1
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    metrics = MetricsRecorder(enabled=bool(args.metrics_out))
+    
+    if args.masters:
+        generated = generate_divisions(args, workers, metrics)
+    elif args.lazy:
+        generated = generate_lazy(args, workers, metrics)
+    else:
+        generated = generate_all(args, workers, metrics)
+    if not generated:
+        # Nothing was built: a batch file or CI job has to see the run fail
+        return 1
+    if args.validate_only:
+        return 0
     
-    print(f"\nCompleted! Generated {len(batches)} security refund workbooks in '{output_dir}' directory.")
-    print("Each workbook contains:")
-    print("- 25 separate sheets (one per work order)")
-    print("- Sheet names: First name of contractor + agreement number")
-    print("- Enhanced formatting with elegant borders and professional styling")
-    print("- Default 'Satisfactory' status for security refund")
-    print("- All relevant work order data")
-    print("- Print-ready format with proper spacing and alignment")
+    if metrics.enabled:
+        metrics.log_summary()
+        metrics.write(args.metrics_out)
+        logger.info(f"Metrics written to {args.metrics_out}")
+    if args.format == 'pdf':
+        return 0
+    logger.info("Each workbook contains:")
+    logger.info(f"- Up to {args.batch_size} separate sheets (one per work order)")
+    logger.info("- Sheet names: First name of contractor + agreement number")
+    logger.info("- Enhanced formatting with elegant borders and professional styling")
+    logger.info("- Default 'Satisfactory' status for security refund")
+    logger.info("- All relevant work order data")
+    logger.info("- Print-ready format with proper spacing and alignment")
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""Sheet names for every work, decided once over the whole master.
+
+A sheet is named after the contractor's first word and the agreement
+number's prefix, e.g. 'Abhinav 104' for Abhinav Engineering, 104/2020-21.
+``assign_sheet_names`` builds those names for the whole table with
+vectorized string operations, applies Excel's rules (at most 31 characters,
+none of ``\\ / * ? : [ ]``, no leading or trailing apostrophe) and then makes
+them unique: Excel compares sheet names case-insensitively, so a repeated
+name gets ' (2)', ' (3)', ... in master order. The result is a complete
+name map before any sheet is rendered, the same whatever the batching.
+"""
+import re
+
+from instrumentation import MetricsRecorder, logger
+
+MAX_SHEET_NAME = 31
+SHEET_NAME_COLUMN = 'Sheet Name'
+
+# 'M/s', 'M/s.', 'M/S ' and the like in front of a firm name
+_FIRM_PREFIX = re.compile(r'^\s*M\s*/\s*s\b\.?\s*', re.IGNORECASE)
+_INVALID = re.compile(r"[\\/*?:\[\]]")
+
+
+def is_blank(value):
+    """True for None, NaN and pandas' NaT/NA, checked without importing pandas"""
+    if value is None or isinstance(value, str):
+        return value is None
+    try:
+        # NaN and NaT are the only values that differ from themselves
+        return bool(value != value)
+    except TypeError:
+        # pd.NA has no truth value
+        return True
+
+
+def strip_firm_prefix(name):
+    """'M/s Abhinav Engineering' -> 'Abhinav Engineering'"""
+    return _FIRM_PREFIX.sub('', name)
+
+
+def _agreement_prefix(agreement):
+    """'104/2020-21' -> '104', '2019-20' -> '2019', anything else unchanged"""
+    if '/' in agreement:
+        return agreement.split('/')[0]
+    if '-' in agreement:
+        return agreement.split('-')[0]
+    return agreement
+
+
+def _finish(name, agreement_prefix):
+    name = _INVALID.sub('', name)[:MAX_SHEET_NAME].strip().strip("'")
+    if not name:
+        name = _INVALID.sub('', f"Work_{agreement_prefix}")[:MAX_SHEET_NAME]
+    return name
+
+
+def sheet_name_for(vendor, agreement_no):
+    """Base sheet name of one work (before duplicates are told apart)"""
+    vendor = '' if is_blank(vendor) else str(vendor)
+    agreement = '' if is_blank(agreement_no) else str(agreement_no)
+    words = strip_firm_prefix(vendor.strip()).split()
+    prefix = _agreement_prefix(agreement.strip())
+    return _finish(f"{words[0] if words else 'Unknown'} {prefix}", prefix)
+
+
+def base_sheet_names(df):
+    """Base sheet name per row, computed column-wise (same rules as sheet_name_for)"""
+    import pandas as pd
+
+    def column(name):
+        if name not in df.columns:
+            return pd.Series('', index=df.index, dtype=object)
+        return df[name].astype(object).where(df[name].notna(), '').astype(str).str.strip()
+
+    first_words = (column('Name of Contractor').str.replace(_FIRM_PREFIX, '', regex=True)
+                   .str.split().str[0].fillna('Unknown'))
+
+    agreements = column('Agreement No.')
+    prefixes = agreements.where(
+        ~agreements.str.contains('/', regex=False), agreements.str.split('/').str[0])
+    prefixes = prefixes.where(
+        agreements.str.contains('/', regex=False) | ~agreements.str.contains('-', regex=False),
+        agreements.str.split('-').str[0])
+
+    names = ((first_words + ' ' + prefixes).str.replace(_INVALID, '', regex=True)
+             .str[:MAX_SHEET_NAME].str.strip().str.strip("'"))
+    fallback = ('Work_' + prefixes).str.replace(_INVALID, '', regex=True).str[:MAX_SHEET_NAME]
+    return names.where(names != '', fallback)
+
+
+def unique_names(names, taken=None):
+    """Make names unique ignoring case, in order: repeats get ' (2)', ' (3)', ...
+
+    One pass with a hash index of the names taken so far; a suffixed name
+    that happens to equal a later base name moves that one on in turn.
+    Passing the same taken set with each chunk of a master names the chunks
+    exactly as the whole master would be named.
+    """
+    taken = set() if taken is None else taken
+    next_suffix = {}
+    result = []
+    for name in names:
+        key = name.casefold()
+        if key in taken:
+            base = name
+            counter = next_suffix.get(key, 2)
+            while True:
+                suffix = f" ({counter})"
+                name = base[:MAX_SHEET_NAME - len(suffix)].rstrip() + suffix
+                counter += 1
+                if name.casefold() not in taken:
+                    break
+            next_suffix[key] = counter
+            key = name.casefold()
+        taken.add(key)
+        result.append(name)
+    return result
+
+
+def assign_sheet_names(df, taken=None):
+    """Unique, Excel-valid sheet name per row of the master, as a Series on df's index"""
+    import pandas as pd
+
+    return pd.Series(unique_names(base_sheet_names(df).tolist(), taken), index=df.index, dtype=object)
+
+
+def name_sheets(df, metrics=None):
+    """Add the sheet name of every work to df, decided once over the whole master
+
+    Names are unique ignoring case, so no batch meets a clash while rendering.
+    """
+    metrics = metrics or MetricsRecorder(enabled=False)
+    with metrics.time('naming'):
+        base_names = base_sheet_names(df)
+        df[SHEET_NAME_COLUMN] = unique_names(base_names.tolist())
+    renamed = int((df[SHEET_NAME_COLUMN] != base_names).sum())
+    if renamed:
+        logger.info(f"{renamed} work(s) share a sheet name with an earlier work; numbered (2), (3), ...")
+    return df
@@ -0,0 +1,163 @@
+"""One work's refund form straight from the master, without pandas.
+
+For the small scheduled jobs that want a single form, loading pandas and
+parsing the whole master into a DataFrame costs more than the form itself.
+Here the master is scanned row by row instead (openpyxl's read-only mode
+for xlsx, the csv module for CSV) and only the rows of the agreement asked
+for are turned into records. Sheet names still follow the master-wide
+rules, so a form is named exactly as in a full run.
+
+    python single_form.py 104/2020-21 --master work_order_master.xlsx
+    python single_form.py 104/2020-21 --format pdf --output-dir reprints
+"""
+import argparse
+import csv
+import os
+import re
+import sys
+
+import openpyxl
+
+from form_template import DEFAULT_DIVISION, FIELD_COLUMNS, WORK_FIELDS, get_plan
+from incremental import normalize_agreement
+from instrumentation import LOG_LEVELS, configure_logging, logger
+from pdf_render import PdfWriter, render_page
+from sheet_naming import sheet_name_for, unique_names
+from work_records import DATE_FIELDS, WorkRecord, normalize_date, normalize_text
+from xlsx_stream import save_workbook
+
+
+def _header_key(name):
+    # Headers match ignoring case and spacing, as master_reader matches them
+    return ' '.join(str(name).split()).casefold()
+
+
+def _xlsx_rows(path, sheet_name):
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        if sheet_name not in wb.sheetnames:
+            raise ValueError(f"Sheet '{sheet_name}' not found. Available sheets: {wb.sheetnames}")
+        yield from wb[sheet_name].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _csv_rows(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        for row in csv.reader(f, skipinitialspace=True):
+            # Blank lines are skipped and empty fields are blanks, as pandas reads a CSV
+            if row:
+                yield [value if value != '' else None for value in row]
+
+
+def master_rows(path, sheet_name='Work Orders'):
+    """The master's rows as {field: raw value} dicts, in master order
+
+    Blank rows count only when data follows them, as when the master is
+    read with pandas, so every row keeps the position it has in a full run.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.xlsx', '.xlsm'):
+        rows = _xlsx_rows(path, sheet_name)
+    elif extension == '.csv':
+        rows = _csv_rows(path)
+    else:
+        raise ValueError(f"single forms are read from .xlsx or .csv masters, not {extension or path}")
+
+    fields = {_header_key(column): field for field, column in FIELD_COLUMNS.items()}
+    header = next(rows, ())
+    positions = {}
+    for pos, name in enumerate(header):
+        field = fields.get(_header_key(name)) if name is not None else None
+        if field is not None:
+            positions.setdefault(field, pos)
+
+    blank = []
+    for row in rows:
+        values = {field: row[pos] if pos < len(row) else None for field, pos in positions.items()}
+        if all(value is None or value == '' for value in values.values()):
+            blank.append(values)
+            continue
+        yield from blank
+        blank.clear()
+        yield values
+
+
+def _record_fields(values):
+    return {field: normalize_date(values.get(field)) if field in DATE_FIELDS else normalize_text(values.get(field))
+            for field in WORK_FIELDS}
+
+
+def find_works(path, agreement_no, sheet_name='Work Orders'):
+    """WorkRecords of every work in the master with this agreement number
+
+    Only the matching rows are normalized in full; every row's sheet name
+    is worked out so repeated names are numbered as in a full run.
+    """
+    wanted = normalize_agreement(agreement_no)
+    base_names = []
+    matches = []
+    for row_idx, values in enumerate(master_rows(path, sheet_name)):
+        contractor = normalize_text(values.get('contractor'))
+        agreement = normalize_text(values.get('agreement_no'))
+        base_names.append(sheet_name_for(contractor, agreement))
+        if normalize_agreement(agreement) == wanted:
+            matches.append((row_idx, _record_fields(values)))
+    if not matches:
+        return []
+    names = unique_names(base_names)
+    return [WorkRecord(sheet_name=names[row_idx], **fields) for row_idx, fields in matches]
+
+
+def write_form(record, path, division=DEFAULT_DIVISION, fmt='xlsx'):
+    """Render one work to an xlsx or a one-page PDF"""
+    if fmt == 'pdf':
+        writer = PdfWriter(path, title=f"Security Deposit Refund - {record.agreement_no}")
+        writer.add_page(render_page(record._asdict(), division))
+        writer.close()
+        return
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    get_plan(division=division).render(wb, record.sheet_name, record._asdict())
+    save_workbook(wb, path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Render the refund form of one agreement straight from the master")
+    parser.add_argument('agreement_no', help="agreement number of the work, e.g. 104/2020-21")
+    parser.add_argument('--master', default='work_order_master.xlsx',
+                        help="work order master (.xlsx or .csv)")
+    parser.add_argument('--master-sheet', default='Work Orders',
+                        help="sheet of an xlsx master to read (default: %(default)s)")
+    parser.add_argument('--division', default=DEFAULT_DIVISION,
+                        help="division printed in the form's footer (default: %(default)s)")
+    parser.add_argument('--format', choices=['xlsx', 'pdf'], default='xlsx')
+    parser.add_argument('--output-dir', default='.',
+                        help="directory the form is written to (default: the current one)")
+    parser.add_argument('--log-level', default='INFO', choices=LOG_LEVELS, type=str.upper)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(args.log_level)
+    try:
+        records = find_works(args.master, args.agreement_no, args.master_sheet)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not read the master {args.master}: {e}")
+        return 2
+    if not records:
+        logger.error(f"No work with agreement '{args.agreement_no}' in {args.master}.")
+        return 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for record in records:
+        slug = re.sub(r'[^0-9A-Za-z]+', '_', record.sheet_name).strip('_')
+        path = os.path.join(args.output_dir, f"Security_Refund_{slug}.{args.format}")
+        write_form(record, path, args.division, args.format)
+        logger.info(f"Wrote {record.agreement_no} ({record.contractor}) to {path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
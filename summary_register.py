@@ -0,0 +1,208 @@
+"""Pending-refund register: totals by contractor and by agreement year.
+
+Written next to a run's batch workbooks so supervisors need not open the
+forms. Every work in the master is a pending refund (the master has no
+record of refunds paid); by its dates a work is
+
+- refund due: its defect liability period (DLP), --dlp-months after the
+  actual date of completion, ended before the day of the run,
+- within DLP: completed, but its DLP is still running,
+- not completed: no actual date of completion yet,
+
+and completed late when it was completed after its stipulated date.
+
+``work_status`` works these out for a whole master (or a block of one) as
+columns. ``register_totals`` then makes a single grouped pass over them by
+contractor and agreement year; the contractor and year sheets are rolled up
+from that small result rather than from the works again. The Works sheet
+lists every work with a link to its form.
+"""
+import os
+
+import openpyxl
+import pandas as pd
+from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.hyperlink import Hyperlink
+
+from form_fields import DEFAULT_DLP_MONTHS, FIELD_COLUMNS
+from run_index import normalize_contractor
+from sheet_naming import SHEET_NAME_COLUMN
+from validation import DATE_FORMAT, agreement_years, parse_dates
+from xlsx_patch import quote_sheet_name
+
+NO_YEAR = 'Unknown'
+
+STATUS_REFUND_DUE = 'Refund due'
+STATUS_WITHIN_DLP = 'Within DLP'
+STATUS_NOT_COMPLETED = 'Not completed'
+
+# (count column, heading, width) of the contractor and year sheets
+TOTAL_COLUMNS = [
+    ('works', 'Pending refunds', 12),
+    ('refund_due', 'Past DLP expiry', 12),
+    ('within_dlp', 'Within DLP', 12),
+    ('not_completed', 'Not completed', 12),
+    ('late', 'Completed late', 12),
+    ('days_late', 'Days late (total)', 12),
+]
+
+WORK_COLUMNS = [
+    ('S.No', 7), ('Name of Contractor', 35), ('Agreement No.', 16), ('Agreement Year', 10),
+    ('Stipulated date of Completion', 14), ('Actual Date of Completion', 14), ('DLP Expiry', 12),
+    ('Status', 14), ('Days Late', 9), ('Form', 24),
+]
+
+_thin = Side(style='thin')
+_header_style = {
+    'font': Font(bold=True, size=11),
+    'fill': PatternFill(start_color='E6E6FA', end_color='E6E6FA', fill_type='solid'),
+    'alignment': Alignment(horizontal='center', vertical='center', wrap_text=True),
+    'border': Border(left=_thin, right=_thin, top=_thin, bottom=_thin),
+}
+_total_font = Font(bold=True)
+_link_font = Font(color='0563C1', underline='single')
+
+
+def register_path(output_dir, agreement_year):
+    return os.path.join(output_dir, f"Security_Refund_Register_{agreement_year}.xlsx")
+
+
+def work_status(df, as_of, dlp_months=DEFAULT_DLP_MONTHS):
+    """Per-work status columns of a (named) master, computed column-wise
+
+    as_of is the day the register is made for. Rows keep df's order; the
+    sheet name is carried along so a work can be linked to its form.
+    """
+    contractors = df[FIELD_COLUMNS['contractor']].astype(object).where(
+        df[FIELD_COLUMNS['contractor']].notna(), '').astype(str).str.strip()
+    stipulated = parse_dates(df[FIELD_COLUMNS['stipulated_completion']].astype(object))
+    actual = parse_dates(df[FIELD_COLUMNS['actual_completion']].astype(object))
+    dlp_expiry = actual + pd.DateOffset(months=dlp_months)
+
+    completed = actual.notna()
+    refund_due = completed & (dlp_expiry < pd.Timestamp(as_of))
+    late = completed & stipulated.notna() & (actual > stipulated)
+    status = pd.Series(STATUS_NOT_COMPLETED, index=df.index, dtype=object)
+    status = status.mask(completed, STATUS_WITHIN_DLP).mask(refund_due, STATUS_REFUND_DUE)
+
+    return pd.DataFrame({
+        'contractor': contractors,
+        'contractor_key': contractors.map(normalize_contractor),
+        'agreement_no': df[FIELD_COLUMNS['agreement_no']].astype(object).where(
+            df[FIELD_COLUMNS['agreement_no']].notna(), '').astype(str).str.strip(),
+        'year': agreement_years(df).fillna(NO_YEAR),
+        'sheet': df[SHEET_NAME_COLUMN] if SHEET_NAME_COLUMN in df.columns else '',
+        'stipulated': stipulated,
+        'actual': actual,
+        'dlp_expiry': dlp_expiry,
+        'status': status,
+        'refund_due': refund_due,
+        'within_dlp': completed & ~refund_due,
+        'not_completed': ~completed,
+        'late': late,
+        'days_late': (actual - stipulated).dt.days.where(late, 0).fillna(0).astype(int),
+    })
+
+
+def register_totals(status):
+    """(by contractor, by year) totals from one grouped pass over the works
+
+    Works are grouped once by contractor and year; each sheet's totals are
+    sums over those groups. Contractors are told apart ignoring case and
+    spacing and shown as first spelled in the master.
+    """
+    counts = [column for column, _, _ in TOTAL_COLUMNS if column != 'works']
+    groups = status.groupby(['contractor_key', 'year'], sort=False).agg(
+        contractor=('contractor', 'first'), works=('status', 'size'),
+        **{column: (column, 'sum') for column in counts}).reset_index()
+
+    totals = ['works', *counts]
+    by_contractor = (groups.groupby('contractor_key', sort=False)
+                     .agg(contractor=('contractor', 'first'), **{column: (column, 'sum') for column in totals})
+                     .sort_values('contractor', key=lambda names: names.str.casefold(), kind='stable'))
+    by_year = groups.groupby('year')[totals].sum()
+    # Works without a year go last
+    by_year = by_year.loc[sorted(by_year.index, key=lambda year: (year == NO_YEAR, year))]
+    return by_contractor, by_year
+
+
+def _header(ws, columns, row=1):
+    for col_idx, (title, width) in enumerate(columns, 1):
+        cell = ws.cell(row=row, column=col_idx, value=title)
+        for name, value in _header_style.items():
+            setattr(cell, name, value)
+        ws.column_dimensions[cell.column_letter].width = width
+
+
+def _date(value):
+    return value.strftime(DATE_FORMAT) if not pd.isna(value) else ''
+
+
+def _write_totals(ws, labels, totals, link_rows=None):
+    """One row per group with its totals, then a Total row; labels are (heading, width, values)"""
+    heading, width, values = labels
+    _header(ws, [('S.No', 7), (heading, width)] + [(title, width) for _, title, width in TOTAL_COLUMNS]
+            + ([('Forms', 10)] if link_rows is not None else []))
+    columns = [column for column, _, _ in TOTAL_COLUMNS]
+    rows = totals[columns].itertuples(index=False)
+    for row_idx, (label, counts) in enumerate(zip(values, rows), 2):
+        ws.cell(row=row_idx, column=1, value=row_idx - 1)
+        ws.cell(row=row_idx, column=2, value=label)
+        for col_idx, count in enumerate(counts, 3):
+            ws.cell(row=row_idx, column=col_idx, value=int(count))
+        if link_rows is not None:
+            cell = ws.cell(row=row_idx, column=len(columns) + 3, value='Forms')
+            cell.hyperlink = Hyperlink(ref=cell.coordinate, location=f"'Works'!A{link_rows[row_idx - 2]}")
+            cell.font = _link_font
+
+    total_row = len(totals) + 2
+    ws.cell(row=total_row, column=2, value='Total').font = _total_font
+    for col_idx, column in enumerate(columns, 3):
+        cell = ws.cell(row=total_row, column=col_idx, value=int(totals[column].sum()))
+        cell.font = _total_font
+    ws.freeze_panes = 'C2'
+
+
+def write_register(status, sheet_files, path, as_of, dlp_months=DEFAULT_DLP_MONTHS):
+    """Write the register workbook: contractor and year totals and every work linked to its form
+
+    sheet_files maps each form's sheet name to the batch workbook holding it.
+    """
+    by_contractor, by_year = register_totals(status)
+    # Each contractor's works together, in master order, so a contractor links to its first
+    works = status.sort_values('contractor_key', kind='stable')
+    first_rows = works.reset_index(drop=True).groupby('contractor_key', sort=False).head(1)
+    first_row = dict(zip(first_rows['contractor_key'], first_rows.index + 2))
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'By Contractor'
+    _write_totals(ws, ('Name of Contractor', 35, by_contractor['contractor']), by_contractor,
+                  [first_row[key] for key in by_contractor.index])
+    note_row = len(by_contractor) + 4
+    ws.cell(row=note_row, column=2,
+            value=f"As on {as_of.strftime(DATE_FORMAT)}; DLP taken as {dlp_months} months after actual completion")
+
+    ws = wb.create_sheet('By Year')
+    _write_totals(ws, ('Agreement Year', 14, by_year.index), by_year)
+
+    ws = wb.create_sheet('Works')
+    _header(ws, WORK_COLUMNS)
+    columns = works[['contractor', 'agreement_no', 'year', 'stipulated', 'actual', 'dlp_expiry', 'status',
+                     'days_late', 'sheet']].itertuples(index=False)
+    for row_idx, (contractor, agreement_no, year, stipulated, actual, dlp_expiry, state, days_late,
+                  sheet) in enumerate(columns, 2):
+        values = [row_idx - 1, contractor, agreement_no, year, _date(stipulated), _date(actual),
+                  _date(dlp_expiry), state, int(days_late) or None, sheet]
+        for col_idx, value in enumerate(values, 1):
+            ws.cell(row=row_idx, column=col_idx, value=value)
+        if sheet in sheet_files:
+            cell = ws.cell(row=row_idx, column=len(values))
+            cell.hyperlink = Hyperlink(ref=cell.coordinate, target=sheet_files[sheet],
+                                       location=f"{quote_sheet_name(sheet)}!A1")
+            cell.font = _link_font
+    ws.freeze_panes = 'A2'
+    ws.auto_filter.ref = f"A1:{get_column_letter(len(WORK_COLUMNS))}{len(works) + 1}"
+    wb.save(path)
+    return path
@@ -0,0 +1,42 @@
+"""A --lazy run indexes its works in master order however many workers render them."""
+import glob
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'benchmarks')]
+
+import security_refund_generator as generator
+from synthetic import write_synthetic_master
+
+
+def run_index(master, output_dir, *options):
+    """Entries of the JSON lookup index a generator run writes"""
+    generator.main(['--master', master, '--output-dir', output_dir, '--allow-invalid', '--no-cache',
+                    '--no-register', '--store', output_dir + '.sqlite', '--validation-report', output_dir + '.csv',
+                    '--log-level', 'WARNING', *options])
+    [path] = glob.glob(os.path.join(output_dir, 'Security_Refund_Index_*.json'))
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)['entries']
+
+
+class LazyIndexOrderTest(unittest.TestCase):
+    def test_parallel_lazy_index_matches_serial_and_full_run(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            master = os.path.join(work_dir, 'master.xlsx')
+            write_synthetic_master(master, 90)
+            # Small batches, so the workers finish many of them out of order
+            options = ['--batch-size', '3', '--agreement-year', '2023']
+            serial = run_index(master, os.path.join(work_dir, 'serial'), '--lazy', '--workers', '1', *options)
+            parallel = run_index(master, os.path.join(work_dir, 'parallel'), '--lazy', '--workers', '2', *options)
+            full = run_index(master, os.path.join(work_dir, 'full'), '--workers', '2', *options)
+        self.assertEqual(len(serial), 90)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(parallel, full)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Looking a form up in a run's index by agreement number or contractor."""
+import os
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from run_index import build_lookup, find_forms
+
+
+def entry(contractor, agreement_no):
+    return {'contractor': contractor, 'agreement_no': agreement_no, 'work_name': '', 'batch': 1,
+            'file': 'Security_Refund_Batch_01_2023.xlsx', 'sheet': ''}
+
+
+class FindFormsTest(unittest.TestCase):
+    def setUp(self):
+        self.lookup = build_lookup([
+            entry('Abhinav Engineering & Suppliers', '104/2020-21'),
+            entry('Mitul Construction', '49/2021-22'),
+            entry('M/s Abhinav  Engineering & Suppliers', '7/2022-23'),
+            entry('Abhijit Traders', '12/2022-23'),
+        ])
+
+    def agreements(self, query):
+        return [found['agreement_no'] for found in find_forms(self.lookup, query)]
+
+    def test_agreement_number(self):
+        self.assertEqual(self.agreements(' 104/2020-21 '), ['104/2020-21'])
+
+    def test_whole_name_ignores_firm_prefix_case_and_spacing(self):
+        both = ['104/2020-21', '7/2022-23']
+        self.assertEqual(self.agreements('abhinav engineering & suppliers'), both)
+        self.assertEqual(self.agreements('M/s Abhinav Engineering & Suppliers'), both)
+        self.assertEqual(self.agreements('M/S. ABHINAV ENGINEERING   & SUPPLIERS'), both)
+
+    def test_words_of_the_name(self):
+        self.assertEqual(self.agreements('Abhinav'), ['104/2020-21', '7/2022-23'])
+        self.assertEqual(self.agreements('abhinav supp'), ['104/2020-21', '7/2022-23'])
+        self.assertEqual(self.agreements('abhi'), ['104/2020-21', '7/2022-23', '12/2022-23'])
+        self.assertEqual(self.agreements('construction'), ['49/2021-22'])
+
+    def test_no_match(self):
+        self.assertEqual(self.agreements('Abhinav Traders'), [])
+        self.assertEqual(self.agreements('M/s'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
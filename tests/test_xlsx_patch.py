@@ -0,0 +1,135 @@
+"""Workbooks patched at the zip level are valid and match a full openpyxl round-trip."""
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'benchmarks')]
+
+import openpyxl
+import pandas as pd
+
+import deposit_ledger
+import security_refund_generator as generator
+import update_existing_workbooks as updater
+from synthetic import write_synthetic_master
+
+STYLE_ATTRIBUTES = ('font', 'fill', 'alignment', 'number_format', 'protection')
+BORDER_SIDES = ('left', 'right', 'top', 'bottom')
+
+
+def cell_styles(cell):
+    # Style proxies of two workbooks never compare equal, their reprs do
+    styles = {name: repr(getattr(cell, name)) for name in STYLE_ATTRIBUTES}
+    # A side without a line may be written as an empty <left/> or left out; both print nothing
+    sides = [getattr(cell.border, side) for side in BORDER_SIDES]
+    styles['border'] = [(side.style, repr(side.color)) if side is not None and side.style else None
+                        for side in sides]
+    return styles
+
+
+class PatchedWorkbookTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp()
+        master = os.path.join(cls.work_dir, 'master.xlsx')
+        write_synthetic_master(master, 6)
+        output_dir = os.path.join(cls.work_dir, 'out')
+        generator.main(['--master', master, '--output-dir', output_dir, '--allow-invalid', '--no-cache',
+                        '--no-register', '--store', os.path.join(cls.work_dir, 'forms.sqlite'),
+                        '--validation-report', os.path.join(cls.work_dir, 'validation.csv'),
+                        '--batch-size', '3', '--agreement-year', '2023', '--log-level', 'WARNING'])
+        cls.batch = sorted(glob.glob(os.path.join(output_dir, 'Security_Refund_Batch_*.xlsx')))[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.work_dir)
+
+    def copy_batch(self, name):
+        path = os.path.join(self.work_dir, name)
+        shutil.copyfile(self.batch, path)
+        return path
+
+    def assertValidZip(self, path):
+        with zipfile.ZipFile(path) as archive:
+            self.assertIsNone(archive.testzip())
+
+    def test_patch_matches_openpyxl_fix(self):
+        patched, fixed = self.copy_batch('patched.xlsx'), self.copy_batch('fixed.xlsx')
+        updater.patch_workbook(patched)
+        updater.fix_workbook(fixed)
+        self.assertValidZip(patched)
+
+        patched_wb, fixed_wb = openpyxl.load_workbook(patched), openpyxl.load_workbook(fixed)
+        self.assertEqual(patched_wb.sheetnames, fixed_wb.sheetnames)
+        for patched_ws, fixed_ws in zip(patched_wb.worksheets, fixed_wb.worksheets):
+            for patched_row, fixed_row in zip(patched_ws.iter_rows(), fixed_ws.iter_rows()):
+                for patched_cell, fixed_cell in zip(patched_row, fixed_row):
+                    self.assertEqual(patched_cell.value, fixed_cell.value, patched_cell.coordinate)
+                    self.assertEqual(cell_styles(patched_cell), cell_styles(fixed_cell), patched_cell.coordinate)
+            self.assertEqual(patched_ws.row_dimensions[updater.TALL_ROW].height, updater.TALL_ROW_HEIGHT)
+            self.assertEqual(patched_ws.print_area, fixed_ws.print_area)
+            self.assertEqual(int(patched_ws.page_setup.paperSize), updater.PAPER_SIZE)
+            self.assertEqual(patched_ws.page_setup.orientation, updater.ORIENTATION)
+            for side, margin in updater.PAGE_MARGINS.items():
+                self.assertEqual(getattr(patched_ws.page_margins, side), margin)
+            self.assertTrue(patched_ws.print_options.horizontalCentered)
+
+    def test_patch_carries_other_parts_over(self):
+        patched = self.copy_batch('carried.xlsx')
+        updater.patch_workbook(patched)
+        with zipfile.ZipFile(self.batch) as before, zipfile.ZipFile(patched) as after:
+            self.assertEqual(before.namelist(), after.namelist())
+            for name in before.namelist():
+                if not name.startswith('xl/worksheets/') and name not in ('xl/styles.xml', 'xl/workbook.xml'):
+                    self.assertEqual(before.read(name), after.read(name), name)
+
+    def test_ledger_fill(self):
+        filled = self.copy_batch('filled.xlsx')
+        [(_, first_sheet, first_agreement), (_, second_sheet, second_agreement), *_] = \
+            deposit_ledger.scan_workbook(filled)
+        capacity = len(deposit_ledger.TABLE_ROWS)
+        # One deposit on the first form; more than the table holds on the second
+        rows = [(first_agreement, 'Final Bill', 'MB-1', 'Cash', 5000)]
+        rows += [(second_agreement, f'Bill {n}', f'MB-{n}', 'FDR', 100 * n) for n in range(1, capacity + 3)]
+        ledger_path = os.path.join(self.work_dir, 'ledger.csv')
+        pd.DataFrame(rows, columns=['Agreement No.', 'Bill Type', 'MB No.', 'SD Type', 'Amount']).to_csv(
+            ledger_path, index=False)
+
+        ledger, dropped = deposit_ledger.read_ledger(ledger_path)
+        fills, stats = deposit_ledger.ledger_fills(ledger, deposit_ledger.work_locations([filled]))
+        self.assertEqual((dropped, stats['filled'], stats['overflowing']), (0, 2, 1))
+        updater.fill_workbook(filled, fills[os.path.basename(filled)])
+        self.assertValidZip(filled)
+
+        original_wb, filled_wb = openpyxl.load_workbook(self.batch), openpyxl.load_workbook(filled)
+        value = deposit_ledger.VALUE_COLUMN
+        first, second = filled_wb[first_sheet], filled_wb[second_sheet]
+        self.assertEqual(first[f"{value}{deposit_ledger.AMOUNT_ROW}"].value, 5000)
+        self.assertEqual(first[f"{value}{deposit_ledger.MB_ROW}"].value, 'MB-1')
+        self.assertEqual(first[f"A{deposit_ledger.TABLE_ROWS[0]}"].value, 'Final Bill')
+        self.assertIsNone(first[f"E{deposit_ledger.TABLE_ROWS[1]}"].value)
+
+        total = sum(100 * n for n in range(1, capacity + 3))
+        self.assertEqual(second[f"{value}{deposit_ledger.AMOUNT_ROW}"].value, total)
+        self.assertEqual(second[f"{value}{deposit_ledger.TOTAL_ROW}"].value, total)
+        table = [second[f"E{row}"].value for row in deposit_ledger.TABLE_ROWS]
+        self.assertEqual(sum(table), total)
+        last = deposit_ledger.TABLE_ROWS[-1]
+        self.assertEqual(second[f"A{last}"].value, 'Others (3 bills)')
+        self.assertEqual(second[f"E{last}"].value, 100 * (capacity + capacity + 1 + capacity + 2))
+        self.assertIsNone(second[f"C{last}"].value)
+
+        # Filling writes values only; every cell keeps its style
+        for original_ws, filled_ws in zip(original_wb.worksheets, filled_wb.worksheets):
+            for original_row, filled_row in zip(original_ws.iter_rows(), filled_ws.iter_rows()):
+                for original_cell, filled_cell in zip(original_row, filled_row):
+                    self.assertEqual(cell_styles(filled_cell), cell_styles(original_cell), filled_cell.coordinate)
+
+
+if __name__ == '__main__':
+    unittest.main()
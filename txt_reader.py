@@ -0,0 +1,131 @@
+"""Streaming parser for the text work-order export (the 355.txt fallback input).
+
+The export is one long line of entries, each starting with its serial number
+directly followed by the capitalised work name. ``iter_work_orders_txt`` reads
+the file in chunks, cuts it into entries as it goes and yields one record per
+entry, so memory use does not depend on the size of the export. All patterns
+are compiled once and none of them can backtrack over a whole entry.
+"""
+import re
+
+CHUNK_SIZE = 1 << 20
+
+# Fields of a record, in column order
+TXT_COLUMNS = [
+    'S.No', 'WorkOrder Name', 'Vendor', 'WO No', 'Agreement No', 'Start Date Serial',
+    'Start Date', 'Comp Date', 'Some Date Serial', 'Amount_a', 'Amount_b', 'Amount_c',
+    'Amount_d', 'Actual date of completion ACD',
+]
+
+# An entry starts at a digit run (not the tail of a longer number) that is
+# followed by a capital letter
+_ENTRY_START = re.compile(r'(?<!\d)\d+(?=[A-Z])')
+_WORK_NUM = re.compile(r'\d+')
+_NAME_RUN = re.compile(r'[a-zA-Z\s&]+')
+_UPPER = re.compile(r'[A-Z]')
+_VENDOR_SUFFIX = re.compile(
+    r'Enterprises|Electricals|Company|Ltd|Pvt|Traders|Suppliers|Engineering|Industries|Centre|Service')
+_WO_NO = re.compile(r'\d{5,6}')
+_AGREEMENT = re.compile(r'\d+[/\s]*(?:of\s+)?\d{4}-\d{2,4}')
+_BRACKET_DATE = re.compile(r'\((\d{2}/\d{2}/\d{4})\)')
+_AMOUNT = re.compile(r'\d+\.\d{2}')
+_DATE = re.compile(r'\d{2}/\d{2}/\d{4}')
+
+
+def _vendor_end(entry, start):
+    """End of a vendor name starting at entry[start], or None
+
+    A vendor is a capital letter, at least one more name character and then
+    one of the suffixes, all inside one run of letters, spaces and '&'. The
+    longest such name ends at the last suffix in the run.
+    """
+    run_end = _NAME_RUN.match(entry, start).end()
+    end = None
+    for match in _VENDOR_SUFFIX.finditer(entry, start + 2, run_end):
+        end = match.end()
+    return end
+
+
+def find_vendor(entry):
+    """First vendor name in an entry, or ''"""
+    for run in _NAME_RUN.finditer(entry):
+        suffixes = list(_VENDOR_SUFFIX.finditer(entry, run.start(), run.end()))
+        if not suffixes:
+            continue
+        last_start = suffixes[-1].start()
+        capital = _UPPER.search(entry, run.start(), last_start - 1)
+        if capital is not None:
+            return entry[capital.start():suffixes[-1].end()].strip()
+    return ''
+
+
+def parse_work_entry(entry):
+    """Turn one entry of the export into a record, or None if it is not a work"""
+    num_match = _WORK_NUM.match(entry)
+    if not num_match:
+        return None
+    name_start = num_match.end()
+
+    # The name runs up to the next capital, provided a vendor starts there
+    next_capital = _UPPER.search(entry, name_start + 1)
+    if (next_capital is not None and entry[name_start:name_start + 1].isupper()
+            and _vendor_end(entry, next_capital.start()) is not None):
+        work_name = entry[name_start:next_capital.start()].strip()
+    else:
+        work_name = entry[:50] + '...'
+
+    wo_match = _WO_NO.search(entry)
+    agreement_match = _AGREEMENT.search(entry)
+    dates = _BRACKET_DATE.findall(entry)
+    amounts = _AMOUNT.findall(entry)[:2]
+    tail = entry.rstrip()[-10:]
+
+    return {
+        'S.No': num_match.group(),
+        'WorkOrder Name': work_name,
+        'Vendor': find_vendor(entry),
+        'WO No': wo_match.group() if wo_match else '',
+        'Agreement No': agreement_match.group() if agreement_match else '',
+        'Start Date Serial': '',
+        'Start Date': dates[0] if len(dates) > 0 else '',
+        'Comp Date': dates[1] if len(dates) > 1 else '',
+        'Some Date Serial': '',
+        'Amount_a': amounts[0] if len(amounts) > 0 else '',
+        'Amount_b': amounts[1] if len(amounts) > 1 else '',
+        'Amount_c': '',
+        'Amount_d': '',
+        'Actual date of completion ACD': tail if _DATE.fullmatch(tail) else '',
+    }
+
+
+def iter_entries(file, chunk_size=CHUNK_SIZE):
+    """Yield the raw entries of an open text export, reading it in chunks
+
+    Text before the last entry start seen so far is complete; the rest is
+    kept and scanned again with the next chunk, so an entry (or its serial
+    number) split across chunks is still found whole.
+    """
+    buffer = ''
+    while True:
+        chunk = file.read(chunk_size)
+        buffer += chunk
+        starts = [match.start() for match in _ENTRY_START.finditer(buffer)]
+        if not chunk:
+            break
+        if len(starts) > 1:
+            for begin, end in zip(starts, starts[1:]):
+                yield buffer[begin:end]
+            buffer = buffer[starts[-1]:]
+
+    for begin, end in zip(starts, starts[1:] + [len(buffer)]):
+        yield buffer[begin:end]
+
+
+def iter_work_orders_txt(file_path, chunk_size=CHUNK_SIZE):
+    """Yield one record dict per work in a text export"""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for entry in iter_entries(file, chunk_size):
+            if entry.strip():
+                record = parse_work_entry(entry)
+                if record is not None:
+                    yield record
@@ -1,40 +1,62 @@
+import argparse
 import os
-from openpyxl import load_workbook
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from instrumentation import LOG_LEVELS, configure_logging, logger
+from xlsx_patch import WorkbookPackage
 
 # Use path relative to this script so it works on Windows too
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 TARGET_DIR = os.path.join(SCRIPT_DIR, "Security_Refund_Sheets_2025_20250903_033335")
 
+# Layout every form must have after the fixes; audit_workbooks.py checks the same
+BORDERED_ROWS = range(20, 27)
+BORDERED_COLUMNS = ("A", "B")
+TALL_ROW, TALL_ROW_HEIGHT = 32, 40
+CERTIFICATE_HEADING = "Certified That:-"
+CERTIFICATE_ROWS = 12
+CERTIFICATE_COLUMNS = ("A", "B", "C", "D", "E")
+UNBORDERED_CELL = "A4"
+PAPER_SIZE, ORIENTATION = 9, 'portrait'
+PAGE_MARGINS = {'left': 0.5, 'right': 0.5, 'top': 0.5, 'bottom': 0.5, 'header': 0.2, 'footer': 0.2}
+PRINT_AREA_PADDING = 2
+
+
 def fix_workbook(path):
+    # openpyxl (and the numpy it pulls in) is only loaded by the openpyxl engine
+    from openpyxl import load_workbook
+    from openpyxl.styles import Border, Side
+
+    thin = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
     wb = load_workbook(path)
     for ws in wb.worksheets:
         # 1) Apply thin borders for A20:B26
-        from openpyxl.styles import Border, Side
-        thin = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        for row_idx in range(20, 27):
-            for col in ("A", "B"):
+        for row_idx in BORDERED_ROWS:
+            for col in BORDERED_COLUMNS:
                 ws[f"{col}{row_idx}"].border = thin
 
         # 2) Double the height of row 32 (approx 40 points if default ~20)
-        ws.row_dimensions[32].height = 40
+        ws.row_dimensions[TALL_ROW].height = TALL_ROW_HEIGHT
 
         # 3) Remove borders in certificate section (heuristic: lines after a row that equals "Certified That:-" until signatures)
         # Find certificate start
         cert_start = None
         for r in range(1, ws.max_row + 1):
             val = ws[f"A{r}"].value
-            if isinstance(val, str) and val.strip().startswith("Certified That:-"):
+            if isinstance(val, str) and val.strip().startswith(CERTIFICATE_HEADING):
                 cert_start = r
                 break
         if cert_start:
             # Clear borders for a reasonable range (up to next 10 lines) until blank then stop
-            for r in range(cert_start, min(cert_start + 12, ws.max_row + 1)):
-                for c in ("A", "B", "C", "D", "E"):
+            for r in range(cert_start, min(cert_start + CERTIFICATE_ROWS, ws.max_row + 1)):
+                for c in CERTIFICATE_COLUMNS:
                     ws[f"{c}{r}"].border = Border()
 
         # 4) Ensure no border at A4
-        if ws["A4"].border is not None:
-            ws["A4"].border = Border()
+        if ws[UNBORDERED_CELL].border is not None:
+            ws[UNBORDERED_CELL].border = Border()
 
         # 5) Print: A4 portrait one page
         # Set print area to cover A1:E(last row with content)
@@ -43,15 +65,11 @@ def fix_workbook(path):
             if ws[f"A{r}"].value is not None:
                 last_row = r
         if last_row:
-            ws.print_area = f"A1:E{last_row+2}"
-        ws.page_setup.paperSize = 9
-        ws.page_setup.orientation = 'portrait'
-        ws.page_margins.left = 0.5
-        ws.page_margins.right = 0.5
-        ws.page_margins.top = 0.5
-        ws.page_margins.bottom = 0.5
-        ws.page_margins.header = 0.2
-        ws.page_margins.footer = 0.2
+            ws.print_area = f"A1:E{last_row + PRINT_AREA_PADDING}"
+        ws.page_setup.paperSize = PAPER_SIZE
+        ws.page_setup.orientation = ORIENTATION
+        for side, margin in PAGE_MARGINS.items():
+            setattr(ws.page_margins, side, margin)
         ws.page_setup.fitToWidth = 1
         ws.page_setup.fitToHeight = 1
         ws.print_options.horizontalCentered = True
@@ -59,11 +77,209 @@ def fix_workbook(path):
     wb.save(path)
 
 
-def main():
-    for name in os.listdir(TARGET_DIR):
-        if name.endswith('.xlsx') and not name.startswith('~$'):
-            fix_workbook(os.path.join(TARGET_DIR, name))
+def patch_workbook(path):
+    """Apply the same fixes as fix_workbook by editing the xlsx at the zip level
+    
+    Only the worksheet parts (plus styles.xml and workbook.xml when a new
+    border style or print area is needed) are rewritten; every other part is
+    carried over unchanged. The file is replaced atomically.
+    """
+    package = WorkbookPackage(path)
+    styles = package.styles
+    thin = styles.border_id('thin')
+    no_border = styles.border_id(None)
 
-if __name__ == '__main__':
-    main()
+    for sheet_index, (sheet_name, part_name) in enumerate(package.sheets):
+        sheet = package.sheet(part_name)
+
+        # 1) Apply thin borders for A20:B26
+        for row_idx in BORDERED_ROWS:
+            for col in BORDERED_COLUMNS:
+                cell = sheet.cell(f"{col}{row_idx}", create=True)
+                cell.set('s', str(styles.with_border(cell.get('s'), thin)))
+
+        # 2) Double the height of row 32
+        sheet.set_row_height(TALL_ROW, TALL_ROW_HEIGHT)
+
+        # 3) Remove borders in the certificate section
+        max_row = sheet.max_row()
+        cert_start = None
+        for r in range(1, max_row + 1):
+            val = sheet.value(f"A{r}")
+            if isinstance(val, str) and val.strip().startswith(CERTIFICATE_HEADING):
+                cert_start = r
+                break
+        if cert_start:
+            for r in range(cert_start, min(cert_start + CERTIFICATE_ROWS, max_row + 1)):
+                for c in CERTIFICATE_COLUMNS:
+                    cell = sheet.cell(f"{c}{r}")
+                    if cell is not None:
+                        cell.set('s', str(styles.with_border(cell.get('s'), no_border)))
+
+        # 4) Ensure no border at A4
+        cell = sheet.cell(UNBORDERED_CELL)
+        if cell is not None:
+            cell.set('s', str(styles.with_border(cell.get('s'), no_border)))
+
+        # 5) Print: A4 portrait one page, print area A1:E(last row with content + 2)
+        last_row = 0
+        for r in range(1, max_row + 1):
+            if sheet.value(f"A{r}") is not None:
+                last_row = r
+        if last_row:
+            package.set_print_area(sheet_index, sheet_name, f"A1:E{last_row + PRINT_AREA_PADDING}")
+        sheet.element('pageMargins', create=True).attrib.update(
+            {side: f"{margin:g}" for side, margin in PAGE_MARGINS.items()})
+        sheet.element('pageSetup', create=True).attrib.update(
+            paperSize=str(PAPER_SIZE), orientation=ORIENTATION, fitToWidth='1', fitToHeight='1')
+        sheet.element('printOptions', create=True).set('horizontalCentered', '1')
 
+        package.mark_changed(part_name)
+
+    package.save()
+
+
+def fill_workbook(path, cells):
+    """Write values into existing cells at the zip level, keeping their styles
+    
+    cells maps sheet names to {cell reference: value}; only the worksheet
+    parts of those sheets are rewritten.
+    """
+    package = WorkbookPackage(path)
+    for sheet_name, part_name in package.sheets:
+        if sheet_name in cells:
+            sheet = package.sheet(part_name)
+            for ref, value in cells[sheet_name].items():
+                sheet.set_value(ref, value)
+            package.mark_changed(part_name)
+    package.save()
+
+
+def is_locked(path):
+    """True while Excel has the workbook open
+    
+    Excel keeps a ~$ owner file beside an open workbook, but a crash can leave
+    it behind, so the owner file only counts if the workbook also cannot be
+    opened for writing.
+    """
+    directory, name = os.path.split(path)
+    if not os.path.exists(os.path.join(directory, '~$' + name)):
+        return False
+    try:
+        with open(path, 'r+b'):
+            return False
+    except OSError:
+        return True
+
+
+def update_file(path, engine='zip', cells=None):
+    """Fix one workbook, or fill the given cells, reporting status and timing instead of raising"""
+    result = {'path': path, 'status': 'ok', 'seconds': 0.0, 'error': None}
+    if is_locked(path):
+        result['status'] = 'locked'
+        return result
+    started = time.perf_counter()
+    try:
+        if cells is not None:
+            fill_workbook(path, cells)
+        elif engine == 'zip':
+            patch_workbook(path)
+        else:
+            fix_workbook(path)
+    except PermissionError as e:
+        # Opened in Excel without a visible owner file, or the replace was refused
+        result['status'] = 'locked'
+        result['error'] = str(e)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def update_files(paths, workers=1, engine='zip', fills=None):
+    """Fix workbooks, or fill their cells from fills ({file name: cells}); results in input order
+    
+    Runs in a process pool when workers > 1.
+    """
+    cells = [fills[os.path.basename(path)] if fills is not None else None for path in paths]
+    if workers <= 1 or len(paths) <= 1:
+        return [update_file(path, engine, path_cells) for path, path_cells in zip(paths, cells)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(update_file, paths, [engine] * len(paths), cells))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Apply layout fixes to generated refund workbooks, "
+                                                 "or fill in their deposits from a ledger")
+    parser.add_argument('target_dir', nargs='?', default=TARGET_DIR,
+                        help="directory holding the batch workbooks")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="worker processes (0 = one per CPU)")
+    parser.add_argument('--engine', choices=('zip', 'openpyxl'), default='zip',
+                        help="zip-level patching (fast) or a full openpyxl load/save")
+    parser.add_argument('--ledger',
+                        help="instead of the layout fixes, fill amount of deposit, MB No., payment date and the "
+                             "deposit table from this ledger (.csv, .parquet or .xlsx with Agreement No., "
+                             "Bill Type, MB No., SD Type and Amount columns)")
+    parser.add_argument('--ledger-sheet',
+                        help="sheet of an xlsx ledger (default: the first)")
+    parser.add_argument('--retries', type=int, default=3,
+                        help="times to retry workbooks that are open in Excel")
+    parser.add_argument('--retry-delay', type=float, default=5.0,
+                        help="seconds to wait between retries of locked workbooks")
+    parser.add_argument('--log-level', default='INFO', choices=LOG_LEVELS, type=str.upper,
+                        help="WARNING shows only the workbooks that were skipped or failed")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(args.log_level)
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+
+    # The run's index and register workbooks sit beside the batches but are not forms
+    paths = [os.path.join(args.target_dir, name) for name in sorted(os.listdir(args.target_dir))
+             if name.endswith('.xlsx')
+             and not name.startswith(('~$', 'Security_Refund_Index_', 'Security_Refund_Register_'))]
+
+    started = time.perf_counter()
+    fills = None
+    if args.ledger:
+        # pandas is only needed to join a ledger
+        from deposit_ledger import ledger_fills, read_ledger, work_locations
+
+        ledger, dropped = read_ledger(args.ledger, args.ledger_sheet)
+        fills, stats = ledger_fills(ledger, work_locations(paths, workers))
+        logger.info(f"Ledger: {len(ledger)} deposits; {stats['filled']} of {stats['forms']} forms have deposits")
+        if dropped:
+            logger.warning(f"Skipped {dropped} ledger row(s) without an agreement number or amount")
+        if stats['unmatched_agreements']:
+            logger.warning(f"{stats['unmatched_agreements']} ledger agreement(s) match no form")
+        if stats['overflowing']:
+            logger.info(f"{stats['overflowing']} form(s) have more deposits than table rows; "
+                        f"the rest are summed into the last row")
+        paths = [path for path in paths if os.path.basename(path) in fills]
+    results = update_files(paths, workers, args.engine, fills)
+    for attempt in range(args.retries):
+        locked = [r['path'] for r in results if r['status'] == 'locked']
+        if not locked:
+            break
+        logger.warning(f"{len(locked)} workbook(s) open in Excel; retrying in {args.retry_delay:g}s...")
+        time.sleep(args.retry_delay)
+        retried = {r['path']: r for r in update_files(locked, workers, args.engine, fills)}
+        results = [retried.get(r['path'], r) for r in results]
+
+    for r in results:
+        if r['status'] == 'ok':
+            logger.info(f"Updated: {r['path']} ({r['seconds']:.2f}s)")
+        elif r['status'] == 'locked':
+            logger.warning(f"Skipped (open in Excel): {r['path']}")
+        else:
+            logger.warning(f"Failed: {r['path']}: {r['error']}")
+    updated = sum(r['status'] == 'ok' for r in results)
+    logger.info(f"Updated {updated} of {len(results)} workbooks in {time.perf_counter() - started:.2f}s")
+    return 0 if updated == len(results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Pre-flight checks of the master, run over whole columns before any workbook is built.
+
+``validate_master`` returns one row per problem found: its severity, the
+master row, the column and what is wrong. Errors are problems that would
+put wrong data on a form (a missing contractor, a date that does not parse,
+commencement after completion, an agreement number without a year);
+warnings are worth a look but do not stop a run. ``agreement_years``
+derives each row's agreement year, which also decides the file names and,
+with ``--by-year``, which output each work goes into.
+"""
+import pandas as pd
+
+from form_fields import FIELD_COLUMNS
+
+REQUIRED_COLUMNS = [FIELD_COLUMNS['contractor'], FIELD_COLUMNS['work_name'], FIELD_COLUMNS['agreement_no']]
+DATE_COLUMNS = [FIELD_COLUMNS['commencement'], FIELD_COLUMNS['stipulated_completion'],
+                FIELD_COLUMNS['actual_completion']]
+DATE_FORMAT = '%d/%m/%Y'
+
+REPORT_COLUMNS = ['severity', 'row', 'column', 'problem', 'value']
+
+# '104/2020-21' and '63 of 2022-23': serial number, then the financial year
+_AGREEMENT_FORMAT = r'^\s*\d+\s*(?:/|of)\s*\d{4}\s*-\s*(?:\d{2}|\d{4})\s*$'
+# The year an agreement was made in: '2020' of '2020-21', or '22' of '41/22-23'
+_FULL_YEAR = r'(?<!\d)(20\d{2})(?!\d)'
+_SHORT_YEAR = r'(?<!\d)0?(\d{2})\s*-\s*\d{2}(?!\d)'
+
+
+def _text(df, column):
+    if column not in df.columns:
+        return pd.Series('', index=df.index, dtype=object)
+    return df[column].astype(object).where(df[column].notna(), '').astype(str).str.strip()
+
+
+def agreement_years(df):
+    """Agreement year (e.g. '2020') per row, or NaN where the agreement number has none"""
+    agreements = _text(df, FIELD_COLUMNS['agreement_no'])
+    full = agreements.str.extract(_FULL_YEAR, expand=False)
+    short = '20' + agreements.str.extract(_SHORT_YEAR, expand=False)
+    return full.fillna(short)
+
+
+def parse_dates(series):
+    """Dates of a column as Timestamps: real dates as they are, text as dd/mm/yyyy, NaT if neither"""
+    is_text = series.map(lambda value: isinstance(value, str))
+    parsed = pd.to_datetime(series.where(~is_text), errors='coerce')
+    return parsed.fillna(pd.to_datetime(series.where(is_text).str.strip(), format=DATE_FORMAT, errors='coerce'))
+
+
+def _problems(mask, severity, column, problem, values):
+    rows = mask[mask].index
+    return pd.DataFrame({'severity': severity, 'row': rows, 'column': column, 'problem': problem,
+                         'value': values.loc[rows].astype(str)}, columns=REPORT_COLUMNS)
+
+
+def validate_master(df):
+    """All problems in the master as a DataFrame with REPORT_COLUMNS, errors first
+
+    'row' is the master's row label (for a sheet read from row 1 with a
+    header, the Excel row is row + 2).
+    """
+    found = []
+
+    for column in REQUIRED_COLUMNS:
+        text = _text(df, column)
+        found.append(_problems(text == '', 'error', column, 'required field is empty', text))
+
+    agreement_column = FIELD_COLUMNS['agreement_no']
+    agreements = _text(df, agreement_column)
+    present = agreements != ''
+    years = agreement_years(df)
+    found.append(_problems(present & years.isna(), 'error', agreement_column,
+                           'no agreement year in the agreement number', agreements))
+    found.append(_problems(present & years.notna() & ~agreements.str.match(_AGREEMENT_FORMAT), 'warning',
+                           agreement_column, "agreement number is not like '104/2020-21'", agreements))
+    keys = agreements.str.split().str.join(' ').str.lower()
+    found.append(_problems(present & keys.duplicated(keep=False), 'warning', agreement_column,
+                           'agreement number appears more than once', agreements))
+
+    dates = {}
+    for column in DATE_COLUMNS:
+        raw = df[column] if column in df.columns else pd.Series(None, index=df.index, dtype=object)
+        text = _text(df, column)
+        dates[column] = parse_dates(raw)
+        found.append(_problems((text != '') & dates[column].isna(), 'error', column,
+                               'not a date (expected dd/mm/yyyy)', text))
+        if column == FIELD_COLUMNS['actual_completion']:
+            found.append(_problems(text == '', 'warning', column, 'no actual date of completion', text))
+        else:
+            found.append(_problems(text == '', 'error', column, 'required date is empty', text))
+
+    commencement, stipulated, actual = (dates[column] for column in DATE_COLUMNS)
+    found.append(_problems(commencement > stipulated, 'error', DATE_COLUMNS[1],
+                           'stipulated completion is before commencement', _text(df, DATE_COLUMNS[1])))
+    found.append(_problems(commencement > actual, 'error', DATE_COLUMNS[2],
+                           'actual completion is before commencement', _text(df, DATE_COLUMNS[2])))
+    found.append(_problems(stipulated > actual, 'warning', DATE_COLUMNS[2],
+                           'completed before the stipulated date', _text(df, DATE_COLUMNS[2])))
+
+    report = pd.concat([part for part in found if not part.empty] or [pd.DataFrame(columns=REPORT_COLUMNS)],
+                       ignore_index=True)
+    report['order'] = (report['severity'] != 'error').astype(int)
+    return report.sort_values(['order', 'row'], kind='stable').drop(columns='order').reset_index(drop=True)
+
+
+def summarize(report):
+    """(severity, problem, count) for each kind of problem, errors first"""
+    counts = report.groupby(['severity', 'problem'], sort=False).size()
+    return [(severity, problem, int(count)) for (severity, problem), count in counts.items()]
@@ -0,0 +1,125 @@
+"""Compact per-work records that rendering works from.
+
+``work_records`` turns a master (or text export) DataFrame into one
+``WorkRecord`` tuple per work, reading each column once as a whole rather
+than boxing every row into a Series. Values are normalized on the way in:
+blanks and NaN become '', text is stripped and every date is printed as
+dd/mm/yyyy, whether it arrived as text, as a real date or as an Excel
+serial number. The renderers only ever see these records.
+"""
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from form_fields import FIELD_COLUMNS, WORK_FIELDS
+from sheet_naming import SHEET_NAME_COLUMN, assign_sheet_names, is_blank
+
+WorkRecord = namedtuple('WorkRecord', ('sheet_name',) + WORK_FIELDS)
+
+DATE_FIELDS = {'commencement', 'stipulated_completion', 'actual_completion'}
+DATE_FORMAT = '%d/%m/%Y'
+
+# Columns of the text export each field is read from; the first non-blank wins
+TXT_FIELD_COLUMNS = {
+    'contractor': ['Vendor'],
+    'work_name': ['WorkOrder Name'],
+    'agreement_no': ['Agreement No'],
+    'commencement': ['Start Date', 'Start Date Serial'],
+    'stipulated_completion': ['Comp Date', 'Some Date Serial'],
+    'actual_completion': ['Actual date of completion ACD'],
+}
+
+# Columns whose numeric text is an Excel serial date rather than a number
+SERIAL_COLUMNS = {'Start Date Serial', 'Some Date Serial'}
+
+# Day 0 of Excel's 1900 date system (allowing for its phantom 29/02/1900)
+EXCEL_EPOCH = datetime(1899, 12, 30)
+MAX_EXCEL_SERIAL = 2958465  # 31/12/9999
+
+
+def normalize_text(value):
+    """Cell value as stripped text, '' for blanks and NaN"""
+    if is_blank(value):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def excel_serial_to_date(serial):
+    """datetime for an Excel serial day number (fractions are the time of day)"""
+    return EXCEL_EPOCH + timedelta(days=float(serial))
+
+
+def normalize_date(value, serial=False):
+    """Date as dd/mm/yyyy text, '' for blanks
+
+    Real dates are formatted, numbers are Excel serials, and so is numeric
+    text when serial is set. Any other text is kept as written.
+    """
+    if is_blank(value):
+        return ''
+    if isinstance(value, (datetime, date)):
+        return value.strftime(DATE_FORMAT)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if 0 < value <= MAX_EXCEL_SERIAL:
+            return excel_serial_to_date(value).strftime(DATE_FORMAT)
+        return normalize_text(value)
+    text = str(value).strip()
+    if serial and text:
+        try:
+            number = float(text)
+        except ValueError:
+            return text
+        if 0 < number <= MAX_EXCEL_SERIAL:
+            return excel_serial_to_date(number).strftime(DATE_FORMAT)
+    return text
+
+
+def _field_columns(df):
+    """Field -> candidate columns for the master or, failing that, the text export"""
+    if any(column in df.columns for column in FIELD_COLUMNS.values()):
+        return {field: [column] for field, column in FIELD_COLUMNS.items()}
+    return TXT_FIELD_COLUMNS
+
+
+def _column_values(df, field, columns):
+    """Normalized values of one field for every row, from the first non-blank candidate column"""
+    values = [''] * len(df)
+    for column in columns:
+        if column not in df.columns:
+            continue
+        if field in DATE_FIELDS:
+            serial = column in SERIAL_COLUMNS
+            candidates = [normalize_date(value, serial) for value in df[column].tolist()]
+        else:
+            candidates = [normalize_text(value) for value in df[column].tolist()]
+        values = [value or candidate for value, candidate in zip(values, candidates)]
+    return values
+
+
+def work_records(df):
+    """One WorkRecord per row of df, in row order
+
+    Sheet names are taken from the 'Sheet Name' column when the master has
+    been named, otherwise they are assigned over df here.
+    """
+    field_columns = _field_columns(df)
+    columns = [_column_values(df, field, field_columns[field]) for field in WORK_FIELDS]
+    if SHEET_NAME_COLUMN in df.columns:
+        sheet_names = df[SHEET_NAME_COLUMN].tolist()
+    else:
+        import pandas as pd
+
+        fields = dict(zip(WORK_FIELDS, columns))
+        sheet_names = assign_sheet_names(pd.DataFrame({
+            FIELD_COLUMNS['contractor']: fields['contractor'],
+            FIELD_COLUMNS['agreement_no']: fields['agreement_no'],
+        })).tolist()
+    return [WorkRecord._make(values) for values in zip(sheet_names, *columns)]
+
+
+def as_records(batch):
+    """A batch as a list of WorkRecords, converting a DataFrame if need be"""
+    if isinstance(batch, (list, tuple)):
+        return batch
+    return work_records(batch)
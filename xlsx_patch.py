@@ -0,0 +1,478 @@
+"""Zip-level editing of xlsx files without a full openpyxl load/save round-trip.
+
+``WorkbookPackage`` opens an xlsx as the zip it is, parses only the XML parts
+that are asked for, and on save rewrites just the parts that were changed;
+every other part is copied over as the compressed bytes already in the file.
+``SheetPart`` and ``StyleTable`` give the small amount of worksheet and
+stylesheet editing the bulk fixes need: cell styles, row heights, page setup
+and the print area.
+"""
+import os
+import re
+import stat
+import struct
+import tempfile
+import xml.etree.ElementTree as ET
+import zlib
+from io import BytesIO
+from zipfile import BadZipFile, ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+DOC_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+MC_NS = 'http://schemas.openxmlformats.org/markup-compatibility/2006'
+
+# Child order of <worksheet> required by the schema (CT_Worksheet)
+WORKSHEET_ORDER = [
+    'sheetPr', 'dimension', 'sheetViews', 'sheetFormatPr', 'cols', 'sheetData',
+    'sheetCalcPr', 'sheetProtection', 'protectedRanges', 'scenarios', 'autoFilter',
+    'sortState', 'dataConsolidate', 'customSheetViews', 'mergeCells', 'phoneticPr',
+    'conditionalFormatting', 'dataValidations', 'hyperlinks', 'printOptions',
+    'pageMargins', 'pageSetup', 'headerFooter', 'rowBreaks', 'colBreaks',
+    'customProperties', 'cellWatches', 'ignoredErrors', 'smartTags', 'drawing',
+    'legacyDrawing', 'legacyDrawingHF', 'drawingHF', 'picture', 'oleObjects',
+    'controls', 'webPublishItems', 'tableParts', 'extLst',
+]
+
+# Child order of <workbook> (CT_Workbook), for inserting <definedNames>
+WORKBOOK_ORDER = [
+    'fileVersion', 'fileSharing', 'workbookPr', 'workbookProtection', 'bookViews',
+    'sheets', 'functionGroups', 'externalReferences', 'definedNames', 'calcPr',
+    'oleSize', 'customWorkbookViews', 'pivotCaches', 'smartTagPr', 'smartTagTypes',
+    'webPublishing', 'fileRecoveryPr', 'webPublishObjects', 'extLst',
+]
+
+_REF_RE = re.compile(r'^\$?([A-Z]+)\$?(\d+)$')
+
+# Zip records written by save(), as laid out in APPNOTE.TXT
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_END_RECORD = struct.Struct('<4s4H2LH')
+_ZIP32_LIMIT = 0xFFFFFFFF
+_UTF8_NAME = 0x800
+
+
+def q(tag):
+    """Qualified name of a SpreadsheetML element"""
+    return f'{{{MAIN_NS}}}{tag}'
+
+
+def split_ref(ref):
+    """'B26' -> ('B', 26)"""
+    match = _REF_RE.match(ref)
+    return match.group(1), int(match.group(2))
+
+
+def column_index(letters):
+    """'A' -> 1, 'E' -> 5, 'AA' -> 27 (as openpyxl's column_index_from_string, without importing openpyxl)"""
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index
+
+
+def quote_sheet_name(name):
+    return "'" + name.replace("'", "''") + "'"
+
+
+def parse_xml(data):
+    """Parse an XML part, returning its root and the namespace prefixes it declares"""
+    namespaces = {}
+    for _, (prefix, uri) in ET.iterparse(BytesIO(data), events=('start-ns',)):
+        namespaces.setdefault(prefix, uri)
+    return ET.fromstring(data), namespaces
+
+
+def serialize_xml(root, namespaces):
+    """Serialize a part keeping its original namespace prefixes
+
+    ElementTree drops declarations nobody uses, but a prefix named in
+    mc:Ignorable must stay declared or Excel refuses the file, so those are
+    put back on the root element.
+    """
+    for prefix, uri in namespaces.items():
+        if prefix and not re.match(r'ns\d+$', prefix):
+            ET.register_namespace(prefix, uri)
+    if '' in namespaces:
+        # Registered last so the default namespace wins over any alias of it
+        ET.register_namespace('', namespaces[''])
+    xml = ET.tostring(root, encoding='UTF-8', xml_declaration=True)
+
+    ignorable = root.get(f'{{{MC_NS}}}Ignorable')
+    if ignorable:
+        head_end = xml.index(b'>', xml.index(b'<', xml.index(b'?>') + 2))
+        head = xml[:head_end]
+        extra = b''.join(
+            f' xmlns:{prefix}="{namespaces[prefix]}"'.encode('utf-8')
+            for prefix in ignorable.split()
+            if prefix in namespaces and f'xmlns:{prefix}='.encode('utf-8') not in head
+        )
+        if head.endswith(b'/'):
+            head_end -= 1
+        xml = xml[:head_end] + extra + xml[head_end:]
+    return xml
+
+
+def insert_ordered(parent, child, order):
+    """Insert child into parent before the first sibling that must follow it"""
+    local = child.tag.split('}')[-1]
+    after = order[order.index(local) + 1:]
+    for idx, sibling in enumerate(parent):
+        if sibling.tag.split('}')[-1] in after:
+            parent.insert(idx, child)
+            return child
+    parent.append(child)
+    return child
+
+
+class StyleTable:
+    """The cellXfs and borders of styles.xml, extended only when needed"""
+
+    def __init__(self, root):
+        self.root = root
+        self.borders = root.find(q('borders'))
+        self.cell_xfs = root.find(q('cellXfs'))
+        self.changed = False
+        self._border_ids = {}
+        self._derived = {}
+
+    @staticmethod
+    def _border_key(border):
+        sides = []
+        for side in ('left', 'right', 'top', 'bottom', 'diagonal'):
+            el = border.find(q(side))
+            style = el.get('style') if el is not None else None
+            color = ET.tostring(el) if el is not None and len(el) else None
+            sides.append((style, color))
+        return tuple(sides), tuple(sorted(border.attrib.items()))
+
+    def border_id(self, style=None):
+        """Index of a border with every side in style (None = no border), added if missing"""
+        if style in self._border_ids:
+            return self._border_ids[style]
+        wanted = ((style, None),) * 4 + ((None, None),)
+        for idx, border in enumerate(self.borders):
+            if self._border_key(border) == (wanted, ()):
+                break
+        else:
+            border = ET.SubElement(self.borders, q('border'))
+            for side in ('left', 'right', 'top', 'bottom'):
+                el = ET.SubElement(border, q(side))
+                if style:
+                    el.set('style', style)
+            ET.SubElement(border, q('diagonal'))
+            self.borders.set('count', str(len(self.borders)))
+            self.changed = True
+            idx = len(self.borders) - 1
+        self._border_ids[style] = idx
+        return idx
+
+    def with_border(self, xf_id, border_id):
+        """Index of a cell format like xf_id but with border_id, added if missing"""
+        xf_id = int(xf_id or 0)
+        xfs = list(self.cell_xfs)
+        base = xfs[xf_id]
+        if int(base.get('borderId', 0)) == border_id:
+            return xf_id
+
+        key = (xf_id, border_id)
+        if key not in self._derived:
+            xf = ET.fromstring(ET.tostring(base))
+            xf.set('borderId', str(border_id))
+            xf.set('applyBorder', '1')
+            wanted = ET.tostring(xf)
+            for idx, candidate in enumerate(xfs):
+                if ET.tostring(candidate) == wanted:
+                    break
+            else:
+                self.cell_xfs.append(xf)
+                self.cell_xfs.set('count', str(len(self.cell_xfs)))
+                self.changed = True
+                idx = len(self.cell_xfs) - 1
+            self._derived[key] = idx
+        return self._derived[key]
+
+
+class SheetPart:
+    """A parsed worksheet part with indexed rows and cells"""
+
+    def __init__(self, root, shared_strings=()):
+        self.root = root
+        self.shared_strings = shared_strings
+        self.sheet_data = root.find(q('sheetData'))
+        self.rows = {int(row.get('r')): row for row in self.sheet_data}
+        self._cells = {}
+        for row in self.sheet_data:
+            for cell in row:
+                self._cells[cell.get('r')] = cell
+
+    def row(self, row_idx, create=False):
+        row = self.rows.get(row_idx)
+        if row is None and create:
+            row = ET.Element(q('row'), {'r': str(row_idx)})
+            later = [r for r in self.rows if r > row_idx]
+            if later:
+                self.sheet_data.insert(list(self.sheet_data).index(self.rows[min(later)]), row)
+            else:
+                self.sheet_data.append(row)
+            self.rows[row_idx] = row
+        return row
+
+    def cell(self, ref, create=False):
+        cell = self._cells.get(ref)
+        if cell is None and create:
+            col_letter, row_idx = split_ref(ref)
+            row = self.row(row_idx, create=True)
+            col_idx = column_index(col_letter)
+            cell = ET.Element(q('c'), {'r': ref})
+            for pos, sibling in enumerate(row):
+                if column_index(split_ref(sibling.get('r'))[0]) > col_idx:
+                    row.insert(pos, cell)
+                    break
+            else:
+                row.append(cell)
+            # The row's span hint may no longer be right; it is optional
+            row.attrib.pop('spans', None)
+            self._cells[ref] = cell
+        return cell
+
+    def value(self, ref):
+        """Cell value as text (shared and inline strings resolved), or None if empty"""
+        cell = self._cells.get(ref)
+        if cell is None:
+            return None
+        kind = cell.get('t')
+        if kind == 'inlineStr':
+            inline = cell.find(q('is'))
+            if inline is None:
+                return None
+            return ''.join(t.text or '' for t in inline.iter(q('t')))
+        v = cell.find(q('v'))
+        if v is None:
+            return None
+        if kind == 's':
+            return self.shared_strings[int(v.text)]
+        return v.text
+
+    def cells_in_row(self, row_idx):
+        row = self.rows.get(row_idx)
+        return [] if row is None else list(row)
+
+    def max_row(self):
+        """Last row that holds any cell (as openpyxl's ws.max_row)"""
+        filled = [r for r, row in self.rows.items() if len(row)]
+        return max(filled) if filled else 1
+
+    def set_row_height(self, row_idx, height):
+        row = self.row(row_idx, create=True)
+        row.set('ht', f"{height:g}")
+        row.set('customHeight', '1')
+
+    def element(self, tag, create=False):
+        el = self.root.find(q(tag))
+        if el is None and create:
+            el = insert_ordered(self.root, ET.Element(q(tag)), WORKSHEET_ORDER)
+        return el
+
+    def set_value(self, ref, value):
+        """Write a number or an inline string into a cell, keeping its style"""
+        cell = self.cell(ref, create=True)
+        for child in list(cell):
+            cell.remove(child)
+        cell.attrib.pop('t', None)
+        if value is None or value == '':
+            return
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            ET.SubElement(cell, q('v')).text = repr(value) if isinstance(value, float) else str(value)
+        else:
+            cell.set('t', 'inlineStr')
+            text = ET.SubElement(ET.SubElement(cell, q('is')), q('t'))
+            text.text = str(value)
+            if text.text != text.text.strip():
+                text.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+
+
+class WorkbookPackage:
+    """An xlsx file opened at the zip level"""
+
+    def __init__(self, path):
+        self.path = path
+        self._load_directory()
+        self._parts = {}
+        self.changed = set()
+        self._sheets = None
+        self._shared_strings = None
+        self._styles = None
+
+    def _load_directory(self):
+        self._stamp = _file_stamp(self.path)
+        with ZipFile(self.path) as archive:
+            self.infos = archive.infolist()
+        self._by_name = {info.filename: info for info in self.infos}
+
+    def read(self, name):
+        """Bytes of a part as stored in the file, decompressed only when asked for"""
+        info = self._by_name.get(name)
+        if info is None or info.compress_type not in (ZIP_DEFLATED, ZIP_STORED):
+            with ZipFile(self.path) as archive:
+                return archive.read(name)
+        # Straight from the part's offset: opening the zip again would re-read the central directory
+        with open(self.path, 'rb') as source:
+            payload = _raw_entry(source, info)[-1]
+        data = zlib.decompress(payload, -15) if info.compress_type == ZIP_DEFLATED else payload
+        if zlib.crc32(data) != info.CRC:
+            raise BadZipFile(f"bad CRC-32 for {name} in {self.path}")
+        return data
+
+    def part(self, name):
+        """Parsed root of a part; edits are kept until save()"""
+        if name not in self._parts:
+            self._parts[name] = parse_xml(self.read(name))
+        return self._parts[name][0]
+
+    def mark_changed(self, name):
+        self.changed.add(name)
+
+    @property
+    def workbook(self):
+        return self.part('xl/workbook.xml')
+
+    @property
+    def sheets(self):
+        """[(sheet name, part name)] in workbook order"""
+        if self._sheets is None:
+            rels = parse_xml(self.read('xl/_rels/workbook.xml.rels'))[0]
+            targets = {rel.get('Id'): rel.get('Target') for rel in rels.iter(f'{{{PKG_REL_NS}}}Relationship')}
+            self._sheets = []
+            for sheet in self.workbook.find(q('sheets')):
+                target = targets[sheet.get(f'{{{DOC_REL_NS}}}id')]
+                part = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+                self._sheets.append((sheet.get('name'), part))
+        return self._sheets
+
+    @property
+    def shared_strings(self):
+        if self._shared_strings is None:
+            self._shared_strings = []
+            if 'xl/sharedStrings.xml' in self._by_name:
+                root = parse_xml(self.read('xl/sharedStrings.xml'))[0]
+                for si in root.iter(q('si')):
+                    self._shared_strings.append(''.join(t.text or '' for t in si.iter(q('t'))))
+        return self._shared_strings
+
+    @property
+    def styles(self):
+        if self._styles is None:
+            self._styles = StyleTable(self.part('xl/styles.xml'))
+        return self._styles
+
+    def sheet(self, part_name):
+        return SheetPart(self.part(part_name), self.shared_strings)
+
+    def set_print_area(self, sheet_index, sheet_name, area):
+        """Set the _xlnm.Print_Area defined name of a sheet, e.g. area='A1:E36'"""
+        start, end = area.split(':')
+        value = "{}!${}${}:${}${}".format(quote_sheet_name(sheet_name), *split_ref(start), *split_ref(end))
+        names = self.workbook.find(q('definedNames'))
+        if names is None:
+            names = insert_ordered(self.workbook, ET.Element(q('definedNames')), WORKBOOK_ORDER)
+        for name in names:
+            if name.get('name') == '_xlnm.Print_Area' and name.get('localSheetId') == str(sheet_index):
+                break
+        else:
+            name = ET.SubElement(names, q('definedName'),
+                                 {'name': '_xlnm.Print_Area', 'localSheetId': str(sheet_index)})
+        if name.text != value:
+            name.text = value
+            self.mark_changed('xl/workbook.xml')
+
+    def save(self, path=None):
+        """Write the package atomically, rewriting only the changed parts
+
+        Every other part is copied as the compressed bytes already in the
+        file, so saving costs one deflate per changed part, not one per part.
+        """
+        path = path or self.path
+        if self._styles is not None and self._styles.changed:
+            self.mark_changed('xl/styles.xml')
+        if _file_stamp(self.path) != self._stamp:
+            raise RuntimeError(f"{self.path} changed on disk since it was opened")
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.~patch', suffix='.xlsx', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f, open(self.path, 'rb') as source:
+                _write_zip(f, self._entries(source))
+            # mkstemp creates the file private; keep the mode of the file it replaces
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(self.path).st_mode))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if os.path.abspath(path) == os.path.abspath(self.path):
+            # Unchanged parts now sit at new offsets of the new file
+            self._load_directory()
+
+    def _entries(self, source):
+        """Zip entries of the package in order: changed parts deflated, the rest as stored"""
+        for info in self.infos:
+            if info.filename in self.changed:
+                root, namespaces = self._parts[info.filename]
+                yield _deflated_entry(info, serialize_xml(root, namespaces))
+            else:
+                yield _raw_entry(source, info)
+
+
+def _file_stamp(path):
+    stat_result = os.stat(path)
+    return stat_result.st_mtime_ns, stat_result.st_size
+
+
+def _raw_entry(source, info):
+    """(info, method, CRC, size, compressed bytes) of a part, read without decompressing it"""
+    source.seek(info.header_offset)
+    header = _LOCAL_HEADER.unpack(source.read(_LOCAL_HEADER.size))
+    if header[0] != b'PK\x03\x04':
+        raise ValueError(f"bad local header for {info.filename}")
+    name_length, extra_length = header[-2:]
+    source.seek(name_length + extra_length, os.SEEK_CUR)
+    return info, info.compress_type, info.CRC, info.file_size, source.read(info.compress_size)
+
+
+def _deflated_entry(info, data):
+    """(info, method, CRC, size, compressed bytes) of a rewritten part"""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return info, ZIP_DEFLATED, zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
+
+
+def _write_zip(f, entries):
+    """Write entries as a zip archive: local headers and data, then the central directory"""
+    central = []
+    for info, method, crc, size, payload in entries:
+        offset = f.tell()
+        if max(offset, size, len(payload)) >= _ZIP32_LIMIT:
+            raise ValueError(f"{info.filename} does not fit a zip without zip64")
+        try:
+            name, flags = info.filename.encode('ascii'), 0
+        except UnicodeEncodeError:
+            name, flags = info.filename.encode('utf-8'), _UTF8_NAME
+        version = 20 if method == ZIP_DEFLATED else 10
+        year, month, day, hour, minute, second = info.date_time
+        dos_time = hour << 11 | minute << 5 | second // 2
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        f.write(_LOCAL_HEADER.pack(b'PK\x03\x04', version, 0, flags, method, dos_time, dos_date,
+                                   crc, len(payload), size, len(name), 0))
+        f.write(name)
+        f.write(payload)
+        central.append(_CENTRAL_HEADER.pack(
+            b'PK\x01\x02', info.create_version, info.create_system, version, 0, flags, method,
+            dos_time, dos_date, crc, len(payload), size, len(name), 0, len(info.comment), 0,
+            info.internal_attr, info.external_attr, offset) + name + info.comment)
+
+    start = f.tell()
+    if start >= _ZIP32_LIMIT or len(central) >= 0xFFFF:
+        raise ValueError("package does not fit a zip without zip64")
+    for record in central:
+        f.write(record)
+    f.write(_END_RECORD.pack(b'PK\x05\x06', 0, 0, len(central), len(central), f.tell() - start, start, 0))
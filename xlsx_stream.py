@@ -0,0 +1,84 @@
+"""Write a write-only openpyxl workbook into its xlsx zip one sheet at a time.
+
+openpyxl's write-only mode streams each sheet to a temporary file, but only
+copies those files into the archive on ``wb.save``. ``StreamingExcelWriter``
+moves every finished sheet into the zip as soon as it is closed, so neither
+the sheet data nor its temporary file outlives the sheet. Both it and
+``save_workbook`` take a zip compression level.
+"""
+from datetime import datetime, timezone
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from openpyxl.packaging.relationship import get_rels_path
+from openpyxl.writer.excel import ExcelWriter
+from openpyxl.xml.functions import tostring
+
+from form_template import openpyxl_tested
+
+# Writing each sheet as it closes overrides ExcelWriter internals and drops
+# worksheet attributes, as laid out in the tested openpyxl series; under any
+# other, sheets are written on save as openpyxl itself does
+EARLY_WRITE = openpyxl_tested()
+
+# Parts of a sheet that the workbook, rels and manifest parts never read
+# once the sheet itself is in the archive
+_RELEASED = (
+    '_writer', '_drawing', 'row_dimensions', 'column_dimensions', 'merged_cells',
+    'HeaderFooter', 'page_setup', 'page_margins', 'print_options', 'views',
+    'protection', 'data_validations', 'conditional_formatting', 'sheet_properties',
+    'sheet_format', 'scenarios', 'row_breaks', 'col_breaks',
+)
+
+
+def open_archive(path, compress_level=None):
+    """New xlsx zip at path; compress_level is zlib's 0-9, None for the default (6)"""
+    return ZipFile(path, 'w', ZIP_DEFLATED, allowZip64=True, compresslevel=compress_level)
+
+
+def save_workbook(workbook, path, compress_level=None):
+    """wb.save(path) with a choice of compression level"""
+    workbook.properties.modified = datetime.now(tz=timezone.utc).replace(tzinfo=None)
+    ExcelWriter(workbook, open_archive(path, compress_level)).save()
+
+
+class StreamingExcelWriter(ExcelWriter):
+    """ExcelWriter that writes closed sheets of a write-only workbook as it goes
+
+    Sheets may only carry cells, dimensions, merges, print setup and
+    hyperlinks; drawings, comments, tables and pivots are not supported.
+    """
+
+    def __init__(self, workbook, path, compress_level=None):
+        if not workbook.write_only:
+            raise ValueError("StreamingExcelWriter needs a write-only workbook")
+        super().__init__(workbook, open_archive(path, compress_level))
+        self._written = 0
+
+    def flush(self):
+        """Move every closed sheet not yet written into the archive (a no-op without EARLY_WRITE)"""
+        if not EARLY_WRITE:
+            return
+        for ws in self.workbook.worksheets[self._written:]:
+            if not ws.closed:
+                break
+            self._written += 1
+            ws._id = self._written
+            self.write_worksheet(ws)
+            if ws._rels:
+                self._archive.writestr(get_rels_path(ws.path)[1:], tostring(ws._rels.to_tree()))
+
+            # Only the title, print area and rels are needed from here on
+            for name in _RELEASED:
+                ws.__dict__.pop(name, None)
+
+    def _write_worksheets(self):
+        if not EARLY_WRITE:
+            return super()._write_worksheets()
+        for ws in self.workbook.worksheets[self._written:]:
+            if not ws.closed:
+                ws.close()
+        self.flush()
+
+    def close(self):
+        """Finish the archive if save() was never reached"""
+        self._archive.close()